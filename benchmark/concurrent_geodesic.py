@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""
+
+Wall-clock time of the geodesic integration and parallel transport, with the backward and forward halves of the
+geodesics integrated sequentially or concurrently (see the concurrent_geodesic_integration model option).
+
+Usage: python benchmark/concurrent_geodesic.py [cpu|cuda]
+
+"""
+
+import glob
+import os
+import re
+import sys
+import time
+import logging
+
+import numpy as np
+import torch
+
+import deformetrica as dfca
+
+logging.getLogger('deformetrica').setLevel(logging.WARNING)
+
+example_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples')
+
+
+def time_function(function, repeats=3):
+    function()  # Warm-up.
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def geodesic_update_and_transport(concurrent_integration, device, grid_size=8, number_of_points=5000,
+                                  number_of_sources=4):
+    """
+    Shoots and flows a geodesic from t0 = 0 to [-1, 1], then transports number_of_sources momenta along it.
+    The control points lie on a regular grid of spacing the kernel width.
+    """
+    torch.manual_seed(42)
+    geodesic = dfca.deformations.Geodesic(
+        kernel=dfca.kernels.factory('torch', kernel_width=1.,
+                                    gpu_mode=dfca.GpuMode.FULL if device == 'cuda' else dfca.GpuMode.NONE),
+        t0=0., concentration_of_time_points=10, use_rk2_for_shoot=True,
+        concurrent_integration=concurrent_integration)
+    geodesic.set_tmin(-1.)
+    geodesic.set_tmax(1.)
+
+    axis = torch.arange(grid_size, dtype=torch.float64, device=device)
+    control_points = torch.stack(torch.meshgrid(axis, axis, axis, indexing='ij'), dim=-1).view(-1, 3)
+    momenta = 0.05 * torch.randn(control_points.size(), dtype=torch.float64, device=device)
+    template_points = {'landmark_points': (grid_size - 1) * torch.rand(number_of_points, 3, dtype=torch.float64,
+                                                                       device=device)}
+    momenta_block = 0.05 * torch.randn((number_of_sources,) + control_points.size(), dtype=torch.float64,
+                                       device=device)
+
+    def run():
+        geodesic.set_control_points_t0(control_points)
+        geodesic.set_momenta_t0(momenta)
+        geodesic.set_template_points_t0(template_points)
+        geodesic.update()
+        geodesic.parallel_transport_many(momenta_block)
+
+    return time_function(run)
+
+
+def geodesic_regression(concurrent_integration, device):
+    data_dir = os.path.join(example_data_dir, 'regression', 'landmark', '2d', 'skulls', 'data')
+    dataset_specifications = {
+        'dataset_filenames': [[{'skull': os.path.join(data_dir, 'skull_%s.vtk' % name)}
+                               for name in ['australopithecus', 'habilis', 'erectus', 'sapiens']]],
+        'visit_ages': [[1, 2, 3, 4]],
+        'subject_ids': [['australopithecus', 'habilis', 'erectus', 'sapiens']]}
+    template_specifications = {
+        'skull': {'deformable_object_type': 'polyline', 'kernel_type': 'torch', 'kernel_width': 20.0,
+                  'noise_std': 1.0, 'filename': os.path.join(data_dir, 'template.vtk'), 'attachment_type': 'varifold'}}
+
+    def run():
+        with dfca.Deformetrica(output_dir='output', verbosity='WARNING') as deformetrica:
+            deformetrica.estimate_geodesic_regression(
+                template_specifications, dataset_specifications,
+                estimator_options={'optimization_method_type': 'GradientAscent', 'max_iterations': 5},
+                model_options={'deformation_kernel_type': 'torch', 'deformation_kernel_width': 25.0,
+                               'concentration_of_time_points': 20, 't0': 2.5,
+                               'concurrent_geodesic_integration': concurrent_integration,
+                               'gpu_mode': dfca.GpuMode.FULL if device == 'cuda' else dfca.GpuMode.NONE},
+                write_output=False)
+
+    return time_function(run, repeats=1)
+
+
+def longitudinal_atlas(concurrent_integration, device):
+    data_dir = os.path.join(example_data_dir, 'longitudinal_atlas', 'landmark', '2d', 'starmen', 'data')
+    visits = {}
+    for filename in glob.glob(os.path.join(data_dir, 'subject_s*__tp_*__age_*.vtk')):
+        subject, visit, age = re.match(r'.*subject_s(\d+)__tp_(\d+)__age_([\d.]+)\.vtk', filename).groups()
+        visits.setdefault(int(subject), []).append((int(visit), float(age), filename))
+    subjects = sorted(visits)
+    dataset_specifications = {
+        'subject_ids': ['s%d' % subject for subject in subjects],
+        'visit_ages': [[age for _, age, _ in sorted(visits[subject])] for subject in subjects],
+        'dataset_filenames': [[{'starman': filename} for _, _, filename in sorted(visits[subject])]
+                              for subject in subjects]}
+    template_specifications = {
+        'starman': {'deformable_object_type': 'polyline', 'noise_std': 1.0, 'attachment_type': 'landmark',
+                    'noise_variance_prior_normalized_dof': 0.01, 'noise_variance_prior_scale_std': 1.,
+                    'filename': os.path.join(data_dir, 'ForInitialization__Template.vtk')}}
+
+    def run():
+        np.random.seed(42)
+        with dfca.Deformetrica(output_dir='output', verbosity='WARNING') as deformetrica:
+            deformetrica.estimate_longitudinal_atlas(
+                template_specifications, dataset_specifications,
+                estimator_options={'optimization_method_type': 'McmcSaem', 'max_iterations': 2,
+                                   'sample_every_n_mcmc_iters': 1},
+                model_options={'deformation_kernel_type': 'torch', 'deformation_kernel_width': 1.0,
+                               'number_of_sources': 4,
+                               'concurrent_geodesic_integration': concurrent_integration},
+                write_output=False)
+
+    return time_function(run, repeats=1)
+
+
+if __name__ == '__main__':
+    device = sys.argv[1] if len(sys.argv) > 1 else 'cpu'
+
+    for name, benchmark in [('geodesic update and transport', geodesic_update_and_transport),
+                            ('geodesic regression', geodesic_regression),
+                            ('longitudinal atlas', longitudinal_atlas)]:
+        sequential = benchmark(False, device)
+        concurrent = benchmark(True, device)
+        print('%-32s sequential: %8.3fs  concurrent: %8.3fs  speedup: %.2f'
+              % (name, sequential, concurrent, sequential / concurrent))
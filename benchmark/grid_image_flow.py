@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""
+
+Wall-clock time and accuracy of the image flow of an exponential, with the velocity fields evaluated by direct kernel
+convolutions or on the image grid (see the use_grid_image_flow model option).
+
+Usage: python benchmark/grid_image_flow.py [cpu|cuda]
+
+"""
+
+import sys
+import time
+import logging
+
+import torch
+
+import deformetrica as dfca
+
+logging.getLogger('deformetrica').setLevel(logging.WARNING)
+
+
+def image_flow(use_grid_image_flow, device, dimension, image_size, kernel_width=10., number_of_time_points=11):
+    """
+    Flows a regular image grid of side image_size, with control points on a regular grid of spacing the kernel width.
+    Returns the mean time taken and the final image points.
+    """
+    torch.manual_seed(42)
+    exponential = dfca.deformations.Exponential(
+        kernel=dfca.kernels.factory('torch', kernel_width=kernel_width,
+                                    gpu_mode=dfca.GpuMode.FULL if device == 'cuda' else dfca.GpuMode.NONE),
+        number_of_time_points=number_of_time_points, use_grid_image_flow=use_grid_image_flow)
+
+    axis = torch.arange(image_size, dtype=torch.float64, device=device)
+    image_points = torch.stack(torch.meshgrid(*[axis] * dimension, indexing='ij'), dim=-1)
+    axis = torch.arange(0., image_size + kernel_width, kernel_width, dtype=torch.float64, device=device)
+    control_points = torch.stack(torch.meshgrid(*[axis] * dimension, indexing='ij'), dim=-1).view(-1, dimension)
+    momenta = 2. * torch.randn(control_points.size(), dtype=torch.float64, device=device)
+
+    exponential.set_initial_control_points(control_points)
+    exponential.set_initial_momenta(momenta)
+    exponential.shoot()
+
+    def run():
+        exponential.set_initial_template_points({'image_points': image_points})
+        exponential.flow()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    run()  # Warm-up.
+    start = time.perf_counter()
+    for _ in range(3):
+        run()
+    return (time.perf_counter() - start) / 3, exponential.get_template_points()['image_points']
+
+
+if __name__ == '__main__':
+    device = sys.argv[1] if len(sys.argv) > 1 else 'cpu'
+
+    for dimension, image_size in [(2, 128), (2, 256), (3, 48), (3, 64)]:
+        direct, direct_points = image_flow(False, device, dimension, image_size)
+        grid, grid_points = image_flow(True, device, dimension, image_size)
+        error = float(torch.max(torch.abs(grid_points - direct_points)))
+        print('%dD image of side %4d    direct: %8.3fs  grid: %8.3fs  speedup: %6.2f  max displacement error: %.2e'
+              % (dimension, image_size, direct, grid, direct / grid, error))
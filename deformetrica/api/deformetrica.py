@@ -253,6 +253,7 @@ class Deformetrica:
         statistical_model = BayesianAtlas(template_specifications, **model_options)
         individual_RER = statistical_model.initialize_random_effects_realization(dataset.number_of_subjects,
                                                                                  **model_options)
+        statistical_model.setup_multiprocess_pool(dataset)
         statistical_model.initialize_noise_variance(dataset, individual_RER)
 
         # Instantiate estimator.
@@ -452,6 +453,7 @@ class Deformetrica:
         individual_RER = statistical_model.initialize(dataset, template_specifications, dataset_specifications,
                                                       model_options, estimator_options, self.output_dir)
 
+        statistical_model.setup_multiprocess_pool(dataset)
         statistical_model.initialize_noise_variance(dataset, individual_RER)
 
         # Instantiate estimator.
@@ -611,6 +613,11 @@ class Deformetrica:
         else:
             default.update_dtype(new_dtype=model_options['dtype'])
 
+        if 'array_file_format' not in model_options:
+            model_options['array_file_format'] = default.array_file_format
+        else:
+            default.update_array_file_format(model_options['array_file_format'])
+
         model_options['tensor_scalar_type'] = default.tensor_scalar_type
         model_options['tensor_integer_type'] = default.tensor_integer_type
 
@@ -642,6 +649,8 @@ class Deformetrica:
             model_options['initial_acceleration_variance'] = default.initial_acceleration_variance
         if 'downsampling_factor' not in model_options:
             model_options['downsampling_factor'] = default.downsampling_factor
+        if 'image_interpolation' not in model_options:
+            model_options['image_interpolation'] = default.image_interpolation
         if 'use_sobolev_gradient' not in model_options:
             model_options['use_sobolev_gradient'] = default.use_sobolev_gradient
         if 'sobolev_kernel_width_ratio' not in model_options:
@@ -734,8 +743,7 @@ class Deformetrica:
                       'Overriding the "number-of-processes" option, now set to 1.' % model_type
                 logger.info('>> ' + msg)
 
-            elif model_type.lower() in ['BayesianAtlas'.lower(), 'Regression'.lower(),
-                                        'LongitudinalRegistration'.lower()]:
+            elif model_type.lower() in ['Regression'.lower(), 'LongitudinalRegistration'.lower()]:
                 model_options['number_of_processes'] = 1
                 msg = 'It is not possible at the moment to estimate a "%s" model with multithreading. ' \
                       'Overriding the "number-of-processes" option, now set to 1.' % model_type
@@ -883,6 +891,8 @@ class Deformetrica:
                         elt['downsampling_factor'] = model_options['downsampling_factor']
                         logger.info('>> Setting the image grid downsampling factor to: %d.' %
                                     model_options['downsampling_factor'])
+                if 'interpolation' not in elt.keys():
+                    elt['interpolation'] = model_options['image_interpolation']
         if count > 1:
             raise RuntimeError('Only a single image object can be used.')
         if count == 0 and not model_options['downsampling_factor'] == 1:
@@ -17,16 +17,23 @@ output_dir = os.path.join(os.getcwd(), 'output')
 preprocessing_dir = os.path.join(os.getcwd(), 'preprocessing')
 state_file = None
 load_state_file = False
+array_file_format = 'txt'  # format of the written parameter arrays: 'txt', or 'npy' (binary, lossless).
 
 # number_of_processes = os.cpu_count()
 number_of_processes = 1
 process_per_gpu = 1
+chunks_per_process = 2    # number of balanced task chunks scheduled per process, see AbstractStatisticalModel.
+subject_cache_size = 2    # number of per-subject likelihood terms kept by the models, see AbstractStatisticalModel.
 
 model_type = 'undefined'
 template_specifications = {}
 deformation_kernel_width = 1.0
 deformation_kernel_type = 'keops'
 deformation_kernel_device = 'auto'
+kernel_tile_size = None     # torch kernel tile size. None: automatically picked from the available memory.
+kernel_memory_fraction = 0.25   # fraction of the available memory that a single torch kernel operation may use.
+kernel_cache_size = 32  # maximum number of kernel instances kept by the kernel factory.
+cometric_cache_memory = None   # maximum memory (in MB) of the cometric factors cached by an exponential. None: unbounded.
 
 shoot_kernel_type = None
 number_of_time_points = 11
@@ -34,6 +41,12 @@ concentration_of_time_points = 10
 number_of_sources = None
 use_rk2_for_shoot = False
 use_rk2_for_flow = False
+adaptive_step_tolerance = None    # tolerance on the local error of the adaptive exponential steps. None: fixed time steps.
+use_batched_exponential = False
+visit_deduplication_tolerance = None  # longitudinal atlas: visits closer than this share their deformation, without gradient.
+concurrent_geodesic_integration = False  # integrates the backward and forward halves of the geodesics in two threads.
+use_grid_image_flow = False  # image flows: evaluates the velocity fields on the image grid, see AbstractKernel.grid_convolve.
+grid_convolution_truncation = 3.5  # support of the Gaussian kernel in grid convolutions, in kernel widths.
 t0 = None
 tmin = float('inf')
 tmax = - float('inf')
@@ -44,11 +57,15 @@ covariance_momenta_prior_normalized_dof = 0.001
 dataset_filenames = []
 visit_ages = []
 subject_ids = []
+number_of_loading_workers = 1  # number of processes reading the dataset objects, see create_dataset. 1: sequential.
+dataset_cache_dir = None  # directory of the preprocessed (and memory-mapped images) dataset objects, see DeformableObjectReader. None: no cache.
 optimization_method_type = 'ScipyLBFGS'
 optimized_log_likelihood = 'complete'
 max_iterations = 100
 max_line_search_iterations = 10
 save_every_n_iters = 100
+use_asynchronous_writer = False  # write the intermediate outputs of the estimators in a background thread.
+asynchronous_writer_queue_size = 1  # number of snapshots waiting to be written before the estimator blocks.
 print_every_n_iters = 1
 sample_every_n_mcmc_iters = 10
 use_sobolev_gradient = True
@@ -63,6 +80,7 @@ noise_variance_prior_normalized_dof = 0.01
 memory_length = 10
 scale_initial_step_size = True
 downsampling_factor = 1
+image_interpolation = 'gather'    # 'gather': single gather of the packed image corners, 'legacy': one gather per corner.
 
 dense_mode = False
 gpu_mode = GpuMode.KERNEL
@@ -132,6 +150,12 @@ initialization_heuristic = False
 verbose = 1
 
 
+def update_array_file_format(new_array_file_format):
+    global array_file_format
+    assert new_array_file_format in ['txt', 'npy'], 'Unknown array file format: ' + str(new_array_file_format)
+    array_file_format = new_array_file_format
+
+
 def update_dtype(new_dtype):
     global dtype
     global tensor_scalar_type
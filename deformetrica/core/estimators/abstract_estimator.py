@@ -1,5 +1,9 @@
+import copy
+import inspect
 import logging
 import os
+import queue
+import threading
 from abc import ABC, abstractmethod
 
 from ...core import default
@@ -7,6 +11,62 @@ from ...core import default
 logger = logging.getLogger(__name__)
 
 
+class AsynchronousWriter:
+    """
+    Writes the outputs of a statistical model in a background thread, see AbstractEstimator._write_statistical_model.
+    The thread owns a copy of the model, whose fixed effects are set from the snapshot of each write. At most
+    queue_size snapshots wait to be written: submitting another one blocks until the oldest one is written.
+    An error raised by a write is re-raised in the estimator thread by the next submit or flush.
+    """
+
+    def __init__(self, statistical_model, dataset, queue_size=default.asynchronous_writer_queue_size):
+        self.statistical_model = statistical_model.copy_for_writing()
+        self.dataset = dataset
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='AsynchronousWriter', daemon=True)
+        self.thread.start()
+
+    def submit(self, fixed_effects, population_RER, individual_RER, output_dir, **kwargs):
+        self._raise_error()
+        self.queue.put((fixed_effects, population_RER, individual_RER, output_dir, kwargs))
+
+    def flush(self):
+        """
+        Waits until all the submitted writes are done.
+        """
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Writes the pending snapshots and stops the thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    fixed_effects, population_RER, individual_RER, output_dir, kwargs = item
+                    self.statistical_model.set_all_fixed_effects(fixed_effects)
+                    self.statistical_model.write(self.dataset, population_RER, individual_RER, output_dir, **kwargs)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('The asynchronous writer failed') from error
+
+
 class AbstractEstimator(ABC):
 
     """
@@ -23,6 +83,7 @@ class AbstractEstimator(ABC):
                  optimized_log_likelihood=default.optimized_log_likelihood,
                  max_iterations=default.max_iterations, convergence_tolerance=default.convergence_tolerance,
                  print_every_n_iters=default.print_every_n_iters, save_every_n_iters=default.save_every_n_iters,
+                 use_asynchronous_writer=default.use_asynchronous_writer,
                  population_RER={}, individual_RER={},
                  callback=None, state_file=None, output_dir=default.output_dir):
 
@@ -36,6 +97,8 @@ class AbstractEstimator(ABC):
         self.convergence_tolerance = convergence_tolerance
         self.print_every_n_iters = print_every_n_iters
         self.save_every_n_iters = save_every_n_iters
+        self.use_asynchronous_writer = use_asynchronous_writer
+        self.asynchronous_writer = None  # Only alive during update(), see _start_asynchronous_writer.
 
         # RER = random effects realization.
         self.population_RER = population_RER
@@ -55,6 +118,48 @@ class AbstractEstimator(ABC):
     def write(self):
         pass
 
+    def _start_asynchronous_writer(self):
+        """
+        Starts the background writer of the intermediate outputs, if requested. To be called at the beginning of
+        update(), and matched by a call to _stop_asynchronous_writer at its end, so that the writes made after the
+        estimation are synchronous.
+        """
+        if self.use_asynchronous_writer and self.asynchronous_writer is None:
+            try:
+                self.asynchronous_writer = AsynchronousWriter(self.statistical_model, self.dataset,
+                                                              queue_size=default.asynchronous_writer_queue_size)
+            except (RuntimeError, TypeError) as e:
+                logger.warning('Cannot copy the statistical model for the asynchronous writer, the outputs will be '
+                               'written synchronously: ' + str(e))
+
+    def _stop_asynchronous_writer(self):
+        """
+        Waits for the pending writes, and stops the background writer.
+        """
+        if self.asynchronous_writer is not None:
+            asynchronous_writer, self.asynchronous_writer = self.asynchronous_writer, None
+            asynchronous_writer.close()
+
+    def _write_statistical_model(self, population_RER, individual_RER, **kwargs):
+        """
+        Writes the outputs of the statistical model, in the background if the asynchronous writer is running: the
+        fixed effects and random effects realizations are then snapshotted, and the estimation goes on while they are
+        written. The writes that update the fixed effects of the model are always synchronous.
+        """
+        update_fixed_effects = inspect.signature(self.statistical_model.write).parameters.get('update_fixed_effects')
+        update_fixed_effects = kwargs.get('update_fixed_effects',
+                                          update_fixed_effects is not None and update_fixed_effects.default)
+
+        if self.asynchronous_writer is not None and not update_fixed_effects:
+            self.asynchronous_writer.submit(copy.deepcopy(self.statistical_model.fixed_effects),
+                                            copy.deepcopy(population_RER), copy.deepcopy(individual_RER),
+                                            self.output_dir, **kwargs)
+        else:
+            if self.asynchronous_writer is not None:
+                # The pending snapshots are older: they must not overwrite these outputs.
+                self.asynchronous_writer.flush()
+            self.statistical_model.write(self.dataset, population_RER, individual_RER, self.output_dir, **kwargs)
+
     def _call_user_callback(self, current_log_likelihood, current_attachment, current_regularity, gradient):
         if self.callback is not None:
             try:
@@ -28,6 +28,7 @@ class GradientAscent(AbstractEstimator):
                  optimized_log_likelihood=default.optimized_log_likelihood,
                  max_iterations=default.max_iterations, convergence_tolerance=default.convergence_tolerance,
                  print_every_n_iters=default.print_every_n_iters, save_every_n_iters=default.save_every_n_iters,
+                 use_asynchronous_writer=default.use_asynchronous_writer,
                  scale_initial_step_size=default.scale_initial_step_size, initial_step_size=default.initial_step_size,
                  max_line_search_iterations=default.max_line_search_iterations,
                  line_search_shrink=default.line_search_shrink,
@@ -40,6 +41,7 @@ class GradientAscent(AbstractEstimator):
                          optimized_log_likelihood=optimized_log_likelihood,
                          max_iterations=max_iterations, convergence_tolerance=convergence_tolerance,
                          print_every_n_iters=print_every_n_iters, save_every_n_iters=save_every_n_iters,
+                         use_asynchronous_writer=use_asynchronous_writer,
                          individual_RER=individual_RER,
                          callback=callback, state_file=state_file, output_dir=output_dir)
 
@@ -84,109 +86,114 @@ class GradientAscent(AbstractEstimator):
         Runs the gradient ascent algorithm and updates the statistical model.
         """
         super().update()
+        self._start_asynchronous_writer()
 
-        self.current_attachment, self.current_regularity, gradient = self._evaluate_model_fit(self.current_parameters,
-                                                                                              with_grad=True)
-        # logger.info(gradient)
-        self.current_log_likelihood = self.current_attachment + self.current_regularity
-        self.print()
-
-        initial_log_likelihood = self.current_log_likelihood
-        last_log_likelihood = initial_log_likelihood
-
-        nb_params = len(gradient)
-        self.step = self._initialize_step_size(gradient)
-
-        # Main loop ----------------------------------------------------------------------------------------------------
-        while self.callback_ret and self.current_iteration < self.max_iterations:
-            self.current_iteration += 1
-
-            # Line search ----------------------------------------------------------------------------------------------
-            found_min = False
-            for li in range(self.max_line_search_iterations):
-
-                # Print step size --------------------------------------------------------------------------------------
-                if not (self.current_iteration % self.print_every_n_iters):
-                    logger.info('>> Step size and gradient norm: ')
-                    for key in gradient.keys():
-                        logger.info('\t\t%.3E   and   %.3E \t[ %s ]' % (Decimal(str(self.step[key])),
-                                                                  Decimal(str(math.sqrt(np.sum(gradient[key] ** 2)))),
-                                                                  key))
-
-                # Try a simple gradient ascent step --------------------------------------------------------------------
-                new_parameters = self._gradient_ascent_step(self.current_parameters, gradient, self.step)
-                new_attachment, new_regularity = self._evaluate_model_fit(new_parameters)
-
-                q = new_attachment + new_regularity - last_log_likelihood
-                if q > 0:
-                    found_min = True
-                    self.step = {key: value * self.line_search_expand for key, value in self.step.items()}
-                    break
-
-                # Adapting the step sizes ------------------------------------------------------------------------------
-                self.step = {key: value * self.line_search_shrink for key, value in self.step.items()}
-                if nb_params > 1:
-                    new_parameters_prop = {}
-                    new_attachment_prop = {}
-                    new_regularity_prop = {}
-                    q_prop = {}
-
-                    for key in self.step.keys():
-                        local_step = self.step.copy()
-                        local_step[key] /= self.line_search_shrink
-                        new_parameters_prop[key] = self._gradient_ascent_step(self.current_parameters, gradient, local_step)
-                        new_attachment_prop[key], new_regularity_prop[key] = self._evaluate_model_fit(new_parameters_prop[key])
-                        q_prop[key] = new_attachment_prop[key] + new_regularity_prop[key] - last_log_likelihood
-
-                    key_max = max(q_prop.keys(), key=(lambda key: q_prop[key]))
-                    if q_prop[key_max] > 0:
-                        new_attachment = new_attachment_prop[key_max]
-                        new_regularity = new_regularity_prop[key_max]
-                        new_parameters = new_parameters_prop[key_max]
-                        self.step[key_max] /= self.line_search_shrink
+        try:
+            self.current_attachment, self.current_regularity, gradient = self._evaluate_model_fit(
+                self.current_parameters, with_grad=True)
+            # logger.info(gradient)
+            self.current_log_likelihood = self.current_attachment + self.current_regularity
+            self.print()
+
+            initial_log_likelihood = self.current_log_likelihood
+            last_log_likelihood = initial_log_likelihood
+
+            nb_params = len(gradient)
+            self.step = self._initialize_step_size(gradient)
+
+            # Main loop ------------------------------------------------------------------------------------------------
+            while self.callback_ret and self.current_iteration < self.max_iterations:
+                self.current_iteration += 1
+
+                # Line search ------------------------------------------------------------------------------------------
+                found_min = False
+                for li in range(self.max_line_search_iterations):
+
+                    # Print step size ----------------------------------------------------------------------------------
+                    if not (self.current_iteration % self.print_every_n_iters):
+                        logger.info('>> Step size and gradient norm: ')
+                        for key in gradient.keys():
+                            logger.info('\t\t%.3E   and   %.3E \t[ %s ]' % (
+                                Decimal(str(self.step[key])), Decimal(str(math.sqrt(np.sum(gradient[key] ** 2)))), key))
+
+                    # Try a simple gradient ascent step ----------------------------------------------------------------
+                    new_parameters = self._gradient_ascent_step(self.current_parameters, gradient, self.step)
+                    new_attachment, new_regularity = self._evaluate_model_fit(new_parameters)
+
+                    q = new_attachment + new_regularity - last_log_likelihood
+                    if q > 0:
                         found_min = True
+                        self.step = {key: value * self.line_search_expand for key, value in self.step.items()}
                         break
 
-            # End of line search ---------------------------------------------------------------------------------------
-            if not found_min:
-                self._set_parameters(self.current_parameters)
-                logger.info('Number of line search loops exceeded. Stopping.')
-                break
+                    # Adapting the step sizes --------------------------------------------------------------------------
+                    self.step = {key: value * self.line_search_shrink for key, value in self.step.items()}
+                    if nb_params > 1:
+                        new_parameters_prop = {}
+                        new_attachment_prop = {}
+                        new_regularity_prop = {}
+                        q_prop = {}
+
+                        for key in self.step.keys():
+                            local_step = self.step.copy()
+                            local_step[key] /= self.line_search_shrink
+                            new_parameters_prop[key] = self._gradient_ascent_step(self.current_parameters, gradient,
+                                                                                  local_step)
+                            new_attachment_prop[key], new_regularity_prop[key] = self._evaluate_model_fit(
+                                new_parameters_prop[key])
+                            q_prop[key] = new_attachment_prop[key] + new_regularity_prop[key] - last_log_likelihood
+
+                        key_max = max(q_prop.keys(), key=(lambda key: q_prop[key]))
+                        if q_prop[key_max] > 0:
+                            new_attachment = new_attachment_prop[key_max]
+                            new_regularity = new_regularity_prop[key_max]
+                            new_parameters = new_parameters_prop[key_max]
+                            self.step[key_max] /= self.line_search_shrink
+                            found_min = True
+                            break
+
+                # End of line search -----------------------------------------------------------------------------------
+                if not found_min:
+                    self._set_parameters(self.current_parameters)
+                    logger.info('Number of line search loops exceeded. Stopping.')
+                    break
 
-            self.current_attachment = new_attachment
-            self.current_regularity = new_regularity
-            self.current_log_likelihood = new_attachment + new_regularity
-            self.current_parameters = new_parameters
-            self._set_parameters(self.current_parameters)
+                self.current_attachment = new_attachment
+                self.current_regularity = new_regularity
+                self.current_log_likelihood = new_attachment + new_regularity
+                self.current_parameters = new_parameters
+                self._set_parameters(self.current_parameters)
 
-            # Test the stopping criterion ------------------------------------------------------------------------------
-            current_log_likelihood = self.current_log_likelihood
-            delta_f_current = last_log_likelihood - current_log_likelihood
-            delta_f_initial = initial_log_likelihood - current_log_likelihood
+                # Test the stopping criterion --------------------------------------------------------------------------
+                current_log_likelihood = self.current_log_likelihood
+                delta_f_current = last_log_likelihood - current_log_likelihood
+                delta_f_initial = initial_log_likelihood - current_log_likelihood
 
-            if math.fabs(delta_f_current) < self.convergence_tolerance * math.fabs(delta_f_initial):
-                logger.info('Tolerance threshold met. Stopping the optimization process.')
-                break
+                if math.fabs(delta_f_current) < self.convergence_tolerance * math.fabs(delta_f_initial):
+                    logger.info('Tolerance threshold met. Stopping the optimization process.')
+                    break
 
-            # Printing and writing -------------------------------------------------------------------------------------
-            if not self.current_iteration % self.print_every_n_iters: self.print()
-            if not self.current_iteration % self.save_every_n_iters: self.write()
+                # Printing and writing ---------------------------------------------------------------------------------
+                if not self.current_iteration % self.print_every_n_iters: self.print()
+                if not self.current_iteration % self.save_every_n_iters: self.write()
 
-            # Call user callback function ------------------------------------------------------------------------------
-            if self.callback is not None:
-                self._call_user_callback(float(self.current_log_likelihood), float(self.current_attachment),
-                                         float(self.current_regularity), gradient)
+                # Call user callback function --------------------------------------------------------------------------
+                if self.callback is not None:
+                    self._call_user_callback(float(self.current_log_likelihood), float(self.current_attachment),
+                                             float(self.current_regularity), gradient)
 
-            # Prepare next iteration -----------------------------------------------------------------------------------
-            last_log_likelihood = current_log_likelihood
-            if not self.current_iteration == self.max_iterations:
-                gradient = self._evaluate_model_fit(self.current_parameters, with_grad=True)[2]
-                # logger.info(gradient)
+                # Prepare next iteration -------------------------------------------------------------------------------
+                last_log_likelihood = current_log_likelihood
+                if not self.current_iteration == self.max_iterations:
+                    gradient = self._evaluate_model_fit(self.current_parameters, with_grad=True)[2]
+                    # logger.info(gradient)
 
-            # Save the state.
-            if not self.current_iteration % self.save_every_n_iters: self._dump_state_file()
+                # Save the state.
+                if not self.current_iteration % self.save_every_n_iters: self._dump_state_file()
 
-        # end of estimator loop
+            # end of estimator loop
+        finally:
+            self._stop_asynchronous_writer()
 
     def print(self):
         """
@@ -204,7 +211,7 @@ class GradientAscent(AbstractEstimator):
         Save the current results.
         """
         # pass
-        self.statistical_model.write(self.dataset, self.population_RER, self.individual_RER, self.output_dir)
+        self._write_statistical_model(self.population_RER, self.individual_RER)
         self._dump_state_file()
 
     ####################################################################################################################
@@ -25,6 +25,7 @@ class McmcSaem(AbstractEstimator):
     def __init__(self, statistical_model, dataset, optimization_method_type='undefined', individual_RER={},
                  max_iterations=default.max_iterations,
                  print_every_n_iters=default.print_every_n_iters, save_every_n_iters=default.save_every_n_iters,
+                 use_asynchronous_writer=default.use_asynchronous_writer,
                  sampler=default.sampler,
                  individual_proposal_distributions=default.individual_proposal_distributions,
                  sample_every_n_mcmc_iters=default.sample_every_n_mcmc_iters,
@@ -41,6 +42,7 @@ class McmcSaem(AbstractEstimator):
                          max_iterations=max_iterations,
                          convergence_tolerance=convergence_tolerance,
                          print_every_n_iters=print_every_n_iters, save_every_n_iters=save_every_n_iters,
+                         use_asynchronous_writer=use_asynchronous_writer,
                          individual_RER=individual_RER,
                          callback=callback, state_file=state_file, output_dir=output_dir)
 
@@ -65,7 +67,7 @@ class McmcSaem(AbstractEstimator):
             statistical_model, dataset,
             optimized_log_likelihood='class2',
             max_iterations=5, convergence_tolerance=convergence_tolerance,
-            print_every_n_iters=1, save_every_n_iters=100000,
+            print_every_n_iters=1, save_every_n_iters=100000, use_asynchronous_writer=False,
             scale_initial_step_size=scale_initial_step_size, initial_step_size=initial_step_size,
             max_line_search_iterations=max_line_search_iterations,
             line_search_shrink=line_search_shrink,
@@ -114,84 +116,89 @@ class McmcSaem(AbstractEstimator):
         """
         Runs the MCMC-SAEM algorithm and updates the statistical model.
         """
-
-        # Print initial console information.
-        logger.info('------------------------------------- Iteration: ' + str(
-            self.current_iteration) + ' -------------------------------------')
-        logger.info('>> MCMC-SAEM algorithm launched for ' + str(self.max_iterations) + ' iterations (' + str(
-            self.number_of_burn_in_iterations) + ' iterations of burn-in).')
-        self.statistical_model.print(self.individual_RER)
-
-        # Initialization of the average random effects realizations.
-        averaged_population_RER = {key: np.zeros(value.shape) for key, value in self.population_RER.items()}
-        averaged_individual_RER = {key: np.zeros(value.shape) for key, value in self.individual_RER.items()}
-
-        # Main loop ----------------------------------------------------------------------------------------------------
-        while self.callback_ret and self.current_iteration < self.max_iterations:
-            self.current_iteration += 1
-            step = self._compute_step_size()
-
-            # Simulation.
-            current_model_terms = None
-            for n in range(self.sample_every_n_mcmc_iters):
-                self.current_mcmc_iteration += 1
-
-                # Single iteration of the MCMC.
-                self.current_acceptance_rates, current_model_terms = self.sampler.sample(
-                    self.statistical_model, self.dataset, self.population_RER, self.individual_RER,
-                    current_model_terms)
-
-                # Adapt proposal variances.
-                self._update_acceptance_rate_information()
-                if not (self.current_mcmc_iteration % self.memory_window_size):
-                    self.average_acceptance_rates_in_window = {
-                        key: np.mean(self.current_acceptance_rates_in_window[key])
-                        for key in self.sampler.individual_proposal_distributions.keys()}
-                    self.sampler.adapt_proposal_distributions(
-                        self.average_acceptance_rates_in_window,
-                        self.current_mcmc_iteration,
-                        not self.current_iteration % self.print_every_n_iters and n == self.sample_every_n_mcmc_iters - 1)
-
-            # Maximization for the class 1 fixed effects.
-            sufficient_statistics = self.statistical_model.compute_sufficient_statistics(
-                self.dataset, self.population_RER, self.individual_RER, model_terms=current_model_terms)
-            self.sufficient_statistics = {key: value + step * (sufficient_statistics[key] - value) for key, value in
-                                          self.sufficient_statistics.items()}
-            self.statistical_model.update_fixed_effects(self.dataset, self.sufficient_statistics)
-
-            # Maximization for the class 2 fixed effects.
-            fixed_effects_before_maximization = self.statistical_model.get_fixed_effects()
-            self._maximize_over_fixed_effects()
-            fixed_effects_after_maximization = self.statistical_model.get_fixed_effects()
-            fixed_effects = {key: value + step * (fixed_effects_after_maximization[key] - value) for key, value in
-                             fixed_effects_before_maximization.items()}
-            self.statistical_model.set_fixed_effects(fixed_effects)
-
-            # Averages the random effect realizations in the concentration phase.
-            if step < 1.0:
-                coefficient_1 = float(self.current_iteration + 1 - self.number_of_burn_in_iterations)
-                coefficient_2 = (coefficient_1 - 1.0) / coefficient_1
-                averaged_population_RER = {key: value * coefficient_2 + self.population_RER[key] / coefficient_1 for
-                                           key, value in averaged_population_RER.items()}
-                averaged_individual_RER = {key: value * coefficient_2 + self.individual_RER[key] / coefficient_1 for
-                                           key, value in averaged_individual_RER.items()}
-                self._update_individual_random_effects_samples_stack()
-
-            else:
-                averaged_individual_RER = self.individual_RER
-                averaged_population_RER = self.population_RER
-
-            # Saving, printing, writing.
-            if not (self.current_iteration % self.save_model_parameters_every_n_iters):
-                self._update_model_parameters_trajectory()
-            if not (self.current_iteration % self.print_every_n_iters):
-                self.print()
-            if not (self.current_iteration % self.save_every_n_iters):
-                self.write()
-
-        # Finalization -------------------------------------------------------------------------------------------------
-        self.population_RER = averaged_population_RER
-        self.individual_RER = averaged_individual_RER
+        self._start_asynchronous_writer()
+
+        try:
+            # Print initial console information.
+            logger.info('------------------------------------- Iteration: ' + str(
+                self.current_iteration) + ' -------------------------------------')
+            logger.info('>> MCMC-SAEM algorithm launched for ' + str(self.max_iterations) + ' iterations (' + str(
+                self.number_of_burn_in_iterations) + ' iterations of burn-in).')
+            self.statistical_model.print(self.individual_RER)
+
+            # Initialization of the average random effects realizations.
+            averaged_population_RER = {key: np.zeros(value.shape) for key, value in self.population_RER.items()}
+            averaged_individual_RER = {key: np.zeros(value.shape) for key, value in self.individual_RER.items()}
+
+            # Main loop ------------------------------------------------------------------------------------------------
+            while self.callback_ret and self.current_iteration < self.max_iterations:
+                self.current_iteration += 1
+                step = self._compute_step_size()
+
+                # Simulation.
+                current_model_terms = None
+                for n in range(self.sample_every_n_mcmc_iters):
+                    self.current_mcmc_iteration += 1
+
+                    # Single iteration of the MCMC.
+                    self.current_acceptance_rates, current_model_terms = self.sampler.sample(
+                        self.statistical_model, self.dataset, self.population_RER, self.individual_RER,
+                        current_model_terms)
+
+                    # Adapt proposal variances.
+                    self._update_acceptance_rate_information()
+                    if not (self.current_mcmc_iteration % self.memory_window_size):
+                        self.average_acceptance_rates_in_window = {
+                            key: np.mean(self.current_acceptance_rates_in_window[key])
+                            for key in self.sampler.individual_proposal_distributions.keys()}
+                        self.sampler.adapt_proposal_distributions(
+                            self.average_acceptance_rates_in_window,
+                            self.current_mcmc_iteration,
+                            not self.current_iteration % self.print_every_n_iters
+                            and n == self.sample_every_n_mcmc_iters - 1)
+
+                # Maximization for the class 1 fixed effects.
+                sufficient_statistics = self.statistical_model.compute_sufficient_statistics(
+                    self.dataset, self.population_RER, self.individual_RER, model_terms=current_model_terms)
+                self.sufficient_statistics = {key: value + step * (sufficient_statistics[key] - value) for key, value in
+                                              self.sufficient_statistics.items()}
+                self.statistical_model.update_fixed_effects(self.dataset, self.sufficient_statistics)
+
+                # Maximization for the class 2 fixed effects.
+                fixed_effects_before_maximization = self.statistical_model.get_fixed_effects()
+                self._maximize_over_fixed_effects()
+                fixed_effects_after_maximization = self.statistical_model.get_fixed_effects()
+                fixed_effects = {key: value + step * (fixed_effects_after_maximization[key] - value) for key, value in
+                                 fixed_effects_before_maximization.items()}
+                self.statistical_model.set_fixed_effects(fixed_effects)
+
+                # Averages the random effect realizations in the concentration phase.
+                if step < 1.0:
+                    coefficient_1 = float(self.current_iteration + 1 - self.number_of_burn_in_iterations)
+                    coefficient_2 = (coefficient_1 - 1.0) / coefficient_1
+                    averaged_population_RER = {key: value * coefficient_2 + self.population_RER[key] / coefficient_1 for
+                                               key, value in averaged_population_RER.items()}
+                    averaged_individual_RER = {key: value * coefficient_2 + self.individual_RER[key] / coefficient_1 for
+                                               key, value in averaged_individual_RER.items()}
+                    self._update_individual_random_effects_samples_stack()
+
+                else:
+                    averaged_individual_RER = self.individual_RER
+                    averaged_population_RER = self.population_RER
+
+                # Saving, printing, writing.
+                if not (self.current_iteration % self.save_model_parameters_every_n_iters):
+                    self._update_model_parameters_trajectory()
+                if not (self.current_iteration % self.print_every_n_iters):
+                    self.print()
+                if not (self.current_iteration % self.save_every_n_iters):
+                    self.write()
+
+            # Finalization ---------------------------------------------------------------------------------------------
+            self.population_RER = averaged_population_RER
+            self.individual_RER = averaged_individual_RER
+        finally:
+            self._stop_asynchronous_writer()
 
     def print(self):
         """
@@ -207,6 +214,12 @@ class McmcSaem(AbstractEstimator):
         for random_effect_name, average_acceptance_rate in self.average_acceptance_rates.items():
             logger.info('\t\t %.2f \t[ %s ]' % (average_acceptance_rate, random_effect_name))
 
+        # Hit rate of the per-subject likelihood cache of the model, if used.
+        hits, misses = (self.statistical_model.subject_cache_info[key] for key in ['hits', 'misses'])
+        if hits + misses > 0:
+            logger.info('>> Subject likelihood cache hit rate (all past iterations): %.2f%% \t[ %d / %d ]'
+                        % (100. * hits / (hits + misses), hits, hits + misses))
+
         # Let the model under optimization print information about itself.
         self.statistical_model.print(self.individual_RER)
 
@@ -219,8 +232,7 @@ class McmcSaem(AbstractEstimator):
             population_RER = self.population_RER
         if individual_RER is None:
             individual_RER = self.individual_RER
-        self.statistical_model.write(self.dataset, population_RER, individual_RER, self.output_dir,
-                                     update_fixed_effects=False)
+        self._write_statistical_model(population_RER, individual_RER, update_fixed_effects=False)
 
         # Save the recorded model parameters trajectory.
         # self.model_parameters_trajectory is a list of dictionaries
@@ -26,6 +26,7 @@ class ScipyOptimize(AbstractEstimator):
                  optimized_log_likelihood=default.optimized_log_likelihood,
                  max_iterations=default.max_iterations, convergence_tolerance=default.convergence_tolerance,
                  print_every_n_iters=default.print_every_n_iters, save_every_n_iters=default.save_every_n_iters,
+                 use_asynchronous_writer=default.use_asynchronous_writer,
                  memory_length=default.memory_length,
                  # parameters_shape, parameters_order, gradient_memory,
                  max_line_search_iterations=default.max_line_search_iterations,
@@ -38,6 +39,7 @@ class ScipyOptimize(AbstractEstimator):
                          optimized_log_likelihood=optimized_log_likelihood,
                          max_iterations=max_iterations, convergence_tolerance=convergence_tolerance,
                          print_every_n_iters=print_every_n_iters, save_every_n_iters=save_every_n_iters,
+                         use_asynchronous_writer=use_asynchronous_writer,
                          individual_RER=individual_RER,
                          callback=callback, state_file=state_file, output_dir=output_dir)
 
@@ -96,6 +98,7 @@ class ScipyOptimize(AbstractEstimator):
             logger.info('>> Scipy optimization method: ' + self.method)
             self.print()
 
+        self._start_asynchronous_writer()
         try:
             if self.method == 'L-BFGS-B':
                 result = minimize(self._cost_and_derivative, self.x0.astype('float64'),
@@ -149,6 +152,7 @@ class ScipyOptimize(AbstractEstimator):
         except StopIteration:
             logger.info('>> STOP: TOTAL NO. of ITERATIONS EXCEEDS LIMIT')
         finally:
+            self._stop_asynchronous_writer()
             self.statistical_model.cleanup()
 
     def print(self):
@@ -175,7 +179,7 @@ class ScipyOptimize(AbstractEstimator):
         """
         Save the results.
         """
-        self.statistical_model.write(self.dataset, self.population_RER, self.individual_RER, self.output_dir)
+        self._write_statistical_model(self.population_RER, self.individual_RER)
         self._dump_state_file(self._vectorize_parameters(self._get_parameters()))
 
 
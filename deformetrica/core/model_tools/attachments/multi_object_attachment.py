@@ -76,6 +76,54 @@ class MultiObjectAttachment:
 
         return distances
 
+    def compute_batched_weighted_distance(self, data, multi_obj1, multi_objs2, inverse_weights):
+        """
+        Batched version of compute_weighted_distance, for several deformations of multi_obj1 that are each compared to
+        their own target: data['landmark_points'] is of size (number_of_targets, number_of_points, dimension), and
+        multi_objs2 is the list of the target multi-objects. Returns the sum of the weighted distances over all targets.
+        """
+        distances = self.compute_batched_distances(data, multi_obj1, multi_objs2)
+        assert distances.size()[1] == len(inverse_weights)
+        inverse_weights_torch = utilities.move_data(inverse_weights, device=distances.device, dtype=distances.dtype)
+        return torch.sum(distances / inverse_weights_torch)
+
+    def compute_batched_distances(self, data, multi_obj1, multi_objs2):
+        """
+        Batched version of compute_distances, only available for landmark objects. Each kernel reduction is evaluated
+        once for all the targets, the targets of different sizes being padded with zero-weight points.
+        Returns a tensor of size (number_of_targets, number_of_objects).
+        """
+        assert all(len(multi_obj1.object_list) == len(multi_obj2.object_list) for multi_obj2 in multi_objs2), \
+            "Cannot compute distance between multi-objects which have different number of objects"
+        assert 'image_intensities' not in data.keys(), 'Batched distances are not available for image objects.'
+        points = data['landmark_points']
+        distances = torch.zeros((len(multi_objs2), len(multi_obj1.object_list)), device=points.device,
+                                dtype=points.dtype)
+
+        pos = 0
+        for i, obj1 in enumerate(multi_obj1.object_list):
+            objs2 = [multi_obj2.object_list[i] for multi_obj2 in multi_objs2]
+            obj1_points = points[:, pos:pos + obj1.get_number_of_points()]
+            pos += obj1.get_number_of_points()
+
+            if self.attachment_types[i].lower() == 'current':
+                distances[:, i] = self.batched_current_distance(obj1_points, obj1, objs2, self.kernels[i])
+
+            elif self.attachment_types[i].lower() == 'pointcloud':
+                distances[:, i] = self.batched_point_cloud_distance(obj1_points, obj1, objs2, self.kernels[i])
+
+            elif self.attachment_types[i].lower() == 'varifold':
+                distances[:, i] = self.batched_varifold_distance(obj1_points, obj1, objs2, self.kernels[i])
+
+            elif self.attachment_types[i].lower() == 'landmark':
+                distances[:, i] = self.batched_landmark_distance(obj1_points, objs2)
+
+            else:
+                assert False, "Please implement the batched distance {e} you are trying to use :)".format(
+                    e=self.attachment_types[i])
+
+        return distances
+
     ####################################################################################################################
     ### Auxiliary methods:
     ####################################################################################################################
@@ -87,16 +135,18 @@ class MultiObjectAttachment:
         We assume here that the target never moves.
         """
         device, _ = utilities.get_best_device(kernel.gpu_mode)
-        c1, n1, c2, n2 = MultiObjectAttachment.__get_source_and_target_centers_and_normals(points, source, target, device=device)
+        c1, n1 = MultiObjectAttachment.__get_source_centers_and_normals(points, source, device=device)
+        target_data = MultiObjectAttachment.__get_target_data(points, target, kernel, 'current', device=device)
+        c2, n2 = target_data['centers'], target_data['normals']
 
         def current_scalar_product(points_1, points_2, normals_1, normals_2):
             assert points_1.device == points_2.device == normals_1.device == normals_2.device, 'tensors must be on the same device'
             return torch.dot(normals_1.view(-1), kernel.convolve(points_1, points_2, normals_2).view(-1))
 
-        if target.norm is None:
-            target.norm = current_scalar_product(c2, c2, n2, n2)
+        if 'norm' not in target_data:
+            target_data['norm'] = current_scalar_product(c2, c2, n2, n2)
 
-        return current_scalar_product(c1, c1, n1, n1) + target.norm.to(c1.device) - 2 * current_scalar_product(c1, c2, n1, n2)
+        return current_scalar_product(c1, c1, n1, n1) + target_data['norm'] - 2 * current_scalar_product(c1, c2, n1, n2)
 
     @staticmethod
     def point_cloud_distance(points, source, target, kernel):
@@ -105,16 +155,19 @@ class MultiObjectAttachment:
         We assume here that the target never moves.
         """
         device, _ = utilities.get_best_device(kernel.gpu_mode)
-        c1, n1, c2, n2 = MultiObjectAttachment.__get_source_and_target_centers_and_normals(points, source, target, device=device)
+        c1, n1 = MultiObjectAttachment.__get_source_centers_and_normals(points, source, device=device)
+        target_data = MultiObjectAttachment.__get_target_data(points, target, kernel, 'pointcloud', device=device)
+        c2, n2 = target_data['centers'], target_data['normals']
 
         def point_cloud_scalar_product(points_1, points_2, normals_1, normals_2):
             return torch.dot(normals_1.view(-1),
                              kernel.convolve(points_1, points_2, normals_2, mode='pointcloud').view(-1))
 
-        if target.norm is None:
-            target.norm = point_cloud_scalar_product(c2, c2, n2, n2)
+        if 'norm' not in target_data:
+            target_data['norm'] = point_cloud_scalar_product(c2, c2, n2, n2)
 
-        return point_cloud_scalar_product(c1, c1, n1, n1) + target.norm - 2 * point_cloud_scalar_product(c1, c2, n1, n2)
+        return point_cloud_scalar_product(c1, c1, n1, n1) + target_data['norm'] \
+               - 2 * point_cloud_scalar_product(c1, c2, n1, n2)
 
     @staticmethod
     def varifold_distance(points, source, target, kernel):
@@ -125,22 +178,27 @@ class MultiObjectAttachment:
         points are source points (torch tensor)
         """
         device, _ = utilities.get_best_device(kernel.gpu_mode)
-        c1, n1, c2, n2 = MultiObjectAttachment.__get_source_and_target_centers_and_normals(points, source, target, device=device)
+        c1, n1 = MultiObjectAttachment.__get_source_centers_and_normals(points, source, device=device)
+        target_data = MultiObjectAttachment.__get_target_data(points, target, kernel, 'varifold', device=device)
+        c2 = target_data['centers']
 
         # alpha = normales non unitaires
         areaa = torch.norm(n1, 2, 1)
-        areab = torch.norm(n2, 2, 1)
-
         nalpha = n1 / areaa.unsqueeze(1)
-        nbeta = n2 / areab.unsqueeze(1)
+
+        if 'areas' not in target_data:
+            n2 = target_data['normals']
+            target_data['areas'] = torch.norm(n2, 2, 1)
+            target_data['unit_normals'] = n2 / target_data['areas'].unsqueeze(1)
+        areab, nbeta = target_data['areas'], target_data['unit_normals']
 
         def varifold_scalar_product(x, y, areaa, areab, nalpha, nbeta):
             return torch.dot(areaa.view(-1), kernel.convolve((x, nalpha), (y, nbeta), areab.view(-1, 1), mode='varifold').view(-1))
 
-        if target.norm is None:
-            target.norm = varifold_scalar_product(c2, c2, areab, areab, nbeta, nbeta)
+        if 'norm' not in target_data:
+            target_data['norm'] = varifold_scalar_product(c2, c2, areab, areab, nbeta, nbeta)
 
-        return varifold_scalar_product(c1, c1, areaa, areaa, nalpha, nalpha) + target.norm \
+        return varifold_scalar_product(c1, c1, areaa, areaa, nalpha, nalpha) + target_data['norm'] \
                - 2 * varifold_scalar_product(c1, c2, areaa, areab, nalpha, nbeta)
 
     @staticmethod
@@ -148,7 +206,10 @@ class MultiObjectAttachment:
         """
         Point correspondance distance
         """
-        target_points = utilities.move_data(target.get_points(), dtype=str(points.type()), device=points.device)
+        target_data = target.attachment_cache.setdefault(('landmark', str(points.device), str(points.dtype)), {})
+        if 'points' not in target_data:
+            target_data['points'] = utilities.move_data(target.get_points(), dtype=points.dtype, device=points.device)
+        target_points = target_data['points']
         assert points.device == target_points.device, 'tensors must be on the same device'
         return torch.sum((points.contiguous().view(-1) - target_points.contiguous().view(-1)) ** 2)
 
@@ -164,17 +225,96 @@ class MultiObjectAttachment:
 
         assert isinstance(intensities, torch.Tensor)
 
-        target_intensities = utilities.move_data(target.get_intensities(), dtype=intensities.type(), device=intensities.device)
+        target_data = target.attachment_cache.setdefault(('L2', str(intensities.device), str(intensities.dtype)), {})
+        if 'intensities' not in target_data:
+            target_data['intensities'] = utilities.move_data(target.get_intensities(), dtype=intensities.dtype,
+                                                             device=intensities.device)
+        target_intensities = target_data['intensities']
         # target_intensities = target.get_intensities_torch(tensor_scalar_type=intensities.type(), device=intensities.device)
         assert intensities.device == target_intensities.device, 'tensors must be on the same device'
         return torch.sum((intensities.contiguous().view(-1) - target_intensities.contiguous().view(-1)) ** 2)
 
+    @staticmethod
+    def batched_current_distance(points, source, targets, kernel):
+        """
+        Batched version of current_distance: points is of size (number_of_targets, number_of_points, dimension).
+        """
+        def current_scalar_products(points_1, points_2, normals_1, normals_2):
+            return torch.sum(normals_1 * kernel.batched_convolve(points_1, points_2, normals_2), (1, 2))
+
+        device, _ = utilities.get_best_device(kernel.gpu_mode)
+        c1, n1 = MultiObjectAttachment.__get_source_centers_and_normals(points, source, device=device)
+        c2, n2, norms = MultiObjectAttachment.__get_batched_target_data(
+            points, targets, kernel, 'current', ['centers', 'normals'], current_scalar_products, device=device)
+
+        return current_scalar_products(c1, c1, n1, n1) + norms - 2 * current_scalar_products(c1, c2, n1, n2)
+
+    @staticmethod
+    def batched_point_cloud_distance(points, source, targets, kernel):
+        """
+        Batched version of point_cloud_distance: points is of size (number_of_targets, number_of_points, dimension).
+        """
+        def point_cloud_scalar_products(points_1, points_2, normals_1, normals_2):
+            return torch.sum(normals_1 * kernel.batched_convolve(points_1, points_2, normals_2, mode='pointcloud'),
+                             (1, 2))
+
+        device, _ = utilities.get_best_device(kernel.gpu_mode)
+        c1, n1 = MultiObjectAttachment.__get_source_centers_and_normals(points, source, device=device)
+        c2, n2, norms = MultiObjectAttachment.__get_batched_target_data(
+            points, targets, kernel, 'pointcloud', ['centers', 'normals'], point_cloud_scalar_products, device=device)
+
+        return point_cloud_scalar_products(c1, c1, n1, n1) + norms - 2 * point_cloud_scalar_products(c1, c2, n1, n2)
+
+    @staticmethod
+    def batched_varifold_distance(points, source, targets, kernel):
+        """
+        Batched version of varifold_distance: points is of size (number_of_targets, number_of_points, dimension).
+        """
+        def varifold_scalar_products(x, y, areaa, areab, nalpha, nbeta):
+            return torch.sum(areaa * kernel.batched_convolve(
+                (x, nalpha), (y, nbeta), areab.unsqueeze(2), mode='varifold').squeeze(2), 1)
+
+        device, _ = utilities.get_best_device(kernel.gpu_mode)
+        c1, n1 = MultiObjectAttachment.__get_source_centers_and_normals(points, source, device=device)
+        areaa = torch.norm(n1, 2, 2)
+        nalpha = n1 / areaa.unsqueeze(2)
+
+        for target in targets:
+            target_data = MultiObjectAttachment.__get_target_data(points, target, kernel, 'varifold', device=device)
+            if 'areas' not in target_data:
+                n2 = target_data['normals']
+                target_data['areas'] = torch.norm(n2, 2, 1)
+                target_data['unit_normals'] = n2 / target_data['areas'].unsqueeze(1)
+
+        c2, areab, nbeta, norms = MultiObjectAttachment.__get_batched_target_data(
+            points, targets, kernel, 'varifold', ['centers', 'areas', 'unit_normals'],
+            varifold_scalar_products, device=device)
+
+        return varifold_scalar_products(c1, c1, areaa, areaa, nalpha, nalpha) + norms \
+               - 2 * varifold_scalar_products(c1, c2, areaa, areab, nalpha, nbeta)
+
+    @staticmethod
+    def batched_landmark_distance(points, targets):
+        """
+        Batched version of landmark_distance: points is of size (number_of_targets, number_of_points, dimension).
+        """
+        target_points = []
+        for target in targets:
+            target_data = target.attachment_cache.setdefault(('landmark', str(points.device), str(points.dtype)), {})
+            if 'points' not in target_data:
+                target_data['points'] = utilities.move_data(target.get_points(), dtype=points.dtype,
+                                                            device=points.device)
+            target_points.append(target_data['points'])
+        target_points = torch.stack(target_points)
+        assert points.device == target_points.device, 'tensors must be on the same device'
+        return torch.sum((points.contiguous().view(len(targets), -1) - target_points.view(len(targets), -1)) ** 2, 1)
+
     ####################################################################################################################
     ### Private methods:
     ####################################################################################################################
 
     @staticmethod
-    def __get_source_and_target_centers_and_normals(points, source, target, device=None):
+    def __get_source_centers_and_normals(points, source, device=None):
         if device is None:
             device = points.device
 
@@ -184,12 +324,64 @@ class MultiObjectAttachment:
                                                 tensor_scalar_type=utilities.get_torch_scalar_type(dtype=dtype),
                                                 tensor_integer_type=utilities.get_torch_integer_type(dtype=dtype),
                                                 device=device)
-        c2, n2 = target.get_centers_and_normals(tensor_scalar_type=utilities.get_torch_scalar_type(dtype=dtype),
-                                                tensor_integer_type=utilities.get_torch_integer_type(dtype=dtype),
-                                                device=device)
 
-        assert c1.device == n1.device == c2.device == n2.device, 'all tensors must be on the same device, c1.device=' + str(c1.device) \
-                                                                 + ', n1.device=' + str(n1.device)\
-                                                                 + ', c2.device=' + str(c2.device)\
-                                                                 + ', n2.device=' + str(n2.device)
-        return c1, n1, c2, n2
+        assert c1.device == n1.device, 'all tensors must be on the same device, c1.device=' + str(c1.device) \
+                                       + ', n1.device=' + str(n1.device)
+        return c1, n1
+
+    @staticmethod
+    def __get_target_data(points, target, kernel, attachment_type, device=None):
+        """
+        Returns the dictionary of the target data that does not depend on the source points, i.e. the target centers
+        and normals, and the quantities lazily added by the distance functions (e.g. the target self scalar product).
+        It is cached on the target for the given attachment, kernel, device and dtype, and is only computed once as
+        long as the target is not modified.
+        """
+        if device is None:
+            device = points.device
+
+        dtype = str(points.dtype)
+
+        key = (attachment_type, kernel.kernel_type, kernel.kernel_width, str(torch.device(device)), dtype)
+        if key not in target.attachment_cache:
+            c2, n2 = target.get_centers_and_normals(tensor_scalar_type=utilities.get_torch_scalar_type(dtype=dtype),
+                                                    tensor_integer_type=utilities.get_torch_integer_type(dtype=dtype),
+                                                    device=device)
+            assert c2.device == n2.device, 'all tensors must be on the same device, c2.device=' + str(c2.device) \
+                                           + ', n2.device=' + str(n2.device)
+            target.attachment_cache[key] = {'centers': c2, 'normals': n2}
+
+        return target.attachment_cache[key]
+
+    @staticmethod
+    def __get_batched_target_data(points, targets, kernel, attachment_type, keys, scalar_products, device=None):
+        """
+        Returns the given cached quantities of all the targets, padded with zeros to the size of the largest target
+        and stacked, followed by the stacked target self scalar products. The scalar_products function is called with
+        each of the given quantities twice, e.g. scalar_products(c, c, n, n) for keys=['centers', 'normals'].
+        """
+        targets_data = [MultiObjectAttachment.__get_target_data(points, target, kernel, attachment_type, device=device)
+                        for target in targets]
+
+        for target_data in targets_data:
+            if 'norm' not in target_data:
+                target_data['norm'] = scalar_products(
+                    *[target_data[key].unsqueeze(0) for key in keys for _ in range(2)])[0]
+
+        stacked = [MultiObjectAttachment.__pad_and_stack([target_data[key] for target_data in targets_data])
+                   for key in keys]
+        return stacked + [torch.stack([target_data['norm'] for target_data in targets_data])]
+
+    @staticmethod
+    def __pad_and_stack(tensors):
+        """
+        Stacks tensors that only differ by their first dimension, padding them with zeros.
+        """
+        size = max(t.size(0) for t in tensors)
+        if all(t.size(0) == size for t in tensors):
+            return torch.stack(tensors)
+
+        res = tensors[0].new_zeros((len(tensors), size) + tuple(tensors[0].size()[1:]))
+        for k, t in enumerate(tensors):
+            res[k, :t.size(0)] = t
+        return res
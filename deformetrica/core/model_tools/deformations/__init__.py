@@ -1,4 +1,6 @@
 
+from .abstract_exponential import AbstractExponential
 from .exponential import Exponential
+from .batched_exponential import BatchedExponential
 from .geodesic import Geodesic
 from .spatiotemporal_reference_frame import SpatiotemporalReferenceFrame
@@ -0,0 +1,299 @@
+import warnings
+from abc import ABC, abstractmethod
+import torch
+
+from ....core import default
+from ....support import utilities
+from ....support import kernels as kernel_factory
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AbstractExponential(ABC):
+    """
+    Common state of the control-point-based LDDMM exponentials: initial control points, momenta and template points,
+    their trajectories and the update logic. Subclasses implement shoot and flow.
+    The integration steps work on single trajectories, with control points of size (number_of_control_points,
+    dimension), as well as on stacked ones, of size (number_of_trajectories, number_of_control_points, dimension):
+    the batched kernel operations are then used.
+
+    """
+
+    ####################################################################################################################
+    ### Constructor:
+    ####################################################################################################################
+
+    def __init__(self, dense_mode=default.dense_mode,
+                 kernel=default.deformation_kernel,
+                 shoot_kernel_type=None,
+                 number_of_time_points=None,
+                 initial_control_points=None, control_points_t=None,
+                 initial_momenta=None, momenta_t=None,
+                 initial_template_points=None, template_points_t=None,
+                 shoot_is_modified=True, flow_is_modified=True, use_rk2_for_shoot=False, use_rk2_for_flow=False,
+                 use_grid_image_flow=default.use_grid_image_flow):
+
+        self.dense_mode = dense_mode
+        self.kernel = kernel
+
+        if shoot_kernel_type is not None:
+            self.shoot_kernel = kernel_factory.factory(shoot_kernel_type, gpu_mode=kernel.gpu_mode, kernel_width=kernel.kernel_width)
+        else:
+            self.shoot_kernel = self.kernel
+
+        # logger.debug(hex(id(self)) + ' using kernel: ' + str(self.kernel))
+        # logger.debug(hex(id(self)) + ' using shoot_kernel: ' + str(self.shoot_kernel))
+
+        self.number_of_time_points = number_of_time_points
+        # Initial position of control points
+        self.initial_control_points = initial_control_points
+        # Control points trajectory
+        self.control_points_t = control_points_t
+        # Initial momenta
+        self.initial_momenta = initial_momenta
+        # Momenta trajectory
+        self.momenta_t = momenta_t
+        # Initial template points
+        self.initial_template_points = initial_template_points
+        # Trajectory of the whole vertices of landmark type at different time steps.
+        self.template_points_t = template_points_t
+        # If the cp or mom have been modified:
+        self.shoot_is_modified = shoot_is_modified
+        # If the template points has been modified
+        self.flow_is_modified = flow_is_modified
+        # Wether to use a RK2 or a simple euler for shooting or flowing respectively.
+        self.use_rk2_for_shoot = use_rk2_for_shoot
+        self.use_rk2_for_flow = use_rk2_for_flow
+        # Whether the velocity fields of the image flows are evaluated on the image grid, see _compute_image_velocity_field.
+        self.use_grid_image_flow = use_grid_image_flow
+
+    def move_data_to_(self, device):
+        if self.initial_control_points is not None:
+            self.initial_control_points = utilities.move_data(self.initial_control_points, device)
+        if self.initial_momenta is not None:
+            self.initial_momenta = utilities.move_data(self.initial_momenta, device)
+
+        if self.initial_template_points is not None:
+            self.initial_template_points = {key: utilities.move_data(value, device) for key, value in
+                                            self.initial_template_points.items()}
+
+    ####################################################################################################################
+    ### Encapsulation methods:
+    ####################################################################################################################
+
+    def set_use_rk2_for_shoot(self, flag):
+        self.shoot_is_modified = True
+        self.use_rk2_for_shoot = flag
+
+    def set_use_rk2_for_flow(self, flag):
+        self.flow_is_modified = True
+        self.use_rk2_for_flow = flag
+
+    def get_kernel_type(self):
+        return self.kernel.kernel_type
+
+    def get_kernel_width(self):
+        return self.kernel.kernel_width
+
+    def set_kernel(self, kernel):
+        # TODO which kernel to set ?
+        self.kernel = kernel
+
+    def set_initial_template_points(self, td):
+        self.initial_template_points = td
+        self.flow_is_modified = True
+
+    def get_initial_template_points(self):
+        return self.initial_template_points
+
+    def set_initial_control_points(self, cps):
+        self.shoot_is_modified = True
+        self.initial_control_points = cps
+
+    def get_initial_control_points(self):
+        return self.initial_control_points
+
+    def set_initial_momenta(self, mom):
+        self.shoot_is_modified = True
+        self.initial_momenta = mom
+
+    def get_initial_momenta(self):
+        return self.initial_momenta
+
+    def get_template_points(self, time_index=None):
+        """
+        Returns the position of the landmark points, at the given time_index in the Trajectory
+        """
+        if self.flow_is_modified:
+            msg = "You tried to get some template points, but the flow was modified. " \
+                  "The exponential should be updated before."
+            warnings.warn(msg)
+        if time_index is None:
+            return {key: self.template_points_t[key][-1] for key in self.initial_template_points.keys()}
+        return {key: self.template_points_t[key][time_index] for key in self.initial_template_points.keys()}
+
+    @abstractmethod
+    def get_norm_squared(self):
+        raise NotImplementedError
+
+    ####################################################################################################################
+    ### Main methods:
+    ####################################################################################################################
+
+    def update(self):
+        """
+        Update the state of the object, depending on what's needed.
+        This is the only clean way to call shoot or flow on the deformation.
+        """
+        assert self.number_of_time_points > 0
+        if self.shoot_is_modified:
+            self.shoot()
+            if self.initial_template_points is not None:
+                self.flow()
+            elif not self.dense_mode:
+                msg = "In exponential update, I am not flowing because I don't have any template points to flow"
+                logger.warning(msg)
+
+        if self.flow_is_modified:
+            if self.initial_template_points is not None:
+                self.flow()
+            elif not self.dense_mode:
+                msg = "In exponential update, I am not flowing because I don't have any template points to flow"
+                logger.warning(msg)
+
+    @abstractmethod
+    def shoot(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def flow(self):
+        raise NotImplementedError
+
+    ####################################################################################################################
+    ### Utility methods:
+    ####################################################################################################################
+
+    @staticmethod
+    def _convolve(kernel, x, cp, mom):
+        """
+        kernel convolution of mom carried by cp at the points x, batched if the tensors are stacked.
+        """
+        if cp.dim() == 3:
+            return kernel.batched_convolve(x, cp, mom)
+        return kernel.convolve(x, cp, mom)
+
+    @staticmethod
+    def _convolve_and_gradient(kernel, cp, mom):
+        """
+        velocity and momenta derivative of the geodesic equation, batched if the tensors are stacked.
+        """
+        if cp.dim() == 3:
+            return kernel.batched_convolve_and_gradient(cp, mom)
+        return kernel.convolve_and_gradient(cp, mom)
+
+    def _compute_image_velocity_field(self, image_points, cp, mom):
+        """
+        velocity field of mom carried by cp at the image points, of size (n_1, ..., n_D, D), or stacked along with the
+        control points. The grid convolution of the kernel is used if use_grid_image_flow is on.
+        """
+        if cp.dim() == 3:
+            if self.use_grid_image_flow:
+                return torch.stack([self.kernel.grid_convolve(image_points_s, cp_s, mom_s)
+                                    for image_points_s, cp_s, mom_s in zip(image_points, cp, mom)])
+            return self.kernel.batched_convolve(image_points.contiguous().view(cp.size(0), -1, cp.size(-1)),
+                                                cp, mom).view(image_points.size())
+        if self.use_grid_image_flow:
+            return self.kernel.grid_convolve(image_points, cp, mom)
+        return self.kernel.convolve(image_points.contiguous().view(-1, cp.size(-1)), cp, mom).view(image_points.size())
+
+    @staticmethod
+    def _euler_step(kernel, cp, mom, h):
+        """
+        simple euler step of length h, with cp and mom. It always returns mom.
+        """
+        assert cp.device == mom.device, 'tensors must be on the same device, cp.device=' + str(
+            cp.device) + ', mom.device=' + str(mom.device)
+        velocity, d_mom = AbstractExponential._convolve_and_gradient(kernel, cp, mom)
+        return cp + h * velocity, mom - h * d_mom
+
+    @staticmethod
+    def _rk2_step(kernel, cp, mom, h, return_mom=True):
+        """
+        perform a single mid-point rk2 step on the geodesic equation with initial cp and mom.
+        also used in parallel transport.
+        return_mom: bool to know if the mom at time t+h is to be computed and returned
+        """
+        assert cp.device == mom.device, 'tensors must be on the same device, cp.device=' + str(
+            cp.device) + ', mom.device=' + str(mom.device)
+
+        velocity, d_mom = AbstractExponential._convolve_and_gradient(kernel, cp, mom)
+        mid_cp = cp + h / 2. * velocity
+        mid_mom = mom - h / 2. * d_mom
+        if return_mom:
+            mid_velocity, mid_d_mom = AbstractExponential._convolve_and_gradient(kernel, mid_cp, mid_mom)
+            return cp + h * mid_velocity, mom - h * mid_d_mom
+        else:
+            return cp + h * AbstractExponential._convolve(kernel, mid_cp, mid_cp, mid_mom)
+
+    # TODO. Wrap pytorch of an efficient C code ? Use keops ? Called ApplyH in PyCa. Check Numba as well.
+    # @jit(parallel=True)
+    @staticmethod
+    def _compute_image_explicit_euler_step_at_order_1(Y, vf):
+        assert Y.device == vf.device, 'tensors must be on the same device, Y.device=' + str(
+            Y.device) + ', vf.device=' + str(vf.device)
+
+        dY = torch.zeros(Y.shape, dtype=vf.dtype, device=vf.device)
+        dimension = len(Y.shape) - 1
+
+        if dimension == 2:
+            ni, nj = Y.shape[:2]
+
+            # Center.
+            dY[1:ni - 1, :] = dY[1:ni - 1, :] + 0.5 * vf[1:ni - 1, :, 0].view(ni - 2, nj, 1).expand(ni - 2, nj, 2) * (
+                    Y[2:ni, :] - Y[0:ni - 2, :])
+            dY[:, 1:nj - 1] = dY[:, 1:nj - 1] + 0.5 * vf[:, 1:nj - 1, 1].view(ni, nj - 2, 1).expand(ni, nj - 2, 2) * (
+                    Y[:, 2:nj] - Y[:, 0:nj - 2])
+
+            # Borders.
+            dY[0, :] = dY[0, :] + vf[0, :, 0].view(nj, 1).expand(nj, 2) * (Y[1, :] - Y[0, :])
+            dY[ni - 1, :] = dY[ni - 1, :] + vf[ni - 1, :, 0].view(nj, 1).expand(nj, 2) * (Y[ni - 1, :] - Y[ni - 2, :])
+
+            dY[:, 0] = dY[:, 0] + vf[:, 0, 1].view(ni, 1).expand(ni, 2) * (Y[:, 1] - Y[:, 0])
+            dY[:, nj - 1] = dY[:, nj - 1] + vf[:, nj - 1, 1].view(ni, 1).expand(ni, 2) * (Y[:, nj - 1] - Y[:, nj - 2])
+
+        elif dimension == 3:
+            ni, nj, nk = Y.shape[:3]
+
+            # Center.
+            dY[1:ni - 1, :, :] = dY[1:ni - 1, :, :] + 0.5 * vf[1:ni - 1, :, :, 0].view(ni - 2, nj, nk, 1).expand(ni - 2,
+                                                                                                                 nj, nk,
+                                                                                                                 3) * (
+                                         Y[2:ni, :, :] - Y[0:ni - 2, :, :])
+            dY[:, 1:nj - 1, :] = dY[:, 1:nj - 1, :] + 0.5 * vf[:, 1:nj - 1, :, 1].view(ni, nj - 2, nk, 1).expand(ni,
+                                                                                                                 nj - 2,
+                                                                                                                 nk,
+                                                                                                                 3) * (
+                                         Y[:, 2:nj, :] - Y[:, 0:nj - 2, :])
+            dY[:, :, 1:nk - 1] = dY[:, :, 1:nk - 1] + 0.5 * vf[:, :, 1:nk - 1, 2].view(ni, nj, nk - 2, 1).expand(ni, nj,
+                                                                                                                 nk - 2,
+                                                                                                                 3) * (
+                                         Y[:, :, 2:nk] - Y[:, :, 0:nk - 2])
+
+            # Borders.
+            dY[0, :, :] = dY[0, :, :] + vf[0, :, :, 0].view(nj, nk, 1).expand(nj, nk, 3) * (Y[1, :, :] - Y[0, :, :])
+            dY[ni - 1, :, :] = dY[ni - 1, :, :] + vf[ni - 1, :, :, 0].view(nj, nk, 1).expand(nj, nk, 3) * (
+                    Y[ni - 1, :, :] - Y[ni - 2, :, :])
+
+            dY[:, 0, :] = dY[:, 0, :] + vf[:, 0, :, 1].view(ni, nk, 1).expand(ni, nk, 3) * (Y[:, 1, :] - Y[:, 0, :])
+            dY[:, nj - 1, :] = dY[:, nj - 1, :] + vf[:, nj - 1, :, 1].view(ni, nk, 1).expand(ni, nk, 3) * (
+                    Y[:, nj - 1, :] - Y[:, nj - 2, :])
+
+            dY[:, :, 0] = dY[:, :, 0] + vf[:, :, 0, 2].view(ni, nj, 1).expand(ni, nj, 3) * (Y[:, :, 1] - Y[:, :, 0])
+            dY[:, :, nk - 1] = dY[:, :, nk - 1] + vf[:, :, nk - 1, 2].view(ni, nj, 1).expand(ni, nj, 3) * (
+                    Y[:, :, nk - 1] - Y[:, :, nk - 2])
+
+        else:
+            raise RuntimeError('Invalid dimension of the ambient space: %d' % dimension)
+
+        return dY
@@ -0,0 +1,146 @@
+import torch
+
+from ....core.model_tools.deformations.abstract_exponential import AbstractExponential
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class BatchedExponential(AbstractExponential):
+    """
+    Control-point-based LDDMM exponential, that shoots and flows the momenta of several subjects at once.
+    The initial control points and template points are shared by all subjects, while the initial momenta are stacked
+    in a tensor of size (number_of_subjects, number_of_control_points, dimension). All trajectories are stacked
+    accordingly, and the kernel operations are batched over the subjects.
+    The initial control points and template points may also be given per subject, stacked in the same way: this is
+    detected from the 3D size of the initial control points.
+
+    """
+
+    ####################################################################################################################
+    ### Encapsulation methods:
+    ####################################################################################################################
+
+    def get_number_of_subjects(self):
+        return self.initial_momenta.size(0)
+
+    def get_norm_squared(self):
+        """
+        Returns the sum over all subjects of the squared norms of the initial momenta.
+        """
+        return torch.sum(self.get_norms_squared())
+
+    def get_norms_squared(self):
+        """
+        Returns the squared norms of the initial momenta of each subject, as a tensor of size (number_of_subjects,).
+        """
+        control_points = self._expand(self.initial_control_points)
+        return torch.sum(self.initial_momenta * self.kernel.batched_convolve(
+            control_points, control_points, self.initial_momenta), (1, 2))
+
+    ####################################################################################################################
+    ### Main methods:
+    ####################################################################################################################
+
+    def shoot(self):
+        """
+        Computes the flow of momenta and control points, for all the subjects at once.
+        """
+        assert len(self.initial_control_points) > 0, "Control points not initialized in shooting"
+        assert len(self.initial_momenta) > 0, "Momenta not initialized in shooting"
+        assert self.initial_momenta.dim() == 3, "Initial momenta must be stacked in a 3D tensor for batched shooting"
+
+        # Integrate the Hamiltonian equations.
+        self.control_points_t = [self._expand(self.initial_control_points)]
+        self.momenta_t = [self.initial_momenta]
+
+        dt = 1.0 / float(self.number_of_time_points - 1)
+
+        for i in range(self.number_of_time_points - 1):
+            if self.use_rk2_for_shoot:
+                new_cp, new_mom = self._rk2_step(self.shoot_kernel, self.control_points_t[i], self.momenta_t[i], dt,
+                                                 return_mom=True)
+            else:
+                new_cp, new_mom = self._euler_step(self.shoot_kernel, self.control_points_t[i], self.momenta_t[i], dt)
+            self.control_points_t.append(new_cp)
+            self.momenta_t.append(new_mom)
+
+        # Correctly resets the attribute flag.
+        self.shoot_is_modified = False
+
+    def flow(self):
+        """
+        Flow the trajectories of the landmark and/or image points, for all the subjects at once.
+        """
+        assert not self.shoot_is_modified, "CP or momenta were modified and the shoot not computed, and now you are asking me to flow ?"
+        assert len(self.control_points_t) > 0, "Shoot before flow"
+        assert len(self.momenta_t) > 0, "Control points given but no momenta"
+
+        # Initialization.
+        dt = 1.0 / float(self.number_of_time_points - 1)
+        self.template_points_t = {}
+
+        # Special case of the dense mode.
+        if self.dense_mode:
+            assert 'image_points' not in self.initial_template_points.keys(), 'Dense mode not allowed with image data.'
+            self.template_points_t['landmark_points'] = self.control_points_t
+            self.flow_is_modified = False
+            return
+
+        # Flow landmarks points.
+        if 'landmark_points' in self.initial_template_points.keys():
+            landmark_points = [self._expand(self.initial_template_points['landmark_points'])]
+
+            for i in range(self.number_of_time_points - 1):
+                d_pos = self.kernel.batched_convolve(landmark_points[i], self.control_points_t[i], self.momenta_t[i])
+                landmark_points.append(landmark_points[i] + dt * d_pos)
+
+                if self.use_rk2_for_flow:
+                    # In this case improved euler (= Heun's method)
+                    # to save one computation of convolve gradient per iteration.
+                    if i < self.number_of_time_points - 2:
+                        landmark_points[-1] = landmark_points[i] + dt / 2 * \
+                                              (self.kernel.batched_convolve(landmark_points[i + 1],
+                                                                            self.control_points_t[i + 1],
+                                                                            self.momenta_t[i + 1]) + d_pos)
+                    else:
+                        final_cp, final_mom = self._rk2_step(self.kernel, self.control_points_t[-1], self.momenta_t[-1],
+                                                             dt, return_mom=True)
+                        landmark_points[-1] = landmark_points[i] + dt / 2 * (
+                                self.kernel.batched_convolve(landmark_points[i + 1], final_cp, final_mom) + d_pos)
+
+            self.template_points_t['landmark_points'] = landmark_points
+
+        # Flow image points.
+        if 'image_points' in self.initial_template_points.keys():
+            image_points = [self._expand(self.initial_template_points['image_points'])]
+
+            for i in range(self.number_of_time_points - 1):
+                vf = self._compute_image_velocity_field(image_points[0], self.control_points_t[i], self.momenta_t[i])
+                dY = torch.stack([self._compute_image_explicit_euler_step_at_order_1(Y_s, vf_s)
+                                  for Y_s, vf_s in zip(image_points[i], vf)])
+                image_points.append(image_points[i] - dt * dY)
+
+            if self.use_rk2_for_flow:
+                msg = 'RK2 not implemented to flow image points.'
+                logger.warning(msg)
+
+            self.template_points_t['image_points'] = image_points
+
+        assert len(self.template_points_t) > 0, 'That\'s unexpected'
+
+        # Correctly resets the attribute flag.
+        self.flow_is_modified = False
+
+    ####################################################################################################################
+    ### Utility methods:
+    ####################################################################################################################
+
+    def _expand(self, t):
+        """
+        Repeats the given shared tensor along a new first dimension, of size the number of subjects.
+        Per-subject initial points are returned as is.
+        """
+        if self.initial_control_points.dim() == 3:
+            return t
+        return t.unsqueeze(0).expand(self.get_number_of_subjects(), *t.size())
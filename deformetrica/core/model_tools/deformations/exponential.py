@@ -1,17 +1,32 @@
-import warnings
+from collections import OrderedDict
 from copy import deepcopy
 import torch
 
 from ....core import default
+from ....core.model_tools.deformations.abstract_exponential import AbstractExponential
 from ....in_out.array_readers_and_writers import *
-from ....support import utilities
-from ....support import kernels as kernel_factory
 
 import logging
 logger = logging.getLogger(__name__)
 
+# torch.linalg.cholesky_ex is only available from torch 1.9 on.
+_has_cholesky_ex = hasattr(getattr(torch, 'linalg', None), 'cholesky_ex')
 
-class Exponential:
+
+def _cholesky(matrix):
+    """
+    Lower Cholesky factor of the given matrix, or None if it is not (numerically) positive definite.
+    """
+    if _has_cholesky_ex:
+        factor, info = torch.linalg.cholesky_ex(matrix)
+        return None if info.item() else factor
+    try:
+        return torch.cholesky(matrix)
+    except RuntimeError:
+        return None
+
+
+class Exponential(AbstractExponential):
     """
     Control-point-based LDDMM exponential, that transforms the template objects according to initial control points
     and momenta parameters.
@@ -31,53 +46,27 @@ class Exponential:
                  initial_control_points=None, control_points_t=None,
                  initial_momenta=None, momenta_t=None,
                  initial_template_points=None, template_points_t=None,
-                 shoot_is_modified=True, flow_is_modified=True, use_rk2_for_shoot=False, use_rk2_for_flow=False):
-
-        self.dense_mode = dense_mode
-        self.kernel = kernel
-
-        if shoot_kernel_type is not None:
-            self.shoot_kernel = kernel_factory.factory(shoot_kernel_type, gpu_mode=kernel.gpu_mode, kernel_width=kernel.kernel_width)
-        else:
-            self.shoot_kernel = self.kernel
-
-        # logger.debug(hex(id(self)) + ' using kernel: ' + str(self.kernel))
-        # logger.debug(hex(id(self)) + ' using shoot_kernel: ' + str(self.shoot_kernel))
-
-        self.number_of_time_points = number_of_time_points
-        # Initial position of control points
-        self.initial_control_points = initial_control_points
-        # Control points trajectory
-        self.control_points_t = control_points_t
-        # Initial momenta
-        self.initial_momenta = initial_momenta
-        # Momenta trajectory
-        self.momenta_t = momenta_t
-        # Initial template points
-        self.initial_template_points = initial_template_points
-        # Trajectory of the whole vertices of landmark type at different time steps.
-        self.template_points_t = template_points_t
-        # If the cp or mom have been modified:
-        self.shoot_is_modified = shoot_is_modified
-        # If the template points has been modified
-        self.flow_is_modified = flow_is_modified
-        # Wether to use a RK2 or a simple euler for shooting or flowing respectively.
-        self.use_rk2_for_shoot = use_rk2_for_shoot
-        self.use_rk2_for_flow = use_rk2_for_flow
-        # Contains the inverse kernel matrices for the time points 1 to self.number_of_time_points
+                 shoot_is_modified=True, flow_is_modified=True, use_rk2_for_shoot=False, use_rk2_for_flow=False,
+                 adaptive_step_tolerance=default.adaptive_step_tolerance,
+                 use_grid_image_flow=default.use_grid_image_flow):
+
+        super().__init__(dense_mode, kernel, shoot_kernel_type, number_of_time_points,
+                         initial_control_points, control_points_t, initial_momenta, momenta_t,
+                         initial_template_points, template_points_t,
+                         shoot_is_modified, flow_is_modified, use_rk2_for_shoot, use_rk2_for_flow,
+                         use_grid_image_flow)
+
+        # If not None, the shoot and the landmark flow are integrated with adaptive time steps, see _integrate_adaptively.
+        self.adaptive_step_tolerance = adaptive_step_tolerance
+        # Landmark points trajectory computed along with the adaptive shoot, and statistics of the last adaptive shoot.
+        self.adaptive_landmark_points_t = None
+        self.step_statistics = None
+        # Contains the Cholesky factors of the kernel matrices for the time points 1 to self.number_of_time_points,
+        # shared by all the momenta transported along the current shoot, see _solve_cometric.
         # (ACHTUNG does not contain the initial matrix, it is not needed)
-        self.cometric_matrices = {}
-        # self.cholesky_matrices = {}
-
-    def move_data_to_(self, device):
-        if self.initial_control_points is not None:
-            self.initial_control_points = utilities.move_data(self.initial_control_points, device)
-        if self.initial_momenta is not None:
-            self.initial_momenta = utilities.move_data(self.initial_momenta, device)
-
-        if self.initial_template_points is not None:
-            self.initial_template_points = {key: utilities.move_data(value, device) for key, value in
-                                            self.initial_template_points.items()}
+        self.cometric_factors = OrderedDict()
+        # Inverse kernel matrices, for the time points whose kernel matrix could not be factorized.
+        self.cometric_inverses = {}
 
     def light_copy(self):
         light_copy = Exponential(self.dense_mode,
@@ -87,54 +76,17 @@ class Exponential:
                                  self.initial_momenta, self.momenta_t,
                                  self.initial_template_points, self.template_points_t,
                                  self.shoot_is_modified, self.flow_is_modified,
-                                 self.use_rk2_for_shoot, self.use_rk2_for_flow)
+                                 self.use_rk2_for_shoot, self.use_rk2_for_flow, self.adaptive_step_tolerance,
+                                 self.use_grid_image_flow)
         return light_copy
 
     ####################################################################################################################
     ### Encapsulation methods:
     ####################################################################################################################
 
-    def set_use_rk2_for_shoot(self, flag):
-        self.shoot_is_modified = True
-        self.use_rk2_for_shoot = flag
-
-    def set_use_rk2_for_flow(self, flag):
-        self.flow_is_modified = True
-        self.use_rk2_for_flow = flag
-
-    def get_kernel_type(self):
-        return self.kernel.kernel_type
-
-    def get_kernel_width(self):
-        return self.kernel.kernel_width
-
-    def set_kernel(self, kernel):
-        # TODO which kernel to set ?
-        self.kernel = kernel
-
     def set_initial_template_points(self, td):
-        self.initial_template_points = td
-        self.flow_is_modified = True
-
-    def get_initial_template_points(self):
-        return self.initial_template_points
-
-    def set_initial_control_points(self, cps):
-        self.shoot_is_modified = True
-        self.initial_control_points = cps
-
-    def get_initial_control_points(self):
-        return self.initial_control_points
-
-    def get_initial_momenta(self):
-        return self.initial_momenta
-
-    def set_initial_momenta(self, mom):
-        self.shoot_is_modified = True
-        self.initial_momenta = mom
-
-    def get_initial_momenta(self):
-        return self.initial_momenta
+        super().set_initial_template_points(td)
+        self.adaptive_landmark_points_t = None
 
     def scalar_product(self, cp, mom1, mom2):
         """
@@ -142,47 +94,25 @@ class Exponential:
         """
         return torch.sum(mom1 * self.kernel.convolve(cp, cp, mom2))
 
-    def get_template_points(self, time_index=None):
-        """
-        Returns the position of the landmark points, at the given time_index in the Trajectory
-        """
-        if self.flow_is_modified:
-            msg = "You tried to get some template points, but the flow was modified. " \
-                  "The exponential should be updated before."
-            warnings.warn(msg)
-        if time_index is None:
-            return {key: self.template_points_t[key][-1] for key in self.initial_template_points.keys()}
-        return {key: self.template_points_t[key][time_index] for key in self.initial_template_points.keys()}
-
     def get_norm_squared(self):
         return self.scalar_product(self.initial_control_points, self.initial_momenta, self.initial_momenta)
 
+    def get_step_statistics(self):
+        """
+        Returns the numbers of accepted steps, rejected steps and right-hand side evaluations of the last adaptive
+        shoot, or None if the time steps are fixed.
+        """
+        return self.step_statistics
+
     ####################################################################################################################
     ### Main methods:
     ####################################################################################################################
 
     def update(self):
-        """
-        Update the state of the object, depending on what's needed.
-        This is the only clean way to call shoot or flow on the deformation.
-        """
-        assert self.number_of_time_points > 0
         if self.shoot_is_modified:
-            self.cometric_matrices.clear()
-            # self.cholesky_matrices.clear()
-            self.shoot()
-            if self.initial_template_points is not None:
-                self.flow()
-            elif not self.dense_mode:
-                msg = "In exponential update, I am not flowing because I don't have any template points to flow"
-                logger.warning(msg)
-
-        if self.flow_is_modified:
-            if self.initial_template_points is not None:
-                self.flow()
-            elif not self.dense_mode:
-                msg = "In exponential update, I am not flowing because I don't have any template points to flow"
-                logger.warning(msg)
+            self.cometric_factors.clear()
+            self.cometric_inverses.clear()
+        super().update()
 
     def shoot(self):
         """
@@ -192,6 +122,11 @@ class Exponential:
         assert len(self.initial_control_points) > 0, "Control points not initialized in shooting"
         assert len(self.initial_momenta) > 0, "Momenta not initialized in shooting"
 
+        if self.adaptive_step_tolerance is not None:
+            self._integrate_adaptively()
+            self.shoot_is_modified = False
+            return
+
         # Integrate the Hamiltonian equations.
         self.control_points_t = [self.initial_control_points]
         self.momenta_t = [self.initial_momenta]
@@ -235,8 +170,13 @@ class Exponential:
             self.flow_is_modified = False
             return
 
-        # Flow landmarks points.
-        if 'landmark_points' in self.initial_template_points.keys():
+        # Flow landmarks points, along with the control points and momenta in the adaptive case.
+        if 'landmark_points' in self.initial_template_points.keys() and self.adaptive_step_tolerance is not None:
+            if self.adaptive_landmark_points_t is None:
+                self._integrate_adaptively()
+            self.template_points_t['landmark_points'] = self.adaptive_landmark_points_t
+
+        elif 'landmark_points' in self.initial_template_points.keys():
             landmark_points = [self.initial_template_points['landmark_points']]
 
             for i in range(self.number_of_time_points - 1):
@@ -262,12 +202,8 @@ class Exponential:
         if 'image_points' in self.initial_template_points.keys():
             image_points = [self.initial_template_points['image_points']]
 
-            dimension = self.initial_control_points.size(1)
-            image_shape = image_points[0].size()
-
             for i in range(self.number_of_time_points - 1):
-                vf = self.kernel.convolve(image_points[0].contiguous().view(-1, dimension), self.control_points_t[i],
-                                          self.momenta_t[i]).view(image_shape)
+                vf = self._compute_image_velocity_field(image_points[0], self.control_points_t[i], self.momenta_t[i])
                 dY = self._compute_image_explicit_euler_step_at_order_1(image_points[i], vf)
                 image_points.append(image_points[i] - dt * dY)
 
@@ -290,19 +226,39 @@ class Exponential:
         if is_orthogonal is on, then the momenta to transport must be orthogonal to the momenta of the geodesic.
         Note: uses shoot kernel
         """
+        return [elt[0] for elt in self.parallel_transport_many(momenta_to_transport.unsqueeze(0), initial_time_point,
+                                                               is_orthogonal)]
+
+    def parallel_transport_many(self, momenta_block, initial_time_point=0, is_orthogonal=False):
+        """
+        Parallel transport of several momenta at once along the exponential, see parallel_transport.
+        momenta_block is a tensor of size (number_of_vectors, number_of_control_points, dimension). The perturbed
+        geodesics of all vectors are shot together with batched kernel operations, and the cometric solves of each
+        time step are shared.
+        Returns the list of the transported blocks, of the same size as momenta_block.
+        Note: uses shoot kernel
+        """
 
         # Sanity checks ------------------------------------------------------------------------------------------------
         assert not self.shoot_is_modified, "You want to parallel transport but the shoot was modified, please update."
         assert self.use_rk2_for_shoot, "The shoot integration must be done with a second order numerical scheme in order to use parallel transport."
-        assert (momenta_to_transport.size() == self.initial_momenta.size())
+        assert (momenta_block.size()[1:] == self.initial_momenta.size())
+
+        number_of_vectors = momenta_block.size(0)
+        number_of_time_points = self.number_of_time_points - initial_time_point
 
         # Special cases, where the transport is simply the identity ----------------------------------------------------
         #       1) Nearly zero initial momenta yield no motion.
-        #       2) Nearly zero momenta to transport.
-        if (torch.norm(self.initial_momenta).detach().cpu().numpy() < 1e-6 or
-                torch.norm(momenta_to_transport).detach().cpu().numpy() < 1e-6):
-            parallel_transport_t = [momenta_to_transport] * (self.number_of_time_points - initial_time_point)
-            return parallel_transport_t
+        #       2) Nearly zero momenta to transport, which are transported apart from the others.
+        if number_of_vectors == 0 or torch.norm(self.initial_momenta).detach().cpu().numpy() < 1e-6:
+            return [momenta_block] * number_of_time_points
+
+        norms = torch.norm(momenta_block.view(number_of_vectors, -1), dim=1).detach().cpu().numpy()
+        if np.any(norms < 1e-6):
+            indices = torch.tensor(np.where(norms >= 1e-6)[0], dtype=torch.long, device=momenta_block.device)
+            parallel_transport_t = self.parallel_transport_many(momenta_block[indices], initial_time_point,
+                                                                is_orthogonal)
+            return [momenta_block.index_put((indices,), elt) for elt in parallel_transport_t]
 
         # Step sizes ---------------------------------------------------------------------------------------------------
         h = 1. / (self.number_of_time_points - 1.)
@@ -313,83 +269,67 @@ class Exponential:
 
         # Optional initial orthogonalization ---------------------------------------------------------------------------
         norm_squared = self.get_norm_squared()
+        sp = self._scalar_products(self.control_points_t[initial_time_point], momenta_block,
+                                   self.momenta_t[initial_time_point]) / norm_squared
         if not is_orthogonal:
-            sp = self.scalar_product(self.control_points_t[initial_time_point], momenta_to_transport,
-                                     self.momenta_t[initial_time_point]) / norm_squared
-            momenta_to_transport_orthogonal = momenta_to_transport - sp * self.momenta_t[initial_time_point]
-            parallel_transport_t = [momenta_to_transport_orthogonal]
+            parallel_transport_t = [momenta_block - sp * self.momenta_t[initial_time_point]]
         else:
-            sp = (self.scalar_product(
-                self.control_points_t[initial_time_point], momenta_to_transport,
-                self.momenta_t[initial_time_point]) / norm_squared).detach().cpu().numpy()
-            assert abs(sp) < 1e-2, \
+            worst_sp = torch.max(torch.abs(sp)).detach().cpu().numpy()
+            assert worst_sp < 1e-2, \
                 'Error: the momenta to transport is not orthogonal to the driving momenta, ' \
-                'but the is_orthogonal flag is active. sp = %.3E' % sp
-            parallel_transport_t = [momenta_to_transport]
+                'but the is_orthogonal flag is active. sp = %.3E' % worst_sp
+            parallel_transport_t = [momenta_block]
 
-        # Then, store the initial norm of this orthogonal momenta ------------------------------------------------------
-        initial_norm_squared = self.scalar_product(self.control_points_t[initial_time_point], parallel_transport_t[0],
-                                                   parallel_transport_t[0])
+        # Then, store the initial norms of these orthogonal momenta ----------------------------------------------------
+        initial_norms_squared = self._norms_squared(self.control_points_t[initial_time_point], parallel_transport_t[0])
 
         for i in range(initial_time_point, self.number_of_time_points - 1):
-            # Shoot the two perturbed geodesics ------------------------------------------------------------------------
-            cp_eps_pos = self._rk2_step(self.shoot_kernel, self.control_points_t[i],
-                                        self.momenta_t[i] + epsilon * parallel_transport_t[-1], h, return_mom=False)
-            cp_eps_neg = self._rk2_step(self.shoot_kernel, self.control_points_t[i],
-                                        self.momenta_t[i] - epsilon * parallel_transport_t[-1], h, return_mom=False)
+            # Shoot the 2 * number_of_vectors perturbed geodesics at once ----------------------------------------------
+            perturbations = epsilon * parallel_transport_t[-1]
+            cp_eps = self._rk2_step(
+                self.shoot_kernel,
+                self.control_points_t[i].unsqueeze(0).expand(2 * number_of_vectors, *self.control_points_t[i].size()),
+                torch.cat([self.momenta_t[i] + perturbations, self.momenta_t[i] - perturbations]), h,
+                return_mom=False)
+            cp_eps_pos, cp_eps_neg = cp_eps[:number_of_vectors], cp_eps[number_of_vectors:]
 
             # Compute J/h ----------------------------------------------------------------------------------------------
             approx_velocity = (cp_eps_pos - cp_eps_neg) / (2 * epsilon * h)
 
-            # We need to find the cotangent space version of this vector -----------------------------------------------
-            # If we don't have already the cometric matrix, we compute and store it.
-            # TODO: add optional flag for not saving this if it's too large.
-            # OPTIM: keep an eye on https://github.com/pytorch/pytorch/issues/4669
-            if i not in self.cometric_matrices:
-                kernel_matrix = self.shoot_kernel.get_kernel_matrix(self.control_points_t[i + 1])
-                # self.kernel_matrices[i] = kernel_matrix
-                # self.cholesky_matrices[i] = torch.potrf(kernel_matrix.t().matmul(kernel_matrix), upper=False)
-                # self.cholesky_matrices[i] = torch.cholesky(kernel_matrix, upper=False)
-                # self.cholesky_matrices[i] = torch.potrf(kernel_matrix, upper=True)
-                self.cometric_matrices[i] = torch.inverse(kernel_matrix)
-                # self.cometric_matrices[i] = torch.inverse(kernel_matrix.cuda()).cpu()
-
-            # Solve the linear system.
-            # rhs = approx_velocity.matmul(self.kernel_matrices[i])
-            # z = torch.trtrs(rhs.t(), self.cholesky_matrices[i], transpose=False, upper=False)[0]
-            # approx_momenta = torch.trtrs(z, self.cholesky_matrices[i], transpose=True, upper=False)[0]
-            # approx_momenta = torch.potrs(approx_velocity, self.cholesky_matrices[i], upper=True)
-            approx_momenta = torch.mm(self.cometric_matrices[i], approx_velocity)
-
-            # We get rid of the component of this momenta along the geodesic velocity:
-            scalar_prod_with_velocity = self.scalar_product(self.control_points_t[i + 1], approx_momenta,
-                                                            self.momenta_t[i + 1]) / norm_squared
+            # We need to find the cotangent space version of these vectors, with a single solve ------------------------
+            number_of_control_points, dimension = approx_velocity.size()[1:]
+            approx_momenta = self._solve_cometric(
+                i, approx_velocity.permute(1, 0, 2).reshape(number_of_control_points, number_of_vectors * dimension))
+            approx_momenta = approx_momenta.view(number_of_control_points, number_of_vectors, dimension).permute(1, 0, 2)
 
+            # We get rid of the component of these momenta along the geodesic velocity:
+            scalar_prod_with_velocity = self._scalar_products(self.control_points_t[i + 1], approx_momenta,
+                                                              self.momenta_t[i + 1]) / norm_squared
             approx_momenta = approx_momenta - scalar_prod_with_velocity * self.momenta_t[i + 1]
 
             # Renormalization ------------------------------------------------------------------------------------------
-            approx_momenta_norm_squared = self.scalar_product(self.control_points_t[i + 1], approx_momenta,
-                                                              approx_momenta)
+            approx_momenta_norms_squared = self._norms_squared(self.control_points_t[i + 1], approx_momenta)
 
-            renormalization_factor = torch.sqrt(initial_norm_squared / approx_momenta_norm_squared)
-            renormalized_momenta = approx_momenta * renormalization_factor
+            renormalization_factors = torch.sqrt(initial_norms_squared / approx_momenta_norms_squared)
+            renormalized_momenta = approx_momenta * renormalization_factors.view(-1, 1, 1)
 
-            if abs(renormalization_factor.detach().cpu().numpy() - 1.) > 0.1:
+            renormalization_factor = renormalization_factors.detach().cpu().numpy()[
+                np.argmax(np.abs(renormalization_factors.detach().cpu().numpy() - 1.))]
+            if abs(renormalization_factor - 1.) > 0.1:
                 raise ValueError('Absurd required renormalization factor during parallel transport: %.4f. '
-                                 'Exception raised.' % renormalization_factor.detach().cpu().numpy())
-            elif abs(renormalization_factor.detach().cpu().numpy() - 1.) > abs(worst_renormalization_factor - 1.):
-                worst_renormalization_factor = renormalization_factor.detach().cpu().numpy()
+                                 'Exception raised.' % renormalization_factor)
+            elif abs(renormalization_factor - 1.) > abs(worst_renormalization_factor - 1.):
+                worst_renormalization_factor = renormalization_factor
 
             # Finalization ---------------------------------------------------------------------------------------------
-            parallel_transport_t.append(renormalized_momenta)
+            parallel_transport_t.append(renormalized_momenta.contiguous())
 
-        assert len(parallel_transport_t) == self.number_of_time_points - initial_time_point, \
-            "Oops, something went wrong."
+        assert len(parallel_transport_t) == number_of_time_points, "Oops, something went wrong."
 
         # We now need to add back the component along the velocity to the transported vectors.
         if not is_orthogonal:
-            parallel_transport_t = [parallel_transport_t[i] + sp * self.momenta_t[i]
-                                    for i in range(initial_time_point, self.number_of_time_points)]
+            parallel_transport_t = [parallel_transport_t[i] + sp * self.momenta_t[initial_time_point + i]
+                                    for i in range(number_of_time_points)]
 
         if abs(worst_renormalization_factor - 1.) > 0.05:
             msg = ("Watch out, a large renormalization factor %.4f is required during the parallel transport. "
@@ -398,6 +338,78 @@ class Exponential:
 
         return parallel_transport_t
 
+    def _scalar_products(self, cp, momenta_block, mom):
+        """
+        returns the scalar products 'momenta_block[s] K(cp) mom', as a tensor of size (number_of_vectors, 1, 1)
+        """
+        return torch.sum(momenta_block * self.kernel.convolve(cp, cp, mom), (1, 2)).view(-1, 1, 1)
+
+    def _norms_squared(self, cp, momenta_block):
+        """
+        returns the squared norms 'momenta_block[s] K(cp) momenta_block[s]', as a tensor of size (number_of_vectors,)
+        """
+        cp = cp.unsqueeze(0).expand(momenta_block.size(0), *cp.size())
+        return torch.sum(momenta_block * self.kernel.batched_convolve(cp, cp, momenta_block), (1, 2))
+
+    def _solve_cometric(self, i, velocity):
+        """
+        Solves K(q_{i+1}) p = v, where K is the shoot kernel matrix at the (i+1)-th control points, with its cached
+        Cholesky factor. Kernel matrices that cannot be factorized are inverted instead.
+        """
+        if i in self.cometric_inverses:
+            return torch.mm(self.cometric_inverses[i], velocity)
+
+        if i in self.cometric_factors:
+            factor = self.cometric_factors[i]
+        else:
+            kernel_matrix = self.shoot_kernel.get_kernel_matrix(self.control_points_t[i + 1])
+            factor = self._compute_cometric_factor(kernel_matrix)
+            if factor is None:
+                logger.warning('The kernel matrix is not positive definite, even with a diagonal jitter: its inverse '
+                               'is used instead. Control points may be too close to each other.')
+                self.cometric_inverses[i] = torch.inverse(kernel_matrix)
+                return torch.mm(self.cometric_inverses[i], velocity)
+            self._cache_cometric_factor(i, factor)
+
+        # The solves return column-major tensors.
+        return torch.cholesky_solve(velocity, factor).contiguous()
+
+    @staticmethod
+    def _compute_cometric_factor(kernel_matrix, max_attempts=6):
+        """
+        Lower Cholesky factor of the kernel matrix. Kernel matrices of close control points are numerically singular:
+        in this case, an increasing jitter (relative to the mean diagonal value) is added to the diagonal.
+        Returns None if the factorization still fails.
+        """
+        factor = _cholesky(kernel_matrix)
+        if factor is not None:
+            return factor
+
+        identity = torch.eye(kernel_matrix.size(0), dtype=kernel_matrix.dtype, device=kernel_matrix.device)
+        jitter = torch.finfo(kernel_matrix.dtype).eps * torch.mean(torch.diagonal(kernel_matrix)).detach()
+        for _ in range(max_attempts):
+            jitter = jitter * 10.
+            factor = _cholesky(kernel_matrix + jitter * identity)
+            if factor is not None:
+                logger.debug('Cometric Cholesky factorization required a diagonal jitter of %.2E.' % jitter)
+                return factor
+
+        return None
+
+    def _cache_cometric_factor(self, i, factor):
+        """
+        Stores the i-th cometric factor. If default.cometric_cache_memory is set, the oldest factors are discarded
+        (and recomputed when needed) to keep the cache under that many megabytes.
+        """
+        self.cometric_factors[i] = factor
+
+        if default.cometric_cache_memory is not None:
+            memory_limit = default.cometric_cache_memory * 1024 ** 2
+            memory = sum(elt.element_size() * elt.nelement() for elt in self.cometric_factors.values())
+            while memory > memory_limit and len(self.cometric_factors) > 1:
+                _, discarded = self.cometric_factors.popitem(last=False)
+                memory -= discarded.element_size() * discarded.nelement()
+
     ####################################################################################################################
     ### Extension methods:
     ####################################################################################################################
@@ -448,13 +460,10 @@ class Exponential:
 
             # Flow image points.
             if 'image_points' in self.initial_template_points.keys():
-                dimension = self.initial_control_points.size(1)
-                image_shape = self.initial_template_points['image_points'].size()
-
                 for ii in range(number_of_additional_time_points):
                     i = len(self.template_points_t['image_points']) - 1
-                    vf = self.kernel.convolve(self.initial_template_points['image_points'].contiguous().view(-1, dimension),
-                                              self.control_points_t[i], self.momenta_t[i]).view(image_shape)
+                    vf = self._compute_image_velocity_field(self.initial_template_points['image_points'],
+                                                            self.control_points_t[i], self.momenta_t[i])
                     dY = self._compute_image_explicit_euler_step_at_order_1(self.template_points_t['image_points'][i], vf)
                     self.template_points_t['image_points'].append(self.template_points_t['image_points'][i] - dt * dY)
 
@@ -473,95 +482,99 @@ class Exponential:
     ### Utility methods:
     ####################################################################################################################
 
-    @staticmethod
-    def _euler_step(kernel, cp, mom, h):
+    def _integrate_adaptively(self, max_step_increase=5., max_step_decrease=0.2, min_step=1e-6):
         """
-        simple euler step of length h, with cp and mom. It always returns mom.
+        Integrates the Hamiltonian equations, together with the landmark points if any, with the embedded
+        Bogacki-Shampine 3(2) pair. Each step is accepted if the estimated local error on the control points and
+        landmark positions is below adaptive_step_tolerance, and the next step size is chosen accordingly: easy
+        deformations take a few large steps, hard ones are refined.
+        The trajectories are then evaluated at the number_of_time_points regular time points by cubic Hermite
+        interpolation, and can be used as the fixed-step ones.
         """
-        assert cp.device == mom.device, 'tensors must be on the same device, cp.device=' + str(
-            cp.device) + ', mom.device=' + str(mom.device)
-        return cp + h * kernel.convolve(cp, cp, mom), \
-               mom - h * kernel.convolve_gradient(mom, cp)
+        assert len(self.initial_control_points) > 0, "Control points not initialized in shooting"
+        assert len(self.initial_momenta) > 0, "Momenta not initialized in shooting"
 
-    @staticmethod
-    def _rk2_step(kernel, cp, mom, h, return_mom=True):
+        state = [self.initial_control_points, self.initial_momenta]
+        with_landmarks = not self.dense_mode and self.initial_template_points is not None \
+                         and 'landmark_points' in self.initial_template_points.keys()
+        if with_landmarks:
+            state.append(self.initial_template_points['landmark_points'])
+        controlled = [0, 2] if with_landmarks else [0]
+
+        # Accepted steps, with the state and its derivative at each of their bounds.
+        times, states, derivatives = [0.], [state], [self._compute_adaptive_derivatives(state)]
+        statistics = {'accepted_steps': 0, 'rejected_steps': 0, 'function_evaluations': 1}
+
+        h = 1.0 / float(self.number_of_time_points - 1)
+        while times[-1] < 1.:
+            h = min(h, 1. - times[-1])
+            y, k1 = states[-1], derivatives[-1]
+            k2 = self._compute_adaptive_derivatives([a + h / 2. * b for a, b in zip(y, k1)])
+            k3 = self._compute_adaptive_derivatives([a + 3. * h / 4. * b for a, b in zip(y, k2)])
+            new_y = [a + h * (2. / 9. * b + 1. / 3. * c + 4. / 9. * d) for a, b, c, d in zip(y, k1, k2, k3)]
+            k4 = self._compute_adaptive_derivatives(new_y)
+            statistics['function_evaluations'] += 3
+
+            # Difference between the third and second order solutions.
+            error = max(float(torch.max(torch.abs(h * (- 5. / 72. * k1[i] + 1. / 12. * k2[i] + 1. / 9. * k3[i]
+                                                       - 1. / 8. * k4[i]))).detach().cpu().numpy())
+                        for i in controlled) / self.adaptive_step_tolerance
+
+            if error <= 1. or h <= min_step:
+                times.append(times[-1] + h if times[-1] + h < 1. - min_step else 1.)
+                states.append(new_y)
+                derivatives.append(k4)
+                statistics['accepted_steps'] += 1
+            else:
+                statistics['rejected_steps'] += 1
+
+            h *= min(max_step_increase, max(max_step_decrease, 0.9 * error ** (-1. / 3.))) if error > 0. \
+                else max_step_increase
+
+        # Dense output at the regular time points.
+        trajectories = self._interpolate_adaptive_steps(
+            times, states, derivatives, np.linspace(0., 1., self.number_of_time_points))
+        self.control_points_t, self.momenta_t = trajectories[0], trajectories[1]
+        self.adaptive_landmark_points_t = trajectories[2] if with_landmarks else None
+
+        self.step_statistics = statistics
+        logger.debug('Adaptive shoot: %d accepted and %d rejected steps, %d function evaluations.'
+                     % (statistics['accepted_steps'], statistics['rejected_steps'],
+                        statistics['function_evaluations']))
+
+    def _compute_adaptive_derivatives(self, state):
         """
-        perform a single mid-point rk2 step on the geodesic equation with initial cp and mom.
-        also used in parallel transport.
-        return_mom: bool to know if the mom at time t+h is to be computed and returned
+        Right-hand side of the Hamiltonian equations, and of the landmark points flow if state holds landmark points.
         """
-        assert cp.device == mom.device, 'tensors must be on the same device, cp.device=' + str(
-            cp.device) + ', mom.device=' + str(mom.device)
-
-        mid_cp = cp + h / 2. * kernel.convolve(cp, cp, mom)
-        mid_mom = mom - h / 2. * kernel.convolve_gradient(mom, cp)
-        if return_mom:
-            return cp + h * kernel.convolve(mid_cp, mid_cp, mid_mom), \
-                   mom - h * kernel.convolve_gradient(mid_mom, mid_cp)
-        else:
-            return cp + h * kernel.convolve(mid_cp, mid_cp, mid_mom)
+        cp, mom = state[:2]
+        velocity, d_mom = self.shoot_kernel.convolve_and_gradient(cp, mom)
+        derivatives = [velocity, - d_mom]
+        if len(state) == 3:
+            derivatives.append(self.kernel.convolve(state[2], cp, mom))
+        return derivatives
 
-    # TODO. Wrap pytorch of an efficient C code ? Use keops ? Called ApplyH in PyCa. Check Numba as well.
-    # @jit(parallel=True)
     @staticmethod
-    def _compute_image_explicit_euler_step_at_order_1(Y, vf):
-        assert Y.device == vf.device, 'tensors must be on the same device, Y.device=' + str(
-            Y.device) + ', vf.device=' + str(vf.device)
-
-        dY = torch.zeros(Y.shape, dtype=vf.dtype, device=vf.device)
-        dimension = len(Y.shape) - 1
-
-        if dimension == 2:
-            ni, nj = Y.shape[:2]
-
-            # Center.
-            dY[1:ni - 1, :] = dY[1:ni - 1, :] + 0.5 * vf[1:ni - 1, :, 0].view(ni - 2, nj, 1).expand(ni - 2, nj, 2) * (
-                    Y[2:ni, :] - Y[0:ni - 2, :])
-            dY[:, 1:nj - 1] = dY[:, 1:nj - 1] + 0.5 * vf[:, 1:nj - 1, 1].view(ni, nj - 2, 1).expand(ni, nj - 2, 2) * (
-                    Y[:, 2:nj] - Y[:, 0:nj - 2])
-
-            # Borders.
-            dY[0, :] = dY[0, :] + vf[0, :, 0].view(nj, 1).expand(nj, 2) * (Y[1, :] - Y[0, :])
-            dY[ni - 1, :] = dY[ni - 1, :] + vf[ni - 1, :, 0].view(nj, 1).expand(nj, 2) * (Y[ni - 1, :] - Y[ni - 2, :])
-
-            dY[:, 0] = dY[:, 0] + vf[:, 0, 1].view(ni, 1).expand(ni, 2) * (Y[:, 1] - Y[:, 0])
-            dY[:, nj - 1] = dY[:, nj - 1] + vf[:, nj - 1, 1].view(ni, 1).expand(ni, 2) * (Y[:, nj - 1] - Y[:, nj - 2])
-
-        elif dimension == 3:
-            ni, nj, nk = Y.shape[:3]
-
-            # Center.
-            dY[1:ni - 1, :, :] = dY[1:ni - 1, :, :] + 0.5 * vf[1:ni - 1, :, :, 0].view(ni - 2, nj, nk, 1).expand(ni - 2,
-                                                                                                                 nj, nk,
-                                                                                                                 3) * (
-                                         Y[2:ni, :, :] - Y[0:ni - 2, :, :])
-            dY[:, 1:nj - 1, :] = dY[:, 1:nj - 1, :] + 0.5 * vf[:, 1:nj - 1, :, 1].view(ni, nj - 2, nk, 1).expand(ni,
-                                                                                                                 nj - 2,
-                                                                                                                 nk,
-                                                                                                                 3) * (
-                                         Y[:, 2:nj, :] - Y[:, 0:nj - 2, :])
-            dY[:, :, 1:nk - 1] = dY[:, :, 1:nk - 1] + 0.5 * vf[:, :, 1:nk - 1, 2].view(ni, nj, nk - 2, 1).expand(ni, nj,
-                                                                                                                 nk - 2,
-                                                                                                                 3) * (
-                                         Y[:, :, 2:nk] - Y[:, :, 0:nk - 2])
-
-            # Borders.
-            dY[0, :, :] = dY[0, :, :] + vf[0, :, :, 0].view(nj, nk, 1).expand(nj, nk, 3) * (Y[1, :, :] - Y[0, :, :])
-            dY[ni - 1, :, :] = dY[ni - 1, :, :] + vf[ni - 1, :, :, 0].view(nj, nk, 1).expand(nj, nk, 3) * (
-                    Y[ni - 1, :, :] - Y[ni - 2, :, :])
-
-            dY[:, 0, :] = dY[:, 0, :] + vf[:, 0, :, 1].view(ni, nk, 1).expand(ni, nk, 3) * (Y[:, 1, :] - Y[:, 0, :])
-            dY[:, nj - 1, :] = dY[:, nj - 1, :] + vf[:, nj - 1, :, 1].view(ni, nk, 1).expand(ni, nk, 3) * (
-                    Y[:, nj - 1, :] - Y[:, nj - 2, :])
-
-            dY[:, :, 0] = dY[:, :, 0] + vf[:, :, 0, 2].view(ni, nj, 1).expand(ni, nj, 3) * (Y[:, :, 1] - Y[:, :, 0])
-            dY[:, :, nk - 1] = dY[:, :, nk - 1] + vf[:, :, nk - 1, 2].view(ni, nj, 1).expand(ni, nj, 3) * (
-                    Y[:, :, nk - 1] - Y[:, :, nk - 2])
-
-        else:
-            raise RuntimeError('Invalid dimension of the ambient space: %d' % dimension)
-
-        return dY
+    def _interpolate_adaptive_steps(times, states, derivatives, query_times):
+        """
+        Cubic Hermite interpolation of the adaptive steps at the query times. Returns the list of the interpolated
+        trajectories of each state component.
+        """
+        trajectories = [[] for _ in states[0]]
+        indices = np.clip(np.searchsorted(times, query_times, side='right') - 1, 0, len(times) - 2)
+        for t, i in zip(query_times, indices):
+            h = times[i + 1] - times[i]
+            s = min(1., max(0., (t - times[i]) / h))
+            h00, h10, h01, h11 = 2 * s ** 3 - 3 * s ** 2 + 1, s ** 3 - 2 * s ** 2 + s, - 2 * s ** 3 + 3 * s ** 2, \
+                                 s ** 3 - s ** 2
+            for trajectory, y0, f0, y1, f1 in zip(trajectories, states[i], derivatives[i],
+                                                  states[i + 1], derivatives[i + 1]):
+                if s == 0.:
+                    trajectory.append(y0)
+                elif s == 1.:
+                    trajectory.append(y1)
+                else:
+                    trajectory.append(h00 * y0 + h10 * h * f0 + h01 * y1 + h11 * h * f1)
+        return trajectories
 
     ####################################################################################################################
     ### Writing methods:
@@ -1,6 +1,10 @@
+import contextlib
+import os
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
+import torch
 
 from ....core import default
 from ....core.model_tools.deformations.exponential import Exponential
@@ -11,16 +15,23 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def _parallel_transport(*args):
-
-    # read args
-    compute_backward, exponential, momenta_to_transport_t0, is_orthogonal = args
-
-    # compute
-    if compute_backward:
-        return compute_backward, exponential.parallel_transport(momenta_to_transport_t0, is_orthogonal=is_orthogonal)
-    else:
-        return compute_backward, exponential.parallel_transport(momenta_to_transport_t0, is_orthogonal=is_orthogonal)
+def _get_tensors(result):
+    """
+    Yields the tensors held by the result of a geodesic half: tensors, possibly nested in lists, tuples and dicts, and
+    the trajectories of exponentials.
+    """
+    if isinstance(result, torch.Tensor):
+        yield result
+    elif isinstance(result, (list, tuple)):
+        for elt in result:
+            yield from _get_tensors(elt)
+    elif isinstance(result, dict):
+        for elt in result.values():
+            yield from _get_tensors(elt)
+    elif isinstance(result, Exponential):
+        for elt in [result.control_points_t, result.momenta_t, result.template_points_t]:
+            if elt is not None:
+                yield from _get_tensors(elt)
 
 
 class Geodesic:
@@ -38,7 +49,10 @@ class Geodesic:
     def __init__(self, dense_mode=default.dense_mode,
                  kernel=default.deformation_kernel, shoot_kernel_type=None,
                  t0=default.t0, concentration_of_time_points=default.concentration_of_time_points,
-                 use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow):
+                 use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 adaptive_step_tolerance=default.adaptive_step_tolerance,
+                 concurrent_integration=default.concurrent_geodesic_integration,
+                 use_grid_image_flow=default.use_grid_image_flow):
 
         self.concentration_of_time_points = concentration_of_time_points
         self.t0 = t0
@@ -52,12 +66,20 @@ class Geodesic:
         self.backward_exponential = Exponential(
             dense_mode=dense_mode,
             kernel=kernel, shoot_kernel_type=shoot_kernel_type,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            adaptive_step_tolerance=adaptive_step_tolerance, use_grid_image_flow=use_grid_image_flow)
 
         self.forward_exponential = Exponential(
             dense_mode=dense_mode,
             kernel=kernel, shoot_kernel_type=shoot_kernel_type,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            adaptive_step_tolerance=adaptive_step_tolerance, use_grid_image_flow=use_grid_image_flow)
+
+        # Whether the backward and forward exponentials are integrated and transported concurrently, see _run_halves.
+        self.concurrent_integration = concurrent_integration
+        self._executor = None
+        self._executor_pid = None
+        self._streams = {}
 
         # Flags to save extra computations that have already been made in the update methods.
         self.shoot_is_modified = True
@@ -65,8 +87,31 @@ class Geodesic:
         self.backward_extension = 0
         self.forward_extension = 0
 
-        # mp.set_sharing_strategy('file_system')
-        # self.parallel_transport_pool = mp.Pool(processes=1)
+        # Stacked template points trajectory, see _get_template_points_trajectory_cache.
+        self._template_points_t_cache = None
+
+    def __getstate__(self):
+        # The stacked trajectory is only a view of the exponentials trajectories, and may hold an autograd graph.
+        state = self.__dict__.copy()
+        state['_template_points_t_cache'] = None
+        # Threads and cuda streams cannot be pickled, they are created again when needed.
+        state['_executor'] = None
+        state['_executor_pid'] = None
+        state['_streams'] = {}
+        return state
+
+    def __del__(self):
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Stops the worker thread used for the concurrent integration, if any.
+        """
+        executor = getattr(self, '_executor', None)
+        if executor is not None and self._executor_pid == os.getpid():
+            executor.shutdown(wait=False)
+        self._executor = None
+        self._executor_pid = None
 
     ####################################################################################################################
     ### Encapsulation methods:
@@ -157,47 +202,58 @@ class Geodesic:
         Returns the position of the landmark points, at the given time.
         Performs a linear interpolation between the two closest available data points.
         """
-
         assert self.tmin <= time <= self.tmax
+        template_t = self.get_template_points_at([time])
+        return {key: value[0] for key, value in template_t.items()}
+
+    def get_template_points_at(self, times):
+        """
+        Returns the position of the landmark points at each of the given times, stacked in tensors of size
+        (len(times), number_of_points, dimension). Performs linear interpolations between the two closest available
+        data points, located with a binary search in the cached time grid of the trajectory.
+        """
         if self.shoot_is_modified or self.flow_is_modified:
             msg = "Asking for deformed template data but the geodesic was modified and not updated"
             warnings.warn(msg)
 
-        times = self.get_times()
+        times = np.asarray(times, dtype='float64').reshape(-1)
+        assert np.all(self.tmin <= times) and np.all(times <= self.tmax)
+        grid_times, template_t = self._get_template_points_trajectory_cache()
 
         # Deal with the special case of a geodesic reduced to a single point.
-        if len(times) == 1:
+        if len(grid_times) == 1:
             logger.info('>> The geodesic seems to be reduced to a single point.')
-            return self.template_points_t0
-
-        # Standard case.
-        for j in range(1, len(times)):
-            if time - times[j] < 0: break
+            return {key: value.expand(len(times), *value.size()[1:]) for key, value in template_t.items()}
 
-        # j = np.searchsorted(times[:-1], time, side='right')
+        # Standard case: times[j - 1] <= time < times[j], the last interval being closed on the right.
+        j = np.searchsorted(grid_times[1:-1], times, side='right') + 1
+        weight_left = (grid_times[j] - times) / (grid_times[j] - grid_times[j - 1])
+        weight_right = (times - grid_times[j - 1]) / (grid_times[j] - grid_times[j - 1])
 
-        # if time <= self.t0:
-        #     dt = (self.t0 - self.tmin) / (self.backward_exponential.number_of_time_points - 1)
-        #     j = int((time-self.tmin)/dt) + 1
-        #
-        # else:
-        #     dt = (self.tmax - self.t0) / (self.forward_exponential.number_of_time_points - 1)
-        #     j = min(len(times)-1,
-        #             int((time - self.t0) / dt) + self.backward_exponential.number_of_time_points)
-        #
-        # assert times[j-1] <= time
-        # assert times[j] >= time
+        deformed_points = {}
+        for key, value in template_t.items():
+            shape = (len(times),) + (1,) * (value.dim() - 1)
+            j_t = torch.from_numpy(j).to(device=value.device)
+            weight_left_t = utilities.move_data(weight_left, device=value.device, dtype=value.dtype).view(shape)
+            weight_right_t = utilities.move_data(weight_right, device=value.device, dtype=value.dtype).view(shape)
+            deformed_points[key] = weight_left_t * value[j_t - 1] + weight_right_t * value[j_t]
 
-        device, _ = utilities.get_best_device(self.backward_exponential.kernel.gpu_mode)
-
-        weight_left = utilities.move_data([(times[j] - time) / (times[j] - times[j - 1])], device=device, dtype=self.momenta_t0.dtype)
-        weight_right = utilities.move_data([(time - times[j - 1]) / (times[j] - times[j - 1])], device=device, dtype=self.momenta_t0.dtype)
-        template_t = {key: [utilities.move_data(v, device=device) for v in value] for key, value in self.get_template_points_trajectory().items()}
+        return deformed_points
 
-        deformed_points = {key: weight_left * value[j - 1] + weight_right * value[j]
-                           for key, value in template_t.items()}
+    def _get_template_points_trajectory_cache(self):
+        """
+        Returns the time grid of the trajectory, and the template points trajectory stacked in contiguous tensors on
+        the compute device. Both are built on first use after an update.
+        """
+        if self._template_points_t_cache is None or \
+                (torch.is_grad_enabled() and not self._template_points_t_cache[2]):
+            device, _ = utilities.get_best_device(self.backward_exponential.kernel.gpu_mode)
+            template_t = {key: torch.stack([utilities.move_data(v, device=device) for v in value])
+                          for key, value in self.get_template_points_trajectory().items()}
+            self._template_points_t_cache = (np.array(self.get_times(), dtype='float64'), template_t,
+                                             torch.is_grad_enabled())
 
-        return deformed_points
+        return self._template_points_t_cache[:2]
 
     ####################################################################################################################
     ### Main methods:
@@ -212,6 +268,9 @@ class Geodesic:
         assert self.t0 >= self.tmin, "tmin should be smaller than t0"
         assert self.t0 <= self.tmax, "tmax should be larger than t0"
 
+        # The stacked trajectory is rebuilt on demand.
+        self._template_points_t_cache = None
+
         if self.shoot_is_modified or self.flow_is_modified:
 
             device, _ = utilities.get_best_device(self.backward_exponential.kernel.gpu_mode)
@@ -225,9 +284,6 @@ class Geodesic:
                 self.backward_exponential.set_initial_control_points(self.control_points_t0)
             if self.flow_is_modified:
                 self.backward_exponential.set_initial_template_points(self.template_points_t0)
-            if self.backward_exponential.number_of_time_points > 1:
-                self.backward_exponential.move_data_to_(device=device)
-                self.backward_exponential.update()
 
             # Forward exponential --------------------------------------------------------------------------------------
             length = self.tmax - self.t0
@@ -238,23 +294,32 @@ class Geodesic:
                 self.forward_exponential.set_initial_control_points(self.control_points_t0)
             if self.flow_is_modified:
                 self.forward_exponential.set_initial_template_points(self.template_points_t0)
-            if self.forward_exponential.number_of_time_points > 1:
-                self.forward_exponential.move_data_to_(device=device)
-                self.forward_exponential.update()
+
+            # Integration ----------------------------------------------------------------------------------------------
+            self._run_halves(lambda: self._update_exponential(self.backward_exponential, device),
+                             lambda: self._update_exponential(self.forward_exponential, device), device)
 
             self.shoot_is_modified = False
             self.flow_is_modified = False
             self.backward_extension = 0
             self.forward_extension = 0
 
-        else:
-            if self.backward_extension > 0:
-                self.backward_exponential.extend(self.backward_extension)
-                self.backward_extension = 0
+        elif self.backward_extension > 0 or self.forward_extension > 0:
+            self._run_halves(lambda: self._extend_exponential(self.backward_exponential, self.backward_extension),
+                             lambda: self._extend_exponential(self.forward_exponential, self.forward_extension),
+                             self.control_points_t0.device)
+            self.backward_extension = 0
+            self.forward_extension = 0
 
-            if self.forward_extension > 0:
-                self.forward_exponential.extend(self.forward_extension)
-                self.forward_extension = 0
+    def get_step_statistics(self):
+        """
+        Sums the step statistics of the backward and forward exponentials, see Exponential.get_step_statistics.
+        """
+        statistics = [elt.get_step_statistics() for elt in [self.backward_exponential, self.forward_exponential]
+                      if elt.number_of_time_points > 1 and elt.get_step_statistics() is not None]
+        if len(statistics) == 0:
+            return None
+        return {key: sum(elt[key] for elt in statistics) for key in statistics[0].keys()}
 
     def get_norm_squared(self):
         """
@@ -273,49 +338,65 @@ class Geodesic:
             msg = "Trying to parallel transport but the geodesic object was modified, please update before."
             warnings.warn(msg)
 
-        # backwards
-        if self.backward_exponential.number_of_time_points > 1:
-            backward_transport = self.backward_exponential.parallel_transport(momenta_to_transport_t0,
-                                                                              is_orthogonal=is_orthogonal)
-        else:
-            backward_transport = [momenta_to_transport_t0]
-
-        # forwards
-        if self.forward_exponential.number_of_time_points > 1:
-            forward_transport = self.forward_exponential.parallel_transport(momenta_to_transport_t0,
-                                                                            is_orthogonal=is_orthogonal)
-        else:
-            forward_transport = []
+        backward_transport, forward_transport = self._run_halves(
+            lambda: self._transport_along(self.backward_exponential, 'parallel_transport', momenta_to_transport_t0,
+                                          is_orthogonal),
+            lambda: self._transport_along(self.forward_exponential, 'parallel_transport', momenta_to_transport_t0,
+                                          is_orthogonal), momenta_to_transport_t0.device)
 
         logger.debug('time taken to compute parallel_transport: ' + str(time.perf_counter() - start))
         assert backward_transport is not None
         assert forward_transport is not None
         return backward_transport[::-1] + forward_transport[1:]
 
+    def parallel_transport_many(self, momenta_block_t0, is_orthogonal=False):
+        """
+        :param momenta_block_t0: the vectors to parallel transport, stacked in a tensor of size
+        (number_of_vectors, number_of_control_points, dimension), given at t0 and carried at control_points_t0
+        :returns: the full trajectory of the parallel transport of all vectors, from tmin to tmax.
+        """
+        start = time.perf_counter()
+
+        if self.shoot_is_modified:
+            msg = "Trying to parallel transport but the geodesic object was modified, please update before."
+            warnings.warn(msg)
+
+        backward_transport, forward_transport = self._run_halves(
+            lambda: self._transport_along(self.backward_exponential, 'parallel_transport_many', momenta_block_t0,
+                                          is_orthogonal),
+            lambda: self._transport_along(self.forward_exponential, 'parallel_transport_many', momenta_block_t0,
+                                          is_orthogonal), momenta_block_t0.device)
+
+        logger.debug('time taken to compute parallel_transport_many: ' + str(time.perf_counter() - start))
+        return backward_transport[::-1] + forward_transport[1:]
+
     ####################################################################################################################
     ### Extension methods:
     ####################################################################################################################
 
     def extend_parallel_transport(self, parallel_transport_t, backward_extension, forward_extension,
                                   is_orthogonal=False):
+        return self._extend_transport('parallel_transport', parallel_transport_t, backward_extension,
+                                      forward_extension, is_orthogonal)
 
-        parallel_transport_t_backward_extension = [parallel_transport_t[0]]
-        if backward_extension > 0:
-            parallel_transport_t_backward_extension = self.backward_exponential.parallel_transport(
-                parallel_transport_t_backward_extension[0],
-                initial_time_point=self.backward_exponential.number_of_time_points - backward_extension - 1,
-                is_orthogonal=is_orthogonal)
+    def extend_parallel_transport_many(self, parallel_transport_t, backward_extension, forward_extension,
+                                       is_orthogonal=False):
+        """
+        Same as extend_parallel_transport, for the trajectory of stacked vectors returned by parallel_transport_many.
+        """
+        return self._extend_transport('parallel_transport_many', parallel_transport_t, backward_extension,
+                                      forward_extension, is_orthogonal)
 
-        parallel_transport_t_forward_extension = [parallel_transport_t[-1]]
-        if forward_extension > 0:
-            parallel_transport_t_forward_extension = self.forward_exponential.parallel_transport(
-                parallel_transport_t_forward_extension[0],
-                initial_time_point=self.forward_exponential.number_of_time_points - forward_extension - 1,
-                is_orthogonal=is_orthogonal)
+    def _extend_transport(self, transport, parallel_transport_t, backward_extension, forward_extension, is_orthogonal):
+        parallel_transport_t_backward_extension, parallel_transport_t_forward_extension = self._run_halves(
+            lambda: self._transport_along(self.backward_exponential, transport, parallel_transport_t[0],
+                                          is_orthogonal, extension=backward_extension),
+            lambda: self._transport_along(self.forward_exponential, transport, parallel_transport_t[-1],
+                                          is_orthogonal, extension=forward_extension),
+            parallel_transport_t[0].device)
 
-        parallel_transport_t = parallel_transport_t_backward_extension[:0:-1] \
-                               + parallel_transport_t + parallel_transport_t_forward_extension[1:]
-        return parallel_transport_t
+        return parallel_transport_t_backward_extension[:0:-1] \
+               + parallel_transport_t + parallel_transport_t_forward_extension[1:]
 
     def get_times(self):
         times_backward = [self.t0]
@@ -384,6 +465,91 @@ class Geodesic:
 
         return template_t
 
+    ####################################################################################################################
+    ### Utility methods:
+    ####################################################################################################################
+
+    def _run_halves(self, backward_function, forward_function, device):
+        """
+        Runs the functions dealing with the backward and forward exponentials, and returns their results.
+        If concurrent_integration is on, backward_function runs in the worker thread of this geodesic while
+        forward_function runs in the calling thread. Torch and KeOps operations release the GIL, so both halves are
+        effectively computed at the same time. On cuda devices, the worker thread enqueues its operations on a
+        dedicated stream, which first waits for the work already enqueued by the calling thread.
+        """
+        if not self.concurrent_integration:
+            return backward_function(), forward_function()
+
+        executor = self._get_executor()
+        stream = self._get_stream(device)
+
+        # The gradient mode is thread-local.
+        grad_enabled = torch.is_grad_enabled()
+
+        def run_backward_function():
+            with torch.set_grad_enabled(grad_enabled), \
+                    (torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()):
+                return backward_function()
+
+        if stream is not None:
+            stream.wait_stream(torch.cuda.current_stream(device))
+        backward_future = executor.submit(run_backward_function)
+        forward_result = forward_function()
+        backward_result = backward_future.result()
+
+        if stream is not None:
+            current_stream = torch.cuda.current_stream(device)
+            current_stream.wait_stream(stream)
+            # The tensors allocated on the side stream are now used on the calling one.
+            for tensor in _get_tensors(backward_result):
+                if tensor.is_cuda:
+                    tensor.record_stream(current_stream)
+
+        return backward_result, forward_result
+
+    def _get_executor(self):
+        # A forked process inherits the executor, but not its thread.
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='geodesic')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _get_stream(self, device):
+        device = torch.device(device)
+        if device.type != 'cuda':
+            return None
+        if device not in self._streams:
+            self._streams[device] = torch.cuda.Stream(device=device)
+        return self._streams[device]
+
+    @staticmethod
+    def _update_exponential(exponential, device):
+        if exponential.number_of_time_points > 1:
+            exponential.move_data_to_(device=device)
+            exponential.update()
+        return exponential
+
+    @staticmethod
+    def _extend_exponential(exponential, extension):
+        if extension > 0:
+            exponential.extend(extension)
+        return exponential
+
+    @staticmethod
+    def _transport_along(exponential, transport, momenta_to_transport, is_orthogonal, extension=None):
+        """
+        Transports the momenta along the whole exponential, or along its last extension time points only. The given
+        transport method is either 'parallel_transport' or 'parallel_transport_many'.
+        """
+        if extension is None and exponential.number_of_time_points > 1:
+            return getattr(exponential, transport)(momenta_to_transport, is_orthogonal=is_orthogonal)
+        elif extension is not None and extension > 0:
+            return getattr(exponential, transport)(
+                momenta_to_transport, initial_time_point=exponential.number_of_time_points - extension - 1,
+                is_orthogonal=is_orthogonal)
+        else:
+            return [momenta_to_transport]
+
     ####################################################################################################################
     ### Writing methods:
     ####################################################################################################################
@@ -393,13 +559,14 @@ class Geodesic:
 
         # Core loop ----------------------------------------------------------------------------------------------------
         times = self.get_times()
+        template_t = self.get_template_points_at(times)
         for t, time in enumerate(times):
             names = []
             for k, (object_name, object_extension) in enumerate(zip(objects_name, objects_extension)):
                 name = root_name + '__GeodesicFlow__' + object_name + '__tp_' + str(t) \
                        + ('__age_%.2f' % time) + object_extension
                 names.append(name)
-            deformed_points = self.get_template_points(time)
+            deformed_points = {key: value[t] for key, value in template_t.items()}
             deformed_data = template.get_deformed_data(deformed_points, template_data)
             template.write(output_dir, names,
                            {key: value.detach().cpu().numpy() for key, value in deformed_data.items()})
@@ -1,6 +1,8 @@
+import numpy as np
 import torch
 
 from ....core import default
+from ....core.model_tools.deformations.batched_exponential import BatchedExponential
 from ....core.model_tools.deformations.exponential import Exponential
 from ....core.model_tools.deformations.geodesic import Geodesic
 from ....in_out.array_readers_and_writers import *
@@ -22,7 +24,8 @@ class SpatiotemporalReferenceFrame:
                  kernel=default.deformation_kernel, shoot_kernel_type=default.shoot_kernel_type, t0=default.t0,
                  concentration_of_time_points=default.concentration_of_time_points,
                  number_of_time_points=default.number_of_time_points,
-                 use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow):
+                 use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 concurrent_geodesic_integration=default.concurrent_geodesic_integration):
 
         self.exponential = Exponential(
             dense_mode=dense_mode,
@@ -30,10 +33,18 @@ class SpatiotemporalReferenceFrame:
             number_of_time_points=number_of_time_points, use_rk2_for_shoot=use_rk2_for_shoot,
             use_rk2_for_flow=use_rk2_for_flow)
 
+        # Used to evaluate several exp-parallel curves at once, see get_template_points_at.
+        self.batched_exponential = BatchedExponential(
+            dense_mode=dense_mode,
+            kernel=kernel, shoot_kernel_type=shoot_kernel_type,
+            number_of_time_points=number_of_time_points, use_rk2_for_shoot=use_rk2_for_shoot,
+            use_rk2_for_flow=use_rk2_for_flow)
+
         self.geodesic = Geodesic(
             dense_mode=dense_mode, kernel=kernel, t0=t0,
             concentration_of_time_points=concentration_of_time_points,
-            use_rk2_for_shoot=True, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=True, use_rk2_for_flow=use_rk2_for_flow,
+            concurrent_integration=concurrent_geodesic_integration)
 
         self.modulation_matrix_t0 = None
         self.projected_modulation_matrix_t0 = None
@@ -80,14 +91,17 @@ class SpatiotemporalReferenceFrame:
 
     def set_use_rk2_for_shoot(self, flag):  # Cannot modify the shoot integration of the geodesic, which require rk2.
         self.exponential.set_use_rk2_for_shoot(flag)
+        self.batched_exponential.set_use_rk2_for_shoot(flag)
 
     def set_use_rk2_for_flow(self, flag):
-        self.exponential.set_use_rk2_for_shoot(flag)
+        self.exponential.set_use_rk2_for_flow(flag)
+        self.batched_exponential.set_use_rk2_for_flow(flag)
         self.geodesic.set_use_rk2_for_flow(flag)
 
     def set_kernel(self, kernel):
         self.geodesic.set_kernel(kernel)
         self.exponential.set_kernel(kernel)
+        self.batched_exponential.set_kernel(kernel)
 
     def get_kernel_type(self):
         return self.exponential.kernel.kernel_type
@@ -103,6 +117,7 @@ class SpatiotemporalReferenceFrame:
 
     def set_number_of_time_points(self, ntp):
         self.exponential.number_of_time_points = ntp
+        self.batched_exponential.number_of_time_points = ntp
 
     def set_template_points_t0(self, td):
         self.geodesic.set_template_points_t0(td)
@@ -201,6 +216,57 @@ class SpatiotemporalReferenceFrame:
         self.exponential.update()
         return self.exponential.get_template_points()
 
+    def get_template_points_at(self, times, sources, device=None):
+        """
+        Batched version of get_template_points, for several (time, sources) pairs.
+        The pairs are grouped by interval of the geodesic time discretization: the exp-parallel curves of each group are
+        computed at once by the batched exponential.
+        :param times:   list of scalar tensors.
+        :param sources: tensor of size (len(times), number_of_sources).
+        :return:    list of the deformed template points dictionaries, in the order of the given times.
+        """
+        if len(self.times) == 1:
+            return [self.get_template_points(time, sources_k, device=device) for time, sources_k in zip(times, sources)]
+
+        # Same interval as _get_interpolation_index_and_weights, located by binary search.
+        indices = np.searchsorted(self.times[1:-1], [float(time) for time in times], side='right') + 1
+
+        deformed_points = [None] * len(times)
+        for index in np.unique(indices):
+            ks = np.nonzero(indices == index)[0]
+            time = torch.stack([times[k] for k in ks])
+            weight_left = (self.times[index] - time) / (self.times[index] - self.times[index - 1])
+            weight_right = (time - self.times[index - 1]) / (self.times[index] - self.times[index - 1])
+
+            template_points = {key: self._interpolate(value, index, weight_left, weight_right)
+                               for key, value in self.template_points_t.items()}
+            control_points = self._interpolate(self.control_points_t, index, weight_left, weight_right)
+            modulation_matrix = self._interpolate(self.projected_modulation_matrix_t, index, weight_left, weight_right)
+            space_shift = torch.bmm(modulation_matrix, sources[torch.as_tensor(ks, device=sources.device)].unsqueeze(2))
+            space_shift = space_shift.view((len(ks),) + self.geodesic.momenta_t0.size())
+
+            self.batched_exponential.set_initial_template_points(template_points)
+            self.batched_exponential.set_initial_control_points(control_points)
+            self.batched_exponential.set_initial_momenta(space_shift)
+            if device is not None:
+                self.batched_exponential.move_data_to_(device)
+            self.batched_exponential.update()
+
+            batched_points = self.batched_exponential.get_template_points()
+            for b, k in enumerate(ks):
+                deformed_points[k] = {key: value[b] for key, value in batched_points.items()}
+
+        return deformed_points
+
+    @staticmethod
+    def _interpolate(trajectory, index, weights_left, weights_right):
+        """
+        Stacks the linear interpolations of the trajectory between its index-1 and index time points, for each pair
+        of weights.
+        """
+        size = (-1,) + (1,) * trajectory[index].dim()
+        return weights_left.view(size) * trajectory[index - 1] + weights_right.view(size) * trajectory[index]
+
     def _get_interpolation_index_and_weights(self, time):
         for index in range(1, len(self.times)):
             if time.data.cpu().numpy() - self.times[index] < 0:
@@ -233,19 +299,10 @@ class SpatiotemporalReferenceFrame:
             # Projects the modulation_matrix_t0 attribute columns.
             self._update_projected_modulation_matrix_t0(device=device)
 
-            # Initializes the projected_modulation_matrix_t attribute size.
-            self.projected_modulation_matrix_t = \
-                [torch.zeros(self.projected_modulation_matrix_t0.size(), dtype=self.modulation_matrix_t0.dtype, device=device)
-                 for _ in range(len(self.control_points_t))]
-
-            # Transport each column, ignoring the tangential components.
-            for s in range(self.number_of_sources):
-                space_shift_t0 = self.projected_modulation_matrix_t0[:, s].contiguous().view(self.geodesic.momenta_t0.size())
-                space_shift_t = self.geodesic.parallel_transport(space_shift_t0, is_orthogonal=True)
-
-                # Set the result correctly in the projected_modulation_matrix_t attribute.
-                for t, space_shift in enumerate(space_shift_t):
-                    self.projected_modulation_matrix_t[t][:, s] = space_shift.view(-1)
+            # Transport all the columns at once, ignoring the tangential components.
+            space_shifts_t = self.geodesic.parallel_transport_many(self._get_space_shifts(
+                self.projected_modulation_matrix_t0), is_orthogonal=True)
+            self.projected_modulation_matrix_t = [self._get_modulation_matrix(elt) for elt in space_shifts_t]
 
             self.transport_is_modified = False
             self.backward_extension = 0
@@ -253,23 +310,13 @@ class SpatiotemporalReferenceFrame:
 
         elif self.backward_extension > 0 or self.forward_extension > 0:
 
-            # Initializes the extended projected_modulation_matrix_t variable.
-            projected_modulation_matrix_t_extended = [
-                torch.zeros(self.projected_modulation_matrix_t0.size(), dtype=self.modulation_matrix_t0.dtype, device=device)
-                for _ in range(len(self.control_points_t))]
+            # Transport all the columns at once, ignoring the tangential components.
+            space_shifts_t = self.geodesic.extend_parallel_transport_many(
+                [self._get_space_shifts(elt) for elt in self.projected_modulation_matrix_t],
+                self.backward_extension, self.forward_extension, is_orthogonal=True)
 
-            # Transport each column, ignoring the tangential components.
-            for s in range(self.number_of_sources):
-                space_shift_t = [elt[:, s].contiguous().view(self.geodesic.momenta_t0.size())
-                                 for elt in self.projected_modulation_matrix_t]
-                space_shift_t = self.geodesic.extend_parallel_transport(space_shift_t, self.backward_extension,
-                                                                        self.forward_extension, is_orthogonal=True)
-
-                assert len(space_shift_t) == len(projected_modulation_matrix_t_extended)
-                for t, space_shift in enumerate(space_shift_t):
-                    projected_modulation_matrix_t_extended[t][:, s] = space_shift.view(-1)
-
-            self.projected_modulation_matrix_t = projected_modulation_matrix_t_extended
+            assert len(space_shifts_t) == len(self.control_points_t)
+            self.projected_modulation_matrix_t = [self._get_modulation_matrix(elt) for elt in space_shifts_t]
             self.backward_extension = 0
             self.forward_extension = 0
 
@@ -285,20 +332,27 @@ class SpatiotemporalReferenceFrame:
     ####################################################################################################################
 
     def _update_projected_modulation_matrix_t0(self, device='cpu'):
-        self.projected_modulation_matrix_t0 = torch.zeros(self.modulation_matrix_t0.size(),
-                                                          dtype=self.modulation_matrix_t0.dtype,
-                                                          device=device)
-
         norm_squared = self.geodesic.backward_exponential.scalar_product(
             self.geodesic.control_points_t0, self.geodesic.momenta_t0, self.geodesic.momenta_t0)
 
-        for s in range(self.number_of_sources):
-            space_shift_t0 = self.modulation_matrix_t0[:, s].contiguous().view(self.geodesic.momenta_t0.size())
-            sp = self.geodesic.backward_exponential.scalar_product(
-                self.geodesic.control_points_t0, self.geodesic.momenta_t0, space_shift_t0) / norm_squared
+        space_shifts_t0 = self._get_space_shifts(self.modulation_matrix_t0)
+        sp = self.geodesic.backward_exponential._scalar_products(
+            self.geodesic.control_points_t0, space_shifts_t0, self.geodesic.momenta_t0) / norm_squared
+
+        self.projected_modulation_matrix_t0 = self._get_modulation_matrix(
+            space_shifts_t0 - sp * self.geodesic.momenta_t0).to(device)
 
-            projected_space_shift_t0 = space_shift_t0 - sp * self.geodesic.momenta_t0
-            self.projected_modulation_matrix_t0[:, s] = projected_space_shift_t0.view(-1).contiguous()
+    def _get_space_shifts(self, modulation_matrix):
+        """
+        Columns of the modulation matrix, stacked as momenta of size (number_of_sources,) + momenta_t0.size().
+        """
+        return modulation_matrix.t().contiguous().view((self.number_of_sources,) + self.geodesic.momenta_t0.size())
+
+    def _get_modulation_matrix(self, space_shifts):
+        """
+        Inverse of _get_space_shifts.
+        """
+        return space_shifts.view(self.number_of_sources, self.geodesic.momenta_t0.numel()).t().contiguous()
 
     ####################################################################################################################
     ### Writing methods:
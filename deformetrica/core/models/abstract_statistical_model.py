@@ -1,12 +1,18 @@
+import copy
+import hashlib
+import heapq
 import logging
 import os
 import time
+import numpy as np
 import torch
 from abc import abstractmethod
+from collections import OrderedDict
 
 import torch.multiprocessing as mp
 
 from ...core import default
+from ...support import utilities
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +39,84 @@ def _initializer(*args):
         process_id.value += 1
 
 
+def _run_chunk(args):
+    """
+    Evaluates a chunk of tasks in a pool worker, timing each of them.
+    :param args:    tuple (function, reduce, keys, tasks), where function and reduce must be module-level functions.
+                    If reduce is not None, the results of the chunk are folded locally with it, and a single partial
+                    result is returned instead of the list of results.
+    """
+    function, reduce, keys, tasks = args
+
+    results = []
+    timings = []
+    for task in tasks:
+        start = time.perf_counter()
+        result = function(task)
+        if reduce is None:
+            results.append(result)
+        else:
+            results = [result] if len(results) == 0 else [reduce(results[0], result)]
+        timings.append(time.perf_counter() - start)
+
+    return mp.current_process().name, keys, results, timings
+
+
+def _subject_residuals(arg):
+    """
+    Auxiliary function for multithreading (cannot be a class method).
+    Computes the residuals of the i-th subject, without gradient, see
+    AbstractStatisticalModel._setup_residuals_multiprocess_pool.
+    """
+    if process_initial_data is None:
+        raise RuntimeError('process_initial_data is not set !')
+
+    # Read arguments.
+    (deformable_objects, multi_object_attachment, exponential, tensor_scalar_type, gpu_mode,
+     template, shared_fixed_effects) = process_initial_data
+    (i, momenta) = arg
+
+    # read the fixed effects from the shared memory buffers, that are written by the main process before each map.
+    template_data = {key: np.array(value) for key, value in shared_fixed_effects['template_data'].items()}
+    template.set_data(template_data)
+    control_points = shared_fixed_effects['control_points']
+
+    device, device_id = utilities.get_best_device(gpu_mode=gpu_mode)
+    if device_id >= 0:
+        torch.cuda.set_device(device_id)
+
+    with torch.no_grad():
+        template_data = {key: utilities.move_data(value, device=device, dtype=tensor_scalar_type)
+                         for key, value in template_data.items()}
+        template_points = {key: utilities.move_data(value, device=device, dtype=tensor_scalar_type)
+                           for key, value in template.get_points().items()}
+        control_points = utilities.move_data(control_points, device=device, dtype=tensor_scalar_type)
+        momenta = utilities.move_data(momenta, device=device, dtype=tensor_scalar_type)
+
+        exponential.set_initial_template_points(template_points)
+        exponential.set_initial_control_points(control_points)
+        exponential.set_initial_momenta(momenta)
+        exponential.move_data_to_(device=device)
+        exponential.update()
+        deformed_points = exponential.get_template_points()
+        deformed_data = template.get_deformed_data(deformed_points, template_data)
+        residuals = multi_object_attachment.compute_distances(deformed_data, template, deformable_objects[i])
+
+    return residuals.cpu().numpy()
+
+
+def _digest(arrays):
+    """
+    Returns a digest of the content, shape and dtype of the given numpy arrays.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(str((array.shape, array.dtype.str)).encode())
+        h.update(array.tobytes())
+    return h.digest()
+
+
 class AbstractStatisticalModel:
     """
     AbstractStatisticalModel object class.
@@ -54,6 +138,13 @@ class AbstractStatisticalModel:
         self.number_of_processes = number_of_processes
         self.gpu_mode = gpu_mode
         self.pool = None
+        self.task_timings = {}
+
+        # Per-subject memoization of the likelihood terms, see _get_subject_cache_keys. The fixed effects version is
+        # bumped by the setters of the fixed effects the cached terms depend on.
+        self.subject_cache = {}
+        self.fixed_effects_version = 0
+        self.subject_cache_info = {'hits': 0, 'misses': 0}
 
     @abstractmethod
     def get_fixed_effects(self):
@@ -81,10 +172,175 @@ class AbstractStatisticalModel:
                                "it is advised to run `nvidia-cuda-mps-control` to leverage concurrent cuda executions. "
                                "If run in background mode, don't forget to stop the daemon when done.")
 
+    def _setup_residuals_multiprocess_pool(self, dataset):
+        """
+        Starts the pool whose workers compute the residuals of the subjects, see _compute_residuals_with_pool.
+        The targets, template and fixed effects are shared with the workers through shared memory: the fixed effects
+        buffers are rewritten before each map. Used by the models with template, exponential, multi_object_attachment
+        and tensor_scalar_type attributes.
+        """
+        if self.number_of_processes > 1:
+            targets = utilities.share_memory([target[0] for target in dataset.deformable_objects])
+            template = utilities.share_memory(self.template)
+            self.shared_fixed_effects = utilities.share_memory(self._get_shared_fixed_effects())
+
+            self._setup_multiprocess_pool(initargs=(targets, self.multi_object_attachment, self.exponential,
+                                                    self.tensor_scalar_type, self.gpu_mode,
+                                                    template, self.shared_fixed_effects))
+
     def _cleanup_multiprocess_pool(self):
         if self.pool is not None:
             self.pool.terminate()
 
+    def _map_tasks(self, function, tasks, keys, costs, chunks_per_process=default.chunks_per_process):
+        """
+        Evaluates the function on each task with the multiprocess pool, and yields the (key, result) pairs in
+        completion order.
+        The tasks are packed into chunks of balanced estimated costs, the most expensive chunks being dispatched first.
+        The cost of a task is its last measured duration if it has already been run, and otherwise its a priori cost
+        rescaled by the measured durations of the other tasks.
+        :param function:    module-level function, called on each task in the pool workers.
+        :param keys:        hashable identifiers of the tasks, that should be stable across iterations.
+        :param costs:       a priori costs of the tasks, e.g. number of points times number of time points.
+        """
+        chunks = self._schedule_chunks(keys, costs, chunks_per_process)
+        args = [(function, None, [keys[k] for k in chunk], [tasks[k] for k in chunk]) for chunk in chunks]
+        for chunk_keys, results in self._run_chunks(args):
+            for key, result in zip(chunk_keys, results):
+                yield key, result
+
+    def _map_reduce_tasks(self, function, reduce, tasks, keys, costs, chunks_per_process=default.chunks_per_process):
+        """
+        Same as _map_tasks, but the results are folded with the reduce function: each worker reduces the results of
+        its chunk locally, and the partial results are folded as they arrive. Only O(number_of_processes) results are
+        therefore alive at the same time.
+        :param reduce:  module-level function, mapping two (partial) results to their reduction.
+        :return:    the reduction of all the results.
+        """
+        chunks = self._schedule_chunks(keys, costs, chunks_per_process)
+        args = [(function, reduce, [keys[k] for k in chunk], [tasks[k] for k in chunk]) for chunk in chunks]
+
+        res = None
+        for _, results in self._run_chunks(args):
+            res = results[0] if res is None else reduce(res, results[0])
+        return res
+
+    def _schedule_chunks(self, keys, costs, chunks_per_process):
+        """
+        Packs the tasks into balanced chunks, greedily assigning the longest tasks first to the least loaded chunk.
+        :return:    list of chunks, i.e. lists of task indices, by decreasing estimated cost.
+        """
+        assert len(keys) == len(costs), 'keys and costs should be the same size'
+
+        # Estimate the costs.
+        timed = [k for k, key in enumerate(keys) if key in self.task_timings]
+        scale = 1.0
+        if len(timed) > 0 and sum(costs[k] for k in timed) > 0:
+            scale = sum(self.task_timings[keys[k]] for k in timed) / sum(costs[k] for k in timed)
+        estimated_costs = [self.task_timings[key] if key in self.task_timings else scale * cost
+                           for key, cost in zip(keys, costs)]
+
+        # Pack.
+        number_of_chunks = max(1, min(len(keys), self.number_of_processes * chunks_per_process))
+        loads = [(0.0, c) for c in range(number_of_chunks)]
+        chunks = [[] for _ in range(number_of_chunks)]
+        for k in sorted(range(len(keys)), key=lambda k: estimated_costs[k], reverse=True):
+            load, c = heapq.heappop(loads)
+            chunks[c].append(k)
+            heapq.heappush(loads, (load + estimated_costs[k], c))
+        return [chunks[c] for _, c in sorted(loads, reverse=True) if len(chunks[c]) > 0]
+
+    def _run_chunks(self, args):
+        """
+        Runs the chunks with the multiprocess pool, and yields the (keys, results) pairs of each chunk in completion
+        order. The measured task durations are stored, and the per-worker statistics are logged.
+        """
+        start = time.perf_counter()
+        worker_timings = {}
+        for worker, chunk_keys, results, timings in self.pool.imap_unordered(_run_chunk, args):
+            busy_time, number_of_tasks = worker_timings.get(worker, (0.0, 0))
+            worker_timings[worker] = (busy_time + sum(timings), number_of_tasks + len(timings))
+            for key, timing in zip(chunk_keys, timings):
+                self.task_timings[key] = timing
+
+            yield chunk_keys, results
+
+        # Log the per-worker statistics.
+        elapsed = time.perf_counter() - start
+        for worker, (busy_time, number_of_tasks) in sorted(worker_timings.items()):
+            logger.debug('%s : %d tasks in %.3f seconds (%.1f%% of %.3f seconds)'
+                         % (worker, number_of_tasks, busy_time, 100. * busy_time / max(elapsed, 1e-12), elapsed))
+        if len(worker_timings) > 0:
+            busy_times = [busy_time for busy_time, _ in worker_timings.values()]
+            logger.debug('load imbalance (max / mean worker busy time): %.2f'
+                         % (max(busy_times) / max(sum(busy_times) / len(busy_times), 1e-12)))
+
+    def _compute_residuals_with_pool(self, targets, momenta, cache_keys, device):
+        """
+        Computes the residuals of the subjects with the multiprocess pool, reading the cached ones if cache_keys is
+        given. The subjects are evaluated independently: the result does not depend on the number of processes.
+        """
+        residuals = [None] * len(targets)
+        if cache_keys is not None:
+            for i in range(len(targets)):
+                residuals[i] = self._get_cached_subject_term(i, cache_keys[i])
+        indices = [i for i, residuals_i in enumerate(residuals) if residuals_i is None]
+
+        if len(indices) > 0:
+            utilities.copy_to_shared_memory(self.shared_fixed_effects, self._get_shared_fixed_effects())
+            momenta = momenta.detach().cpu().numpy()
+            args = [(i, momenta[i]) for i in indices]
+            costs = [targets[i].get_number_of_points() * self.exponential.number_of_time_points for i in indices]
+
+            for i, residuals_i in self._map_tasks(_subject_residuals, args, indices, costs):
+                residuals[i] = utilities.move_data(residuals_i, dtype=self.tensor_scalar_type, device=device)
+                if cache_keys is not None:
+                    self._cache_subject_term(i, cache_keys[i], residuals[i])
+
+        return residuals
+
+    def _get_shared_fixed_effects(self):
+        """
+        Fixed effects read by the pool workers, see _subject_residuals.
+        """
+        return {'template_data': self.fixed_effects['template_data'],
+                'control_points': self.fixed_effects['control_points']}
+
+    def _get_subject_cache_keys(self, individual_RER):
+        """
+        Returns the cache key of each subject, made of the fixed effects version and of the digest of the random
+        effects realization of the subject.
+        :param individual_RER:  numpy array whose first dimension indexes the subjects.
+        """
+        return [(self.fixed_effects_version, _digest([individual_RER[i]])) for i in range(len(individual_RER))]
+
+    def _get_cached_subject_term(self, i, key):
+        """
+        Returns the cached term of the i-th subject for the given key, or None if it has not been computed yet.
+        """
+        subject_cache = self.subject_cache.get(i)
+        if subject_cache is not None and key in subject_cache:
+            subject_cache.move_to_end(key)
+            self.subject_cache_info['hits'] += 1
+            return subject_cache[key]
+
+        self.subject_cache_info['misses'] += 1
+        return None
+
+    def _cache_subject_term(self, i, key, term):
+        """
+        Stores the term of the i-th subject. Only the default.subject_cache_size last terms of each subject are kept,
+        e.g. the current and candidate terms of the sampler.
+        """
+        cache_size = default.subject_cache_size
+        if cache_size <= 0:
+            return
+        subject_cache = self.subject_cache.setdefault(i, OrderedDict())
+        subject_cache[key] = term
+        subject_cache.move_to_end(key)
+        while len(subject_cache) > cache_size:
+            subject_cache.popitem(last=False)
+
     ####################################################################################################################
     ### Common methods, not necessarily useful for every model.
     ####################################################################################################################
@@ -93,5 +349,33 @@ class AbstractStatisticalModel:
         self._cleanup_multiprocess_pool()
 
     def clear_memory(self):
-        pass
+        self.subject_cache = {}
+
+    def copy_for_writing(self):
+        """
+        Returns an independent copy of the model, without multiprocess pool, that writes the outputs of an estimation
+        in a background thread, see AbstractEstimator. Its fixed effects are then updated with set_all_fixed_effects.
+        Raises a RuntimeError if the model holds tensors attached to an autograd graph, which cannot be deep-copied.
+        """
+        excluded = {key: self.__dict__.pop(key) for key in ['pool', 'shared_fixed_effects'] if key in self.__dict__}
+        try:
+            model = copy.deepcopy(self)
+        finally:
+            self.__dict__.update(excluded)
+
+        model.pool = None
+        model.number_of_processes = 1
+        return model
+
+    def set_all_fixed_effects(self, fixed_effects):
+        """
+        Sets every fixed effect of the given dictionary, structured as self.fixed_effects, through its setter when the
+        model has one, so that the state derived from it is updated as well.
+        """
+        for key, value in fixed_effects.items():
+            setter = getattr(self, 'set_' + key, None)
+            if setter is not None:
+                setter(value)
+            else:
+                self.fixed_effects[key] = value
 
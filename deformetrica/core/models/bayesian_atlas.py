@@ -45,6 +45,8 @@ class BayesianAtlas(AbstractStatisticalModel):
                  shoot_kernel_type=default.shoot_kernel_type,
                  number_of_time_points=default.number_of_time_points,
                  use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 adaptive_step_tolerance=default.adaptive_step_tolerance,
+                 use_grid_image_flow=default.use_grid_image_flow,
 
                  freeze_template=default.freeze_template,
                  use_sobolev_gradient=default.use_sobolev_gradient,
@@ -87,7 +89,8 @@ class BayesianAtlas(AbstractStatisticalModel):
             kernel=kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width),
             shoot_kernel_type=shoot_kernel_type,
             number_of_time_points=number_of_time_points,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            adaptive_step_tolerance=adaptive_step_tolerance, use_grid_image_flow=use_grid_image_flow)
 
         # Template.
         (object_list, self.objects_name, self.objects_name_extension,
@@ -183,6 +186,7 @@ class BayesianAtlas(AbstractStatisticalModel):
 
     def set_template_data(self, td):
         self.fixed_effects['template_data'] = td
+        self.fixed_effects_version += 1
         self.template.set_data(td)
 
     # Control points ---------------------------------------------------------------------------------------------------
@@ -191,6 +195,7 @@ class BayesianAtlas(AbstractStatisticalModel):
 
     def set_control_points(self, cp):
         self.fixed_effects['control_points'] = cp
+        self.fixed_effects_version += 1
         self.number_of_control_points = len(cp)
 
     # Covariance momenta inverse ---------------------------------------------------------------------------------------
@@ -242,6 +247,11 @@ class BayesianAtlas(AbstractStatisticalModel):
     ### Public methods:
     ####################################################################################################################
 
+    def setup_multiprocess_pool(self, dataset):
+        # The residuals of the subjects are computed by the pool workers when no gradient is required, e.g. for the
+        # candidates of the mcmc sampler.
+        self._setup_residuals_multiprocess_pool(dataset)
+
     def compute_log_likelihood(self, dataset, population_RER, individual_RER, mode='complete', with_grad=False,
                                modified_individual_RER='all'):
         """
@@ -261,7 +271,10 @@ class BayesianAtlas(AbstractStatisticalModel):
         momenta = self._individual_RER_to_torch_tensors(individual_RER, with_grad and mode == 'complete')
 
         # Deform, update, compute metrics ------------------------------------------------------------------------------
-        residuals = self._compute_residuals(dataset, template_data, template_points, control_points, momenta)
+        # Without gradient, the residuals of the subjects whose momenta did not change are read from the cache.
+        cache_keys = None if with_grad else self._get_residuals_cache_keys(individual_RER)
+        residuals = self._compute_residuals(dataset, template_data, template_points, control_points, momenta,
+                                            cache_keys=cache_keys)
 
         # Update the fixed effects only if the user asked for the complete log likelihood.
         if mode == 'complete':
@@ -332,14 +345,15 @@ class BayesianAtlas(AbstractStatisticalModel):
 
         # Trick to save useless computations. Could be extended to work in the multi-object case as well ...
         if model_terms is not None and self.number_of_objects == 1:
-            sufficient_statistics['S2'][0] += - 2 * np.sum(model_terms) * self.get_noise_variance()
+            sufficient_statistics['S2'][0] += - 2 * np.sum(model_terms) * self.get_noise_variance()[0]
             return sufficient_statistics
 
         # Standard case.
         if residuals is None:
             template_data, template_points, control_points = self._fixed_effects_to_torch_tensors(False)
             momenta = self._individual_RER_to_torch_tensors(individual_RER, False)
-            residuals = self._compute_residuals(dataset, template_data, template_points, control_points, momenta)
+            residuals = self._compute_residuals(dataset, template_data, template_points, control_points, momenta,
+                                                cache_keys=self._get_residuals_cache_keys(individual_RER))
             residuals = [torch.sum(residuals_i) for residuals_i in residuals]
 
         for i in range(dataset.number_of_subjects):
@@ -461,9 +475,11 @@ class BayesianAtlas(AbstractStatisticalModel):
 
         return regularity
 
-    def _compute_residuals(self, dataset, template_data, template_points, control_points, momenta):
+    def _compute_residuals(self, dataset, template_data, template_points, control_points, momenta, cache_keys=None):
         """
         Core part of the ComputeLogLikelihood methods. Fully torch.
+        :param cache_keys:  optional per-subject cache keys, see _get_residuals_cache_keys. Only the residuals of the
+                            subjects that are not in the cache are computed.
         """
         device, _ = utilities.get_best_device(self.exponential.kernel.gpu_mode)
 
@@ -477,7 +493,18 @@ class BayesianAtlas(AbstractStatisticalModel):
         self.exponential.set_initial_template_points(template_points)
         self.exponential.set_initial_control_points(control_points)
 
+        # Without gradient, the subjects that are not in the cache are dispatched to the multiprocess pool.
+        if self.pool is not None and not any(tensor.requires_grad for tensor in [control_points, momenta]
+                                             + list(template_data.values()) + list(template_points.values())):
+            return self._compute_residuals_with_pool(targets, momenta, cache_keys, device)
+
         for i, target in enumerate(targets):
+            if cache_keys is not None:
+                residuals_i = self._get_cached_subject_term(i, cache_keys[i])
+                if residuals_i is not None:
+                    residuals.append(residuals_i)
+                    continue
+
             self.exponential.set_initial_momenta(momenta[i])
             self.exponential.move_data_to_(device=device)
             self.exponential.update()
@@ -485,8 +512,18 @@ class BayesianAtlas(AbstractStatisticalModel):
             deformed_data = self.template.get_deformed_data(deformed_points, template_data)
             residuals.append(self.multi_object_attachment.compute_distances(deformed_data, self.template, target))
 
+            if cache_keys is not None:
+                self._cache_subject_term(i, cache_keys[i], residuals[i].detach())
+
         return residuals
 
+    def _get_residuals_cache_keys(self, individual_RER):
+        """
+        The residuals of a subject only depend on its momenta, and on the template and control points: their setters
+        bump the fixed effects version.
+        """
+        return self._get_subject_cache_keys(individual_RER['momenta'])
+
     ####################################################################################################################
     ### Private utility methods:
     ####################################################################################################################
@@ -5,6 +5,7 @@ import torch
 
 from ...support import kernels as kernel_factory
 from ...core import default
+from ...core.model_tools.deformations.batched_exponential import BatchedExponential
 from ...core.model_tools.deformations.exponential import Exponential
 from ...core.models.abstract_statistical_model import AbstractStatisticalModel
 from ...core.models.model_functions import initialize_control_points, initialize_momenta
@@ -27,8 +28,16 @@ def _subject_attachment_and_regularity(arg):
     # Read arguments.
     (deformable_objects, multi_object_attachment, objects_noise_variance,
      freeze_template, freeze_control_points, freeze_momenta,
-     exponential, sobolev_kernel, use_sobolev_gradient, tensor_scalar_type, gpu_mode) = process_initial_data
-    (i, template, template_data, control_points, momenta, with_grad) = arg
+     exponential, sobolev_kernel, use_sobolev_gradient, tensor_scalar_type, gpu_mode,
+     template, shared_fixed_effects) = process_initial_data
+    (i, with_grad) = arg
+
+    # read the fixed effects from the shared memory buffers, that are written by the main process at each iteration.
+    # the template data is copied, since the buffers are overwritten at the next iteration.
+    template_data = {key: np.array(value) for key, value in shared_fixed_effects['template_data'].items()}
+    template.set_data(template_data)
+    control_points = shared_fixed_effects['control_points']
+    momenta = shared_fixed_effects['momenta'][i]
 
     # start = time.perf_counter()
     device, device_id = utilities.get_best_device(gpu_mode=gpu_mode)
@@ -70,7 +79,30 @@ def _subject_attachment_and_regularity(arg):
     # elapsed = time.perf_counter() - start
     # logger.info('pid=' + str(os.getpid()) + ', ' + torch.multiprocessing.current_process().name +
     #       ', device=' + device + ', elapsed=' + str(elapsed))
-    return i, res
+
+    # the momenta gradient is indexed by subject, so that results can be summed by _sum_attachments_and_regularities.
+    if with_grad and 'momenta' in res[2]:
+        res[2]['momenta'] = {i: res[2]['momenta']}
+    return res
+
+
+def _sum_attachments_and_regularities(res_1, res_2):
+    """
+    Auxiliary function for multithreading, that sums two (partial) results of _subject_attachment_and_regularity.
+    The momenta gradients of the different subjects are gathered, the other terms are summed. The first argument is
+    modified in place.
+    """
+    if len(res_1) == 2:
+        return res_1[0] + res_2[0], res_1[1] + res_2[1]
+
+    attachment_1, regularity_1, gradient_1 = res_1
+    attachment_2, regularity_2, gradient_2 = res_2
+    for key, value in gradient_2.items():
+        if key == 'momenta':
+            gradient_1[key].update(value)
+        else:
+            gradient_1[key] += value
+    return attachment_1 + attachment_2, regularity_1 + regularity_2, gradient_1
 
 
 class DeterministicAtlas(AbstractStatisticalModel):
@@ -98,6 +130,9 @@ class DeterministicAtlas(AbstractStatisticalModel):
                  shoot_kernel_type=default.shoot_kernel_type,
                  number_of_time_points=default.number_of_time_points,
                  use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 adaptive_step_tolerance=default.adaptive_step_tolerance,
+                 use_grid_image_flow=default.use_grid_image_flow,
+                 use_batched_exponential=default.use_batched_exponential,
 
                  freeze_template=default.freeze_template,
                  use_sobolev_gradient=default.use_sobolev_gradient,
@@ -141,7 +176,24 @@ class DeterministicAtlas(AbstractStatisticalModel):
                                           kernel_width=deformation_kernel_width, freeze_DOFs= freeze_DOFs),
             shoot_kernel_type=shoot_kernel_type,
             number_of_time_points=number_of_time_points,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            adaptive_step_tolerance=adaptive_step_tolerance, use_grid_image_flow=use_grid_image_flow)
+
+        # Batched deformation, shooting and flowing all the subjects at once in the single-process case.
+        # The batched exponential only integrates with fixed time steps.
+        if use_batched_exponential and adaptive_step_tolerance is not None:
+            logger.warning('The batched exponential does not handle adaptive time steps: it will not be used.')
+            use_batched_exponential = False
+        self.use_batched_exponential = use_batched_exponential
+        self.batched_exponential = None
+        if self.use_batched_exponential:
+            self.batched_exponential = BatchedExponential(
+                dense_mode=dense_mode,
+                kernel=self.exponential.kernel,
+                shoot_kernel_type=shoot_kernel_type,
+                number_of_time_points=number_of_time_points,
+                use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+                use_grid_image_flow=use_grid_image_flow)
 
         # Template.
         (object_list, self.objects_name, self.objects_name_extension,
@@ -258,12 +310,21 @@ class DeterministicAtlas(AbstractStatisticalModel):
     ####################################################################################################################
 
     def setup_multiprocess_pool(self, dataset):
-        self._setup_multiprocess_pool(initargs=([target[0] for target in dataset.deformable_objects],
-                                                self.multi_object_attachment,
-                                                self.objects_noise_variance,
-                                                self.freeze_template, self.freeze_control_points, self.freeze_momenta,
-                                                self.exponential, self.sobolev_kernel, self.use_sobolev_gradient,
-                                                self.tensor_scalar_type, self.gpu_mode))
+        if self.number_of_processes > 1:
+            # The static data (targets, template connectivity and image intensities) is moved once to shared memory.
+            # The fixed effects are written at each iteration to shared memory buffers, mapped by the worker processes.
+            targets = utilities.share_memory([target[0] for target in dataset.deformable_objects])
+            template = utilities.share_memory(self.template)
+            self.shared_fixed_effects = utilities.share_memory(self.fixed_effects)
+
+            self._setup_multiprocess_pool(initargs=(targets,
+                                                    self.multi_object_attachment,
+                                                    self.objects_noise_variance,
+                                                    self.freeze_template, self.freeze_control_points,
+                                                    self.freeze_momenta,
+                                                    self.exponential, self.sobolev_kernel, self.use_sobolev_gradient,
+                                                    self.tensor_scalar_type, self.gpu_mode,
+                                                    template, self.shared_fixed_effects))
 
     # Compute the functional. Numpy input/outputs.
     def compute_log_likelihood(self, dataset, population_RER, individual_RER, mode='complete', with_grad=False):
@@ -280,56 +341,36 @@ class DeterministicAtlas(AbstractStatisticalModel):
         """
 
         if self.number_of_processes > 1:
+            utilities.copy_to_shared_memory(self.shared_fixed_effects, self.fixed_effects)
             targets = [target[0] for target in dataset.deformable_objects]
-            args = [(i, self.template,
-                     self.fixed_effects['template_data'],
-                     self.fixed_effects['control_points'],
-                     self.fixed_effects['momenta'][i],
-                     with_grad) for i in range(len(targets))]
-
-            start = time.perf_counter()
-            results = self.pool.map(_subject_attachment_and_regularity, args, chunksize=1)  # TODO: optimized chunk size
-            # results = self.pool.imap_unordered(_subject_attachment_and_regularity, args, chunksize=1)
-            # results = self.pool.imap(_subject_attachment_and_regularity, args, chunksize=int(len(args)/self.number_of_processes))
-            logger.debug('time taken for deformations : ' + str(time.perf_counter() - start))
-
-            # Sum and return.
+            args = [(i, with_grad) for i in range(len(targets))]
+            costs = [target.get_number_of_points() * self.exponential.number_of_time_points for target in targets]
+
+            # the tasks are scheduled in balanced chunks, and their results are summed by the workers as they are
+            # computed, then by the main process as they arrive.
+            res = self._map_reduce_tasks(_subject_attachment_and_regularity, _sum_attachments_and_regularities,
+                                         args, args, costs)
+
             if with_grad:
-                attachment = 0.0
-                regularity = 0.0
-
-                gradient = {}
-                if not self.freeze_template:
-                    for key, value in self.fixed_effects['template_data'].items():
-                        gradient[key] = np.zeros(value.shape)
-                if not self.freeze_control_points:
-                    gradient['control_points'] = np.zeros(self.fixed_effects['control_points'].shape)
-                if not self.freeze_momenta:
-                    gradient['momenta'] = np.zeros(self.fixed_effects['momenta'].shape)
-
-                for result in results:
-                    i, (attachment_i, regularity_i, gradient_i) = result
-                    attachment += attachment_i
-                    regularity += regularity_i
-                    for key, value in gradient_i.items():
-                        if key == 'momenta':
-                            gradient[key][i] = value
-                        else:
-                            gradient[key] += value
+                attachment, regularity, gradient = res
+                if 'momenta' in gradient:
+                    momenta_gradient = np.zeros(self.fixed_effects['momenta'].shape)
+                    for i, value in gradient['momenta'].items():
+                        momenta_gradient[i] = value
+                    gradient['momenta'] = momenta_gradient
                 return attachment, regularity, gradient
             else:
-                attachment = 0.0
-                regularity = 0.0
-                for result in results:
-                    i, (attachment_i, regularity_i) = result
-                    attachment += attachment_i
-                    regularity += regularity_i
+                attachment, regularity = res
                 return attachment, regularity
 
         else:
             device, device_id = utilities.get_best_device(gpu_mode=self.gpu_mode)
             template_data, template_points, control_points, momenta = self._fixed_effects_to_torch_tensors(with_grad,
                                                                                                            device=device)
+            if self.use_batched_exponential:
+                return self._compute_batched_attachment_and_regularity(dataset, template_data, template_points,
+                                                                       control_points, momenta, with_grad,
+                                                                       device=device)
             return self._compute_attachment_and_regularity(dataset, template_data, template_points, control_points,
                                                            momenta, with_grad, device=device)
 
@@ -435,6 +476,39 @@ class DeterministicAtlas(AbstractStatisticalModel):
                                        self.use_sobolev_gradient, self.sobolev_kernel,
                                        with_grad)
 
+    def _compute_batched_attachment_and_regularity(self, dataset, template_data, template_points, control_points,
+                                                   momenta, with_grad=False, device='cpu'):
+        """
+        Core part of the ComputeLogLikelihood methods. Torch input, numpy output.
+        Single-thread version, where all the subjects are shot and flowed at once by the batched exponential.
+        """
+
+        # Deform all subjects at once.
+        self.batched_exponential.set_initial_template_points(template_points)
+        self.batched_exponential.set_initial_control_points(control_points)
+        self.batched_exponential.set_initial_momenta(momenta)
+        self.batched_exponential.move_data_to_(device=device)
+        self.batched_exponential.update()
+
+        # Compute attachment and regularity.
+        targets = [target[0] for target in dataset.deformable_objects]
+        deformed_points = self.batched_exponential.get_template_points()
+        attachment = 0.
+        for i, target in enumerate(targets):
+            deformed_data = self.template.get_deformed_data({key: value[i] for key, value in deformed_points.items()},
+                                                            template_data)
+            attachment -= self.multi_object_attachment.compute_weighted_distance(
+                deformed_data, self.template, target, self.objects_noise_variance)
+        regularity = -self.batched_exponential.get_norm_squared()
+
+        # Compute gradient.
+        return self._compute_gradients(attachment, regularity, template_data,
+                                       self.freeze_template, template_points,
+                                       self.freeze_control_points, control_points,
+                                       self.freeze_momenta, momenta,
+                                       self.use_sobolev_gradient, self.sobolev_kernel,
+                                       with_grad)
+
     ####################################################################################################################
     ### Private utility methods:
     ####################################################################################################################
@@ -37,6 +37,9 @@ class GeodesicRegression(AbstractStatisticalModel):
                  shoot_kernel_type=default.shoot_kernel_type,
                  concentration_of_time_points=default.concentration_of_time_points, t0=default.t0,
                  use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 adaptive_step_tolerance=default.adaptive_step_tolerance,
+                 concurrent_geodesic_integration=default.concurrent_geodesic_integration,
+                 use_grid_image_flow=default.use_grid_image_flow,
 
                  freeze_template=default.freeze_template,
                  use_sobolev_gradient=default.use_sobolev_gradient,
@@ -75,7 +78,9 @@ class GeodesicRegression(AbstractStatisticalModel):
             kernel=kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width),
             shoot_kernel_type=shoot_kernel_type,
             t0=t0, concentration_of_time_points=concentration_of_time_points,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            adaptive_step_tolerance=adaptive_step_tolerance,
+            concurrent_integration=concurrent_geodesic_integration, use_grid_image_flow=use_grid_image_flow)
 
         # Template.
         (object_list, self.objects_name, self.objects_name_extension,
@@ -119,12 +124,18 @@ class GeodesicRegression(AbstractStatisticalModel):
             self.geodesic.set_momenta_t0(momenta)
             self.geodesic.update()
 
-            residuals = np.zeros((self.number_of_objects,))
-            for (time, target) in zip(target_times, target_objects):
-                deformed_points = self.geodesic.get_template_points(time)
+            if 'image_points' in template_points.keys():
+                residuals = np.zeros((self.number_of_objects,))
+                for (time, target) in zip(target_times, target_objects):
+                    deformed_points = self.geodesic.get_template_points(time)
+                    deformed_data = self.template.get_deformed_data(deformed_points, template_data)
+                    residuals += self.multi_object_attachment.compute_distances(
+                        deformed_data, self.template, target).data.numpy()
+            else:
+                deformed_points = self.geodesic.get_template_points_at(target_times)
                 deformed_data = self.template.get_deformed_data(deformed_points, template_data)
-                residuals += self.multi_object_attachment.compute_distances(
-                    deformed_data, self.template, target).data.numpy()
+                residuals = self.multi_object_attachment.compute_batched_distances(
+                    deformed_data, self.template, target_objects).sum(0).data.cpu().numpy()
 
             # Initialize the noise variance hyper-parameter as a 1/100th of the initial residual.
             for k, obj in enumerate(self.objects_name):
@@ -274,12 +285,21 @@ class GeodesicRegression(AbstractStatisticalModel):
         self.geodesic.set_momenta_t0(momenta)
         self.geodesic.update()
 
-        attachment = 0.
-        for j, (time, obj) in enumerate(zip(target_times, target_objects)):
-            deformed_points = self.geodesic.get_template_points(time)
+        if 'image_points' in template_points.keys():
+            attachment = 0.
+            for j, (time, obj) in enumerate(zip(target_times, target_objects)):
+                deformed_points = self.geodesic.get_template_points(time)
+                deformed_data = self.template.get_deformed_data(deformed_points, template_data)
+                attachment -= self.multi_object_attachment.compute_weighted_distance(
+                    deformed_data, self.template, obj, self.objects_noise_variance)
+
+        else:
+            # All the visits at once.
+            deformed_points = self.geodesic.get_template_points_at(target_times)
             deformed_data = self.template.get_deformed_data(deformed_points, template_data)
-            attachment -= self.multi_object_attachment.compute_weighted_distance(
-                deformed_data, self.template, obj, self.objects_noise_variance)
+            attachment = - self.multi_object_attachment.compute_batched_weighted_distance(
+                deformed_data, self.template, target_objects, self.objects_noise_variance)
+
         regularity = - self.geodesic.get_norm_squared()
 
         return attachment, regularity
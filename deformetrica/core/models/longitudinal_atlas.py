@@ -194,6 +194,9 @@ class LongitudinalAtlas(AbstractStatisticalModel):
                  concentration_of_time_points=default.concentration_of_time_points,
                  use_rk2_for_shoot=default.use_rk2_for_shoot,
                  use_rk2_for_flow=default.use_rk2_for_flow,
+                 use_batched_exponential=default.use_batched_exponential,
+                 visit_deduplication_tolerance=default.visit_deduplication_tolerance,
+                 concurrent_geodesic_integration=default.concurrent_geodesic_integration,
                  t0=default.t0,
 
                  freeze_template=default.freeze_template,
@@ -265,6 +268,11 @@ class LongitudinalAtlas(AbstractStatisticalModel):
         self.individual_random_effects['onset_age'] = MultiScalarNormalDistribution()
         self.individual_random_effects['acceleration'] = MultiScalarTruncatedNormalDistribution()
 
+        if concurrent_geodesic_integration and self.number_of_processes > 1:
+            logger.warning("The concurrent geodesic integration is not compatible with the multiprocess pool. "
+                           "Disabling the concurrent geodesic integration.")
+            concurrent_geodesic_integration = False
+
         # Deformation.
         self.spatiotemporal_reference_frame = SpatiotemporalReferenceFrame(
             dense_mode=dense_mode,
@@ -273,9 +281,14 @@ class LongitudinalAtlas(AbstractStatisticalModel):
                                           kernel_width=deformation_kernel_width),
             shoot_kernel_type=shoot_kernel_type,
             concentration_of_time_points=concentration_of_time_points, number_of_time_points=number_of_time_points,
-            t0=t0, use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            t0=t0, use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            concurrent_geodesic_integration=concurrent_geodesic_integration)
         self.spatiotemporal_reference_frame_is_modified = True
 
+        # Residuals computation: batching of the visits by time interval, and deduplication of the visits.
+        self.use_batched_exponential = use_batched_exponential
+        self.visit_deduplication_tolerance = visit_deduplication_tolerance
+
         # Template.
         (object_list, self.objects_name, self.objects_name_extension,
          objects_noise_variance, self.multi_object_attachment) = create_template_metadata(
@@ -391,10 +404,8 @@ class LongitudinalAtlas(AbstractStatisticalModel):
                 template_points, control_points, momenta, modulation_matrix, tmin, tmax)
             residuals, _, _ = self._compute_residuals(dataset, template_data, absolute_times, sources)
 
-            residuals_per_object = np.zeros((self.number_of_objects,))
-            for i in range(len(residuals)):
-                for j in range(len(residuals[i])):
-                    residuals_per_object += residuals[i][j].detach().cpu().numpy()
+            packed_residuals, _ = self._pack_residuals(residuals)
+            residuals_per_object = torch.sum(packed_residuals, dim=0).detach().cpu().numpy()
 
             for k, scale_std in enumerate(self.objects_noise_variance_prior_scale_std):
                 if scale_std is None:
@@ -791,7 +802,7 @@ class LongitudinalAtlas(AbstractStatisticalModel):
 
             # Trick to save useless computations. Could be extended to work in the multi-object case as well ...
             if model_terms is not None and self.number_of_objects == 1:
-                sufficient_statistics['S4'][0] += - 2 * np.sum(model_terms) * self.get_noise_variance()
+                sufficient_statistics['S4'][0] += - 2 * np.sum(model_terms) * self.get_noise_variance()[0]
                 return sufficient_statistics
 
             # Standard case.
@@ -805,10 +816,8 @@ class LongitudinalAtlas(AbstractStatisticalModel):
                 residuals, _, _ = self._compute_residuals(dataset, template_data, absolute_times, sources,
                                                           with_grad=False)
 
-            for i in range(len(residuals)):
-                for j in range(len(residuals[i])):
-                    for k in range(self.number_of_objects):
-                        sufficient_statistics['S4'][k] += residuals[i][j][k].detach().cpu().numpy()
+            packed_residuals, _ = self._pack_residuals(residuals)
+            sufficient_statistics['S4'] += torch.sum(packed_residuals, dim=0).detach().cpu().numpy()
 
         return sufficient_statistics
 
@@ -997,16 +1006,15 @@ class LongitudinalAtlas(AbstractStatisticalModel):
         Fully torch.
         """
         number_of_subjects = len(residuals)
-        device = residuals[0][0].device
+        packed_residuals, subject_indices = self._pack_residuals(residuals)
+        device = packed_residuals.device
 
         attachments = torch.zeros((number_of_subjects,), dtype=self.tensor_scalar_type.dtype, device=device)
         noise_variance = utilities.move_data(self.fixed_effects['noise_variance'], dtype=self.tensor_scalar_type, device=device)
 
-        for i in range(number_of_subjects):
-            attachment_i = 0.0
-            for j in range(len(residuals[i])):
-                attachment_i -= 0.5 * torch.sum(residuals[i][j] / noise_variance)
-            attachments[i] = attachment_i
+        # The attachments of the visits are summed per subject.
+        attachments = attachments.index_add(0, subject_indices,
+                                            - 0.5 * torch.sum(packed_residuals / noise_variance, dim=1))
 
         if self.number_of_processes > 1:
             assert grad_checkpoints_tensors is not None
@@ -1019,24 +1027,19 @@ class LongitudinalAtlas(AbstractStatisticalModel):
         """
         Fully torch.
         """
-        number_of_subjects = onset_ages.shape[0]
         regularity = 0.0
 
         # Sources random effect.
-        for i in range(number_of_subjects):
-            regularity += self.individual_random_effects['sources'].compute_log_likelihood_torch(
-                sources[i], self.tensor_scalar_type, device=device)
+        regularity += torch.sum(self.individual_random_effects['sources'].compute_batched_log_likelihood_torch(
+            sources, self.tensor_scalar_type, device=device))
 
         # Onset age random effect.
-        for i in range(number_of_subjects):
-            regularity += self.individual_random_effects['onset_age'].compute_log_likelihood_torch(
-                onset_ages[i], self.tensor_scalar_type, device=device)
+        regularity += torch.sum(self.individual_random_effects['onset_age'].compute_batched_log_likelihood_torch(
+            onset_ages, self.tensor_scalar_type, device=device))
 
         # Acceleration random effect.
-        for i in range(number_of_subjects):
-            regularity += \
-                self.individual_random_effects['acceleration'].compute_log_likelihood_torch(
-                    accelerations[i], self.tensor_scalar_type, device=device)
+        regularity += torch.sum(self.individual_random_effects['acceleration'].compute_batched_log_likelihood_torch(
+            accelerations, self.tensor_scalar_type, device=device))
 
         # # Noise random effect (if not frozen).
         # if not self.is_frozen['noise_variance']:
@@ -1160,18 +1163,10 @@ class LongitudinalAtlas(AbstractStatisticalModel):
 
         # if self.number_of_processes > 1 and not with_grad:
         if self.number_of_processes > 1:
-            # Set arguments.
+            # Set arguments: one task per visit, that are then scheduled in balanced chunks.
             args = []
-
-            # TODO: check block size
-            # block_size = int(sum(len(x) for x in absolute_times) / self.number_of_processes)
-            block_size = 1
-
-            tmp_ij = []
-            tmp_initial_template_points = []
-            tmp_initial_control_points = []
-            tmp_initial_momenta = []
-            tmp_targets = []
+            keys = []
+            costs = []
 
             for i in range(len(targets)):
                 residuals_i = []
@@ -1186,64 +1181,37 @@ class LongitudinalAtlas(AbstractStatisticalModel):
                         checkpoint_tensors += \
                             list(initial_template_points.values()) + [initial_control_points, initial_momenta]
 
-                    tmp_ij.append((i, j))
-                    tmp_initial_template_points.append({key: value.detach()
-                                                        for key, value in initial_template_points.items()})
-                    tmp_initial_control_points.append(initial_control_points.detach())
-                    tmp_initial_momenta.append(initial_momenta.detach())
-                    tmp_targets.append(target)
-
-                    if len(tmp_ij) == block_size:
-                        args.append((tmp_ij, tmp_initial_template_points, tmp_initial_control_points,
-                                     tmp_initial_momenta, template_data, tmp_targets, with_grad))
-
-                        tmp_ij = []
-                        tmp_initial_template_points = []
-                        tmp_initial_control_points = []
-                        tmp_initial_momenta = []
-                        tmp_targets = []
+                    args.append(([(i, j)], [{key: value.detach() for key, value in initial_template_points.items()}],
+                                 [initial_control_points.detach()], [initial_momenta.detach()],
+                                 template_data, [target], with_grad))
+                    keys.append((i, j, with_grad))
+                    costs.append(target.get_number_of_points() *
+                                 self.spatiotemporal_reference_frame.exponential.number_of_time_points)
 
                 residuals.append(residuals_i)
 
-            if len(tmp_ij) != 0:
-                assert len(tmp_ij) == len(tmp_initial_template_points) == len(tmp_initial_control_points) == \
-                       len(tmp_initial_momenta) == len(tmp_targets)
-                args.append((tmp_ij, tmp_initial_template_points, tmp_initial_control_points,
-                             tmp_initial_momenta, template_data, tmp_targets, with_grad))
-
-                current_block_size = 0
-                tmp_ij = []
-                tmp_initial_template_points = []
-                tmp_initial_control_points = []
-                tmp_initial_momenta = []
-                tmp_targets = []
-
-            # Perform parallel computations
-            start = time.perf_counter()
-            results = self.pool.map(compute_exponential_and_attachment, args, chunksize=1)
-            logger.debug('time taken to compute residuals: ' + str(time.perf_counter() - start) + ' for ' + str(
-                len(args)) + ' tasks with a block_size of ' + str(block_size))
-
-            # Gather results.
-            for result in results:
+            # Perform parallel computations, and gather the results.
+            grad_checkpoint_tensors_ij = {}
+            for _, result in self._map_tasks(compute_exponential_and_attachment, args, keys, costs):
                 ijs, ret_residuals, grad_template_points, grad_control_points, grad_momentas = result
 
                 if with_grad:
                     for (i, j), residual, grad_template_point, grad_control_point, grad_momenta \
                             in zip(ijs, ret_residuals, grad_template_points, grad_control_points, grad_momentas):
                         residuals[i][j] = residual
-
-                        grad_checkpoint_tensors += list(grad_template_point.values()) + [grad_control_point,
-                                                                                         grad_momenta]
+                        grad_checkpoint_tensors_ij[(i, j)] = list(grad_template_point.values()) + \
+                                                             [grad_control_point, grad_momenta]
 
                 else:
                     for (i, j), residual in zip(ijs, ret_residuals):
                         residuals[i][j] = residual
 
-                # i, j, residual, grad_template_points, grad_control_points, grad_momenta = result
-                # residuals[i][j] = residual
-                # if with_grad:
-                #     grad_checkpoint_tensors += list(grad_template_points.values()) + [grad_control_points, grad_momenta]
+            # The results arrive in completion order: the gradients are re-ordered like the checkpoint tensors.
+            if with_grad:
+                for i in range(len(targets)):
+                    for j in range(len(targets[i])):
+                        grad_checkpoint_tensors += grad_checkpoint_tensors_ij[(i, j)]
+
         else:
             # logger.info('Perform sequential computations.')
             device, device_id = utilities.get_best_device(self.gpu_mode)
@@ -1253,22 +1221,82 @@ class LongitudinalAtlas(AbstractStatisticalModel):
             # self.template_data = {key: utilities.move_data(value, device=device) for key, value in
             #                       template_data.items()}
 
-            for i in range(len(targets)):
-                residuals_i = []
-                for j, (absolute_time, target) in enumerate(zip(absolute_times[i], targets[i])):
-                    # target = utilities.convert_deformable_object_to_torch(target, device=device)
-                    deformed_points = self.spatiotemporal_reference_frame.get_template_points(
-                        absolute_time, sources[i], device=device)
-                    deformed_data = self.template.get_deformed_data(deformed_points, template_data)
-                    residual = self.multi_object_attachment.compute_distances(deformed_data, self.template, target)
-                    residuals_i.append(residual.cpu())
-                residuals.append(residuals_i)
+            deduplicate = self.visit_deduplication_tolerance is not None and not with_grad
+            if self.use_batched_exponential or deduplicate:
+                # Only the deformations of the unique visits are computed, by batches of visits in the same time
+                # interval of the reference frame if use_batched_exponential.
+                visits = [(i, j) for i in range(len(targets)) for j in range(len(targets[i]))]
+                unique_visits, unique_indices = self._get_unique_visits(visits, absolute_times, sources, deduplicate)
+
+                unique_times = [absolute_times[i][j] for i, j in unique_visits]
+                unique_sources = sources[[i for i, _ in unique_visits]]
+                if self.use_batched_exponential:
+                    deformed_points = self.spatiotemporal_reference_frame.get_template_points_at(
+                        unique_times, unique_sources, device=device)
+                else:
+                    deformed_points = [self.spatiotemporal_reference_frame.get_template_points(
+                        time, sources_k, device=device) for time, sources_k in zip(unique_times, unique_sources)]
+
+                residuals = [[None] * len(targets[i]) for i in range(len(targets))]
+                for (i, j), k in zip(visits, unique_indices):
+                    deformed_data = self.template.get_deformed_data(deformed_points[k], template_data)
+                    residual = self.multi_object_attachment.compute_distances(deformed_data, self.template,
+                                                                              targets[i][j])
+                    residuals[i][j] = residual.cpu()
+
+            else:
+                for i in range(len(targets)):
+                    residuals_i = []
+                    for j, (absolute_time, target) in enumerate(zip(absolute_times[i], targets[i])):
+                        # target = utilities.convert_deformable_object_to_torch(target, device=device)
+                        deformed_points = self.spatiotemporal_reference_frame.get_template_points(
+                            absolute_time, sources[i], device=device)
+                        deformed_data = self.template.get_deformed_data(deformed_points, template_data)
+                        residual = self.multi_object_attachment.compute_distances(deformed_data, self.template, target)
+                        residuals_i.append(residual.cpu())
+                    residuals.append(residuals_i)
 
             logger.debug('time taken to compute residuals: ' + str(time.perf_counter() - start))
 
         assert len(checkpoint_tensors) == len(grad_checkpoint_tensors)
         return residuals, checkpoint_tensors, grad_checkpoint_tensors
 
+    def _get_unique_visits(self, visits, absolute_times, sources, deduplicate):
+        """
+        Returns the list of the visits whose deformation is to be computed, and for each visit the index of the visit of
+        this list that it shares its deformation with.
+        If deduplicate, each visit is merged with the first retained visit whose absolute time and sources all differ
+        from its own by at most visit_deduplication_tolerance. The visits are scanned by increasing absolute time, so
+        only the retained visits within the tolerance in time are compared. The merged visits do not receive any
+        gradient: this is only done for computations without gradient.
+        """
+        if not deduplicate:
+            return visits, list(range(len(visits)))
+
+        tolerance = self.visit_deduplication_tolerance
+        absolute_times = torch.stack([absolute_times[i][j] for i, j in visits]).detach().cpu().numpy()
+        keys = np.concatenate([absolute_times.reshape(-1, 1),
+                               sources.detach().cpu().numpy()[[i for i, _ in visits]]], axis=1)
+
+        representatives = []    # indices of the retained visits, by increasing absolute time.
+        first = 0               # first retained visit within the tolerance in time of the current visit.
+        representative_indices = np.zeros(len(visits), dtype=int)
+        for k in np.argsort(keys[:, 0], kind='stable'):
+            while first < len(representatives) and keys[representatives[first], 0] < keys[k, 0] - tolerance:
+                first += 1
+            for r in representatives[first:]:
+                if np.max(np.abs(keys[r] - keys[k])) <= tolerance:
+                    representative_indices[k] = r
+                    break
+            else:
+                representatives.append(k)
+                representative_indices[k] = k
+
+        # The retained visits are kept in their original order.
+        first_indices = sorted(representatives)
+        position = {r: p for p, r in enumerate(first_indices)}
+        return [visits[k] for k in first_indices], [position[r] for r in representative_indices]
+
     def _compute_absolute_times(self, times, onset_ages, accelerations):
         """
         Fully torch.
@@ -1279,26 +1307,46 @@ class LongitudinalAtlas(AbstractStatisticalModel):
                              'For reference, the acceleration std is %.2f.'
                              % (np.max(accelerations.data.cpu().numpy()), acceleration_std))
 
+        assert len(times) <= len(onset_ages), 'len(times)=' + str(len(times)) + ', len(onset_ages)=' + str(len(onset_ages))
+
         reference_time = self.get_reference_time()
-        reference_time_torch = torch.from_numpy(np.array(reference_time)).type(self.tensor_scalar_type)
         clamped_accelerations = torch.clamp(accelerations, 0.0)
 
-        absolute_times = []
-        for i in range(len(times)):
-            absolute_times_i = []
-            for j in range(len(times[i])):
-                t_ij = torch.from_numpy(np.array(times[i][j])).type(self.tensor_scalar_type)
-
-                assert i < len(onset_ages), 'i=' + str(i) + ', len(onset_ages)=' + str(len(onset_ages))
+        # The times of all the visits are packed in a single tensor, and their absolute times computed at once.
+        lengths = [len(times_i) for times_i in times]
+        packed_times = utilities.move_data(np.concatenate([np.ravel(times_i) for times_i in times] + [np.zeros(0)]),
+                                           dtype=self.tensor_scalar_type, device=accelerations.device)
+        subject_indices = self._get_subject_indices(lengths, device=accelerations.device)
+        packed_absolute_times = clamped_accelerations[subject_indices] * (packed_times - onset_ages[subject_indices]) \
+                                + float(reference_time)
 
-                absolute_times_i.append(clamped_accelerations[i] * (t_ij - onset_ages[i]) + reference_time_torch)
-            absolute_times.append(absolute_times_i)
+        # List of per-subject views of the packed tensor.
+        absolute_times = list(torch.split(packed_absolute_times, lengths))
 
-        tmin = min([subject_times[0].detach().cpu().numpy() for subject_times in absolute_times] + [reference_time])
-        tmax = max([subject_times[-1].detach().cpu().numpy() for subject_times in absolute_times] + [reference_time])
+        packed_absolute_times = packed_absolute_times.detach().cpu().numpy()
+        tmin = np.min(packed_absolute_times, initial=reference_time)
+        tmax = np.max(packed_absolute_times, initial=reference_time)
 
         return absolute_times, tmin, tmax
 
+    @staticmethod
+    def _get_subject_indices(lengths, device='cpu'):
+        """
+        Returns the subject index of each visit, in the packed representation where the visits of all the subjects are
+        concatenated. lengths is the list of the numbers of visits of the subjects.
+        """
+        return torch.repeat_interleave(torch.arange(len(lengths), device=device),
+                                       torch.tensor(lengths, dtype=torch.long, device=device))
+
+    def _pack_residuals(self, residuals):
+        """
+        Packs the list of lists of residuals in a single (number of visits, number of objects) tensor.
+        Returns this tensor, and the subject index of each of its rows.
+        """
+        lengths = [len(residuals_i) for residuals_i in residuals]
+        packed_residuals = torch.stack([residual for residuals_i in residuals for residual in residuals_i])
+        return packed_residuals, self._get_subject_indices(lengths, device=packed_residuals.device)
+
     ####################################################################################################################
     ### Private utility methods:
     ####################################################################################################################
@@ -74,8 +74,6 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
         self.dense_mode =  dense_mode
         self.number_of_processes = number_of_processes
         self.latent_space_dimension = latent_space_dimension
-        if self.number_of_processes > 1:
-            logger.info('Number of threads larger than 1 not currently handled by the PGA model.')
 
         # Dictionary of numpy arrays.
         self.fixed_effects['template_data'] = None
@@ -245,6 +243,7 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
 
     def set_template_data(self, td):
         self.fixed_effects['template_data'] = td
+        self.fixed_effects_version += 1
         self.template.set_data(td)
 
     def get_control_points(self):
@@ -252,6 +251,7 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
 
     def set_control_points(self, cp):
         self.fixed_effects['control_points'] = cp
+        self.fixed_effects_version += 1
         self.number_of_control_points = len(cp)
 
     def get_momenta(self):
@@ -264,6 +264,7 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
 
     def set_principal_directions(self, pd):
         self.fixed_effects['principal_directions'] = pd
+        self.fixed_effects_version += 1
 
     def get_noise_variance(self):
         return self.fixed_effects['noise_variance']
@@ -314,8 +315,12 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
 
         self._initialize_noise_variance()
 
-    # Compute the functional. Numpy input/outputs.
-    def compute_log_likelihood(self, dataset, population_RER, individual_RER, mode='complete', with_grad=False):
+    def setup_multiprocess_pool(self, dataset):
+        # The residuals of the subjects are computed by the pool workers when no gradient is required.
+        self._setup_residuals_multiprocess_pool(dataset)
+
+    def compute_log_likelihood(self, dataset, population_RER, individual_RER, mode='complete', with_grad=False,
+                               modified_individual_RER='all'):
         """
         Compute the log-likelihood of the dataset, given parameters fixed_effects and random effects realizations
         population_RER and indRER.
@@ -337,7 +342,10 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
 
         momenta = self._momenta_from_latent_positions(principal_directions, latent_positions)
 
-        residuals = self._compute_residuals(dataset, template_data, template_points, control_points, momenta, device=device)
+        # Without gradient, the residuals of the subjects whose latent positions did not change are read from the cache.
+        cache_keys = None if with_grad else self._get_residuals_cache_keys(individual_RER)
+        residuals = self._compute_residuals(dataset, template_data, template_points, control_points, momenta,
+                                            device=device, cache_keys=cache_keys)
 
         if mode == 'complete' and with_grad == False:
             sufficient_statistics = self.compute_sufficient_statistics(dataset, individual_RER,
@@ -397,9 +405,12 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
             elif mode == 'model':
                 return attachments.detach().cpu().numpy()
 
-    def _compute_residuals(self, dataset, template_data, template_points, control_points, momenta, device='cpu'):
+    def _compute_residuals(self, dataset, template_data, template_points, control_points, momenta, device='cpu',
+                           cache_keys=None):
         """
         Core part of the ComputeLogLikelihood methods. Fully torch.
+        :param cache_keys:  optional per-subject cache keys, see _get_residuals_cache_keys. Only the residuals of the
+                            subjects that are not in the cache are computed.
         """
 
         # Initialize: cross-sectional dataset --------------------------------------------------------------------------
@@ -412,7 +423,18 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
         self.exponential.set_initial_template_points(template_points)
         self.exponential.set_initial_control_points(control_points)
 
+        # Without gradient, the subjects that are not in the cache are dispatched to the multiprocess pool.
+        if self.pool is not None and not any(tensor.requires_grad for tensor in [control_points, momenta]
+                                             + list(template_data.values()) + list(template_points.values())):
+            return self._compute_residuals_with_pool(targets, momenta, cache_keys, device)
+
         for i, target in enumerate(targets):
+            if cache_keys is not None:
+                residuals_i = self._get_cached_subject_term(i, cache_keys[i])
+                if residuals_i is not None:
+                    residuals.append(residuals_i)
+                    continue
+
             self.exponential.set_initial_momenta(momenta[i])
             self.exponential.move_data_to_(device=device)
             self.exponential.update()
@@ -420,8 +442,18 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
             deformed_data = self.template.get_deformed_data(deformed_points, template_data)
             residuals.append(self.multi_object_attachment.compute_distances(deformed_data, self.template, target))
 
+            if cache_keys is not None:
+                self._cache_subject_term(i, cache_keys[i], residuals[i].detach())
+
         return residuals
 
+    def _get_residuals_cache_keys(self, individual_RER):
+        """
+        The residuals of a subject only depend on its latent positions, and on the template, control points and
+        principal directions: their setters bump the fixed effects version.
+        """
+        return self._get_subject_cache_keys(individual_RER['latent_positions'])
+
     def _compute_individual_attachments(self, residuals, device='cpu'):
         """
         Fully torch.
@@ -449,7 +481,8 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
 
             # Compute residuals ----------------------------------------------------------------------------------------
             residuals = [torch.sum(residuals_i)
-                         for residuals_i in self._compute_residuals(dataset, template_data, template_points, control_points, momenta, device=device)]
+                         for residuals_i in self._compute_residuals(dataset, template_data, template_points, control_points, momenta, device=device,
+                                                                    cache_keys=self._get_residuals_cache_keys(individual_RER))]
 
         # Compute sufficient statistics --------------------------------------------------------------------------------
         sufficient_statistics = {}
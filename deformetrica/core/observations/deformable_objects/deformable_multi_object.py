@@ -69,6 +69,9 @@ class DeformableMultiObject:
             assert len(image_object_list) == 1, 'That\'s unexpected.'
             image_object_list[0].set_intensities(data['image_intensities'])
 
+    def get_number_of_points(self):
+        return sum([elt.get_number_of_points() for elt in self.object_list])
+
     def get_points(self):
         """
         Gets the geometrical data that defines the deformable multi object, as a concatenated array.
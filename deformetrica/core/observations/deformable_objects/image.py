@@ -4,6 +4,7 @@ import nibabel as nib
 import numpy as np
 import torch
 
+from ....core import default
 from ....in_out.image_functions import rescale_image_intensities, points_to_voxels_transform
 from ....support import utilities
 
@@ -29,28 +30,48 @@ class Image:
     ####################################################################################################################
 
     # Constructor.
-    def __init__(self, intensities, intensities_dtype, affine):
+    def __init__(self, intensities, intensities_dtype, affine, intensities_filename=None):
+        """
+        intensities_filename is the .npy file the intensities are memory-mapped from, if any.
+        """
         self.dimension = len(intensities.shape)
         assert self.dimension in [2, 3], 'Ambient-space dimension must be either 2 or 3.'
 
         self.type = 'Image'
         self.is_modified = False
+        self.attachment_cache = {}  # device data of the object as an attachment target, see MultiObjectAttachment.
 
         self.intensities = intensities
         self.intensities_dtype = intensities_dtype
+        self.intensities_filename = intensities_filename
         self.affine = affine
 
         self.downsampling_factor = 1
+        self.interpolation = default.image_interpolation
 
         self._update_corner_point_positions()
         self.update_bounding_box()
 
+    def __getstate__(self):
+        # the attachment cache holds device tensors, that are rebuilt by each process.
+        state = self.__dict__.copy()
+        state['attachment_cache'] = {}
+        # memory-mapped intensities are mapped again from their file, instead of being copied.
+        if self.intensities_filename is not None:
+            state['intensities'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.intensities_filename is not None:
+            self.intensities = np.load(self.intensities_filename, mmap_mode='c')
+
     ####################################################################################################################
     ### Encapsulation methods:
     ####################################################################################################################
 
     def get_number_of_points(self):
-        raise RuntimeError("Not implemented for Image yet.")
+        return self.intensities.size
 
     def set_affine(self, affine_matrix):
         """
@@ -60,9 +81,11 @@ class Image:
         """
         self.affine = affine_matrix
 
-    def set_intensities(self, intensities):
+    def set_intensities(self, intensities, intensities_filename=None):
         self.is_modified = True
+        self.attachment_cache = {}
         self.intensities = intensities
+        self.intensities_filename = intensities_filename
 
     def get_intensities(self):
         return self.intensities
@@ -120,64 +143,74 @@ class Image:
                 else:
                     # Setting displacement to 0
                     deformed_voxels = make2DGrid(image_shape, deformed_voxels.device).permute(1,2,0)
-            u, v = deformed_voxels.view(-1, 2)[:, 0], deformed_voxels.view(-1, 2)[:, 1]
-
-            u1 = torch.floor(u.detach())
-            v1 = torch.floor(v.detach())
-
-            u1 = torch.clamp(u1, 0, image_shape[0] - 1)
-            v1 = torch.clamp(v1, 0, image_shape[1] - 1)
-            u2 = torch.clamp(u1 + 1, 0, image_shape[0] - 1)
-            v2 = torch.clamp(v1 + 1, 0, image_shape[1] - 1)
-
-            fu = u - u1
-            fv = v - v1
-            gu = (u1 + 1) - u
-            gv = (v1 + 1) - v
-            deformed_intensities = (intensities[u1.type(tensor_integer_type), v1.type(tensor_integer_type)] * gu * gv +
-                                    intensities[u1.type(tensor_integer_type), v2.type(tensor_integer_type)] * gu * fv +
-                                    intensities[u2.type(tensor_integer_type), v1.type(tensor_integer_type)] * fu * gv +
-                                    intensities[u2.type(tensor_integer_type), v2.type(tensor_integer_type)] * fu * fv).view(image_shape)
         elif self.dimension == 3:
             if not self.downsampling_factor == 1:
                 shape = deformed_points.shape
                 deformed_voxels = torch.nn.functional.interpolate(deformed_voxels.permute(3, 0, 1, 2).contiguous().view(1, shape[3], shape[0], shape[1], shape[2]),
                                                                   size=image_shape, mode='trilinear', align_corners=True)[0].permute(1, 2, 3, 0).contiguous()
 
-            u, v, w = deformed_voxels.view(-1, 3)[:, 0], \
-                      deformed_voxels.view(-1, 3)[:, 1], \
-                      deformed_voxels.view(-1, 3)[:, 2]
-
-            u1 = torch.floor(u.detach())
-            v1 = torch.floor(v.detach())
-            w1 = torch.floor(w.detach())
-
-            u1 = torch.clamp(u1, 0, image_shape[0] - 1)
-            v1 = torch.clamp(v1, 0, image_shape[1] - 1)
-            w1 = torch.clamp(w1, 0, image_shape[2] - 1)
-            u2 = torch.clamp(u1 + 1, 0, image_shape[0] - 1)
-            v2 = torch.clamp(v1 + 1, 0, image_shape[1] - 1)
-            w2 = torch.clamp(w1 + 1, 0, image_shape[2] - 1)
-
-            fu = u - u1
-            fv = v - v1
-            fw = w - w1
-            gu = (u1 + 1) - u
-            gv = (v1 + 1) - v
-            gw = (w1 + 1) - w
-
-            deformed_intensities = (intensities[u1.type(tensor_integer_type), v1.type(tensor_integer_type), w1.type(tensor_integer_type)] * gu * gv * gw +
-                                    intensities[u1.type(tensor_integer_type), v1.type(tensor_integer_type), w2.type(tensor_integer_type)] * gu * gv * fw +
-                                    intensities[u1.type(tensor_integer_type), v2.type(tensor_integer_type), w1.type(tensor_integer_type)] * gu * fv * gw +
-                                    intensities[u1.type(tensor_integer_type), v2.type(tensor_integer_type), w2.type(tensor_integer_type)] * gu * fv * fw +
-                                    intensities[u2.type(tensor_integer_type), v1.type(tensor_integer_type), w1.type(tensor_integer_type)] * fu * gv * gw +
-                                    intensities[u2.type(tensor_integer_type), v1.type(tensor_integer_type), w2.type(tensor_integer_type)] * fu * gv * fw +
-                                    intensities[u2.type(tensor_integer_type), v2.type(tensor_integer_type), w1.type(tensor_integer_type)] * fu * fv * gw +
-                                    intensities[u2.type(tensor_integer_type), v2.type(tensor_integer_type), w2.type(tensor_integer_type)] * fu * fv * fw).view(image_shape)
-
         else:
             raise RuntimeError('Incorrect dimension of the ambient space: %d' % self.dimension)
 
+        if self.interpolation == 'gather':
+            deformed_intensities = self._interpolate(intensities, deformed_voxels)
+
+        elif self.interpolation == 'legacy':
+            if self.dimension == 2:
+                u, v = deformed_voxels.view(-1, 2)[:, 0], deformed_voxels.view(-1, 2)[:, 1]
+
+                u1 = torch.floor(u.detach())
+                v1 = torch.floor(v.detach())
+
+                u1 = torch.clamp(u1, 0, image_shape[0] - 1)
+                v1 = torch.clamp(v1, 0, image_shape[1] - 1)
+                u2 = torch.clamp(u1 + 1, 0, image_shape[0] - 1)
+                v2 = torch.clamp(v1 + 1, 0, image_shape[1] - 1)
+
+                fu = u - u1
+                fv = v - v1
+                gu = (u1 + 1) - u
+                gv = (v1 + 1) - v
+                deformed_intensities = (intensities[u1.type(tensor_integer_type), v1.type(tensor_integer_type)] * gu * gv +
+                                        intensities[u1.type(tensor_integer_type), v2.type(tensor_integer_type)] * gu * fv +
+                                        intensities[u2.type(tensor_integer_type), v1.type(tensor_integer_type)] * fu * gv +
+                                        intensities[u2.type(tensor_integer_type), v2.type(tensor_integer_type)] * fu * fv).view(image_shape)
+
+            else:
+                u, v, w = deformed_voxels.view(-1, 3)[:, 0], \
+                          deformed_voxels.view(-1, 3)[:, 1], \
+                          deformed_voxels.view(-1, 3)[:, 2]
+
+                u1 = torch.floor(u.detach())
+                v1 = torch.floor(v.detach())
+                w1 = torch.floor(w.detach())
+
+                u1 = torch.clamp(u1, 0, image_shape[0] - 1)
+                v1 = torch.clamp(v1, 0, image_shape[1] - 1)
+                w1 = torch.clamp(w1, 0, image_shape[2] - 1)
+                u2 = torch.clamp(u1 + 1, 0, image_shape[0] - 1)
+                v2 = torch.clamp(v1 + 1, 0, image_shape[1] - 1)
+                w2 = torch.clamp(w1 + 1, 0, image_shape[2] - 1)
+
+                fu = u - u1
+                fv = v - v1
+                fw = w - w1
+                gu = (u1 + 1) - u
+                gv = (v1 + 1) - v
+                gw = (w1 + 1) - w
+
+                deformed_intensities = (intensities[u1.type(tensor_integer_type), v1.type(tensor_integer_type), w1.type(tensor_integer_type)] * gu * gv * gw +
+                                        intensities[u1.type(tensor_integer_type), v1.type(tensor_integer_type), w2.type(tensor_integer_type)] * gu * gv * fw +
+                                        intensities[u1.type(tensor_integer_type), v2.type(tensor_integer_type), w1.type(tensor_integer_type)] * gu * fv * gw +
+                                        intensities[u1.type(tensor_integer_type), v2.type(tensor_integer_type), w2.type(tensor_integer_type)] * gu * fv * fw +
+                                        intensities[u2.type(tensor_integer_type), v1.type(tensor_integer_type), w1.type(tensor_integer_type)] * fu * gv * gw +
+                                        intensities[u2.type(tensor_integer_type), v1.type(tensor_integer_type), w2.type(tensor_integer_type)] * fu * gv * fw +
+                                        intensities[u2.type(tensor_integer_type), v2.type(tensor_integer_type), w1.type(tensor_integer_type)] * fu * fv * gw +
+                                        intensities[u2.type(tensor_integer_type), v2.type(tensor_integer_type), w2.type(tensor_integer_type)] * fu * fv * fw).view(image_shape)
+
+        else:
+            raise RuntimeError('Unknown image interpolation: "%s"' % self.interpolation)
+
         return deformed_intensities
 
     ####################################################################################################################
@@ -221,6 +254,36 @@ class Image:
     ### Utility methods:
     ####################################################################################################################
 
+    def _interpolate(self, intensities, deformed_voxels):
+        """
+        Multilinear interpolation of the intensities at the deformed voxels, with the same conventions as the legacy
+        implementation. The flat indices of the 2 ** dimension corners are packed in a single tensor, so that all the
+        intensities are read with a single gather.
+        """
+        image_shape = self.intensities.shape
+        voxels = deformed_voxels.view(-1, self.dimension).t().contiguous()   # (dimension, N)
+        number_of_voxels = voxels.size(1)
+
+        upper_bounds = torch.tensor([[s - 1] for s in image_shape], dtype=voxels.dtype, device=voxels.device)
+        lower = torch.min(torch.clamp(torch.floor(voxels.detach()), min=0), upper_bounds)
+        upper = torch.min(lower + 1, upper_bounds)
+
+        # flat indices and weights of the lower and upper corners along each axis, of size (dimension, 2, N).
+        strides = torch.tensor([[int(np.prod(image_shape[d + 1:]))] for d in range(self.dimension)],
+                               dtype=torch.long, device=voxels.device)
+        axis_indices = torch.stack([lower.long() * strides, upper.long() * strides], 1)
+        axis_weights = torch.stack([(lower + 1) - voxels, voxels - lower], 1)
+
+        # flat indices and weights of all the corners, of size (2 ** dimension, N), the first axis varying slowest.
+        corner_indices = axis_indices[0]
+        corner_weights = axis_weights[0]
+        for d in range(1, self.dimension):
+            corner_indices = (corner_indices.unsqueeze(1) + axis_indices[d].unsqueeze(0)).view(-1, number_of_voxels)
+            corner_weights = (corner_weights.unsqueeze(1) * axis_weights[d].unsqueeze(0)).view(-1, number_of_voxels)
+
+        corner_intensities = intensities.contiguous().view(-1).index_select(0, corner_indices.view(-1))
+        return torch.sum(corner_intensities.view(-1, number_of_voxels) * corner_weights, 0).view(image_shape)
+
     def _update_corner_point_positions(self):
         if self.dimension == 2:
             corner_points = np.zeros((4, 2))
@@ -26,13 +26,19 @@ class Landmark:
 
         self.type = 'Landmark'
         self.is_modified = False
-        self.norm = None
+        self.attachment_cache = {}  # device data of the object as an attachment target, see MultiObjectAttachment.
 
         self.points = points
         self.connectivity = None
 
         self.update_bounding_box()
 
+    def __getstate__(self):
+        # the attachment cache holds device tensors, that are rebuilt by each process.
+        state = self.__dict__.copy()
+        state['attachment_cache'] = {}
+        return state
+
     ####################################################################################################################
     ### Encapsulation methods:
     ####################################################################################################################
@@ -45,11 +51,13 @@ class Landmark:
         Sets the list of points of the poly data, to save at the end.
         """
         self.is_modified = True
+        self.attachment_cache = {}
         self.points = points
 
     def set_connectivity(self, connectivity):
         self.connectivity = connectivity
         self.is_modified = True
+        self.attachment_cache = {}
 
     # Gets the geometrical data that defines the landmark object, as a matrix list.
     def get_points(self):
@@ -37,7 +37,8 @@ class PointCloud(Landmark):
                                  device='cpu'):
 
         centers = utilities.move_data(points, dtype=tensor_scalar_type, device=device)
-        normals = utilities.move_data(torch.ones(points.size(0), 1) / points.size(0),
+        # points may have leading batch dimensions.
+        normals = utilities.move_data(torch.ones(points.size()[:-1] + (1,)) / points.size(-2),
                                       device=device, dtype=tensor_scalar_type)
 
         assert torch.device(device) == centers.device == normals.device
@@ -40,8 +40,9 @@ class PolyLine(Landmark):
         points = utilities.move_data(points, dtype=tensor_scalar_type, device=device)
         segments = utilities.move_data(segments, dtype=tensor_integer_type, device=device)
 
-        a = points[segments[:, 0]]
-        b = points[segments[:, 1]]
+        # points may have leading batch dimensions.
+        a = points[..., segments[:, 0], :]
+        b = points[..., segments[:, 1], :]
         centers = (a + b) / 2.
         normals = b - a
 
@@ -18,15 +18,21 @@ class SurfaceMesh(Landmark):
     ### Constructor:
     ####################################################################################################################
 
-    def __init__(self, points, triangles):
+    def __init__(self, points, triangles, centers=None, normals=None):
+        """
+        The centers and normals of the triangles are computed, unless they are given, e.g. by a preprocessed cache.
+        """
         Landmark.__init__(self, points)
         self.type = 'SurfaceMesh'
 
         self.connectivity = triangles
 
         # All of these are torch tensor attributes.
-        self.centers, self.normals = SurfaceMesh._get_centers_and_normals(
-            torch.from_numpy(points), torch.from_numpy(triangles))
+        if centers is None or normals is None:
+            self.centers, self.normals = SurfaceMesh._get_centers_and_normals(
+                torch.from_numpy(points), torch.from_numpy(triangles))
+        else:
+            self.centers, self.normals = centers, normals
 
     ####################################################################################################################
     ### Public methods:
@@ -42,6 +48,7 @@ class SurfaceMesh(Landmark):
             new_connectivity = self.connectivity[triangles_to_keep.view(-1)]
             new_connectivity = np.copy(new_connectivity)
             self.connectivity = new_connectivity
+            self.attachment_cache = {}
 
             # Updating the centers and normals consequently.
             self.centers, self.normals = SurfaceMesh._get_centers_and_normals(
@@ -56,11 +63,12 @@ class SurfaceMesh(Landmark):
         points = utilities.move_data(points, dtype=tensor_scalar_type, device=device)
         triangles = utilities.move_data(triangles, dtype=tensor_integer_type, device=device)
 
-        a = points[triangles[:, 0]]
-        b = points[triangles[:, 1]]
-        c = points[triangles[:, 2]]
+        # points may have leading batch dimensions.
+        a = points[..., triangles[:, 0], :]
+        b = points[..., triangles[:, 1], :]
+        c = points[..., triangles[:, 2], :]
         centers = (a + b + c) / 3.
-        normals = torch.cross(b - a, c - a) / 2
+        normals = torch.cross(b - a, c - a, dim=-1) / 2
 
         assert torch.device(device) == centers.device == normals.device
         return centers, normals
@@ -5,35 +5,81 @@ import os.path
 
 import numpy as np
 
+from ..core import default
 
-def write_2D_array(array, output_dir, name, fmt='%f'):
+
+def _get_save_name(output_dir, name, file_format):
+    """
+    Path of the written array: in the binary format, the extension of the given name is replaced by .npy.
+    """
+    if file_format is None:
+        file_format = default.array_file_format
+    assert file_format in ['txt', 'npy'], 'Unknown array file format: ' + str(file_format)
+    if file_format == 'npy':
+        name = os.path.splitext(name)[0] + '.npy'
+    return os.path.join(output_dir, name), file_format
+
+
+def _get_read_name(name):
+    """
+    Path of the array to read: if the given text file does not exist, its binary counterpart is read instead.
+    """
+    if not os.path.isfile(name) and os.path.isfile(os.path.splitext(name)[0] + '.npy'):
+        return os.path.splitext(name)[0] + '.npy'
+    return name
+
+
+def _load_binary_array(name):
+    """
+    Loads a .npy file, or the single array of a .npz file.
+    """
+    if name.endswith('.npz'):
+        with np.load(name) as data:
+            assert len(data.files) == 1, 'Expecting a single array in ' + name
+            return data[data.files[0]]
+    return np.load(name)
+
+
+def write_2D_array(array, output_dir, name, fmt='%f', file_format=None):
     """
     Assuming 2-dim array here e.g. control points
     save_name = os.path.join(Settings().output_dir, name)
     np.savetxt(save_name, array)
+    The array is written in the given file format, 'txt' or 'npy' (binary, lossless), by default in
+    default.array_file_format. Returns the path of the written file.
     """
-    save_name = os.path.join(output_dir, name)
+    save_name, file_format = _get_save_name(output_dir, name, file_format)
     if len(array.shape) == 0:
         array = array.reshape(1,)
-    np.savetxt(save_name, array, fmt=fmt)
+    if file_format == 'npy':
+        np.save(save_name, array)
+    else:
+        np.savetxt(save_name, array, fmt=fmt)
+    return save_name
 
 
-def write_3D_array(array, output_dir, name):
+def write_3D_array(array, output_dir, name, file_format=None):
     """
     Saving an array has dim (numsubjects, numcps, dimension), using deformetrica format
+    The array is written in the given file format, 'txt' or 'npy' (binary, lossless), by default in
+    default.array_file_format. Returns the path of the written file.
     """
+    save_name, file_format = _get_save_name(output_dir, name, file_format)
+    if file_format == 'npy':
+        np.save(save_name, array)
+        return save_name
+
     s = array.shape
     if len(s) == 2:
         array = np.array([array])
-    save_name = os.path.join(output_dir, name)
+    # Enough significant digits to read back the exact values.
+    fmt = '%.9g' if array.dtype == np.float32 else '%.17g'
     with open(save_name, "w") as f:
         f.write(str(len(array)) + " " + str(len(array[0])) + " " + str(len(array[0, 0])) + "\n")
         for elt in array:
             f.write("\n")
-            for elt1 in elt:
-                for elt2 in elt1:
-                    f.write(str(elt2) + " ")
-                f.write("\n")
+            np.savetxt(f, elt, fmt=fmt)
+    return save_name
 
 
 def read_2D_list(path):
@@ -98,32 +144,36 @@ def flatten_3D_list(list3):
 def read_3D_array(name):
     """
     Loads a file containing momenta, old deformetrica syntax assumed
-    """
-    try:
-        with open(name, "r") as f:
-            lines = f.readlines()
-            line0 = [int(elt) for elt in lines[0].split()]
+    .npy and .npz files are loaded as such.
+    """
+    name = _get_read_name(name)
+    if name.endswith('.npy') or name.endswith('.npz'):
+        momenta = _load_binary_array(name)
+    else:
+        try:
+            with open(name, "r") as f:
+                line0 = [int(elt) for elt in f.readline().split()]
             nbSubjects, nbControlPoints, dimension = line0[0], line0[1], line0[2]
-            momenta = np.zeros((nbSubjects, nbControlPoints, dimension))
-            lines = lines[2:]
-            for i in range(nbSubjects):
-                for c in range(nbControlPoints):
-                    foo = lines[c].split()
-                    assert (len(foo) == dimension)
-                    foo = [float(elt) for elt in foo]
-                    momenta[i, c, :] = foo
-                lines = lines[1 + nbControlPoints:]
-        if momenta.shape[0] == 1:
-            return momenta[0]
-        else:
-            return momenta
-
-    except ValueError:
-        return read_2D_array(name)
+            # The blank lines separating the subjects are skipped.
+            momenta = np.loadtxt(name, skiprows=1, ndmin=2)
+            assert momenta.shape == (nbSubjects * nbControlPoints, dimension)
+            momenta = momenta.reshape((nbSubjects, nbControlPoints, dimension))
+
+        except ValueError:
+            return read_2D_array(name)
+
+    if momenta.ndim == 3 and momenta.shape[0] == 1:
+        return momenta[0]
+    else:
+        return momenta
 
 
 def read_2D_array(name):
     """
     Assuming 2-dim array here e.g. control points
+    .npy and .npz files are loaded as such.
     """
+    name = _get_read_name(name)
+    if name.endswith('.npy') or name.endswith('.npz'):
+        return _load_binary_array(name)
     return np.loadtxt(name)
@@ -1,9 +1,12 @@
 import logging
 import math
 import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 from torch.autograd import Variable
 
 from ..support import kernels as kernel_factory
@@ -17,27 +20,33 @@ from ..support.utilities.general_settings import Settings
 logger = logging.getLogger(__name__)
 
 
-def create_dataset(template_specifications, visit_ages=None, dataset_filenames=None, subject_ids=None, dimension=None):
+def create_dataset(template_specifications, visit_ages=None, dataset_filenames=None, subject_ids=None, dimension=None,
+                   number_of_loading_workers=default.number_of_loading_workers,
+                   dataset_cache_dir=default.dataset_cache_dir):
     """
     Creates a longitudinal dataset object from xml parameters. 
+    The visits are read by number_of_loading_workers processes if it is greater than 1, see _read_visits. If
+    dataset_cache_dir is given, the preprocessed landmark objects are cached in this directory, see
+    DeformableObjectReader.create_object.
     """
     deformable_objects_dataset = []
     if dataset_filenames is not None:
+        visits = []
         for i in range(len(dataset_filenames)):
-            deformable_objects_subject = []
             for j in range(len(dataset_filenames[i])):
-                object_list = []
-                reader = DeformableObjectReader()
+                visit = []
                 for object_id in template_specifications.keys():
                     if object_id not in dataset_filenames[i][j]:
                         raise RuntimeError('The template object with id ' + object_id + ' is not found for the visit '
                                            + str(j) + ' of subject ' + str(i) + '. Check the dataset xml.')
                     else:
                         object_type = template_specifications[object_id]['deformable_object_type']
-                        object_list.append(reader.create_object(dataset_filenames[i][j][object_id], object_type,
-                                                                dimension))
-                deformable_objects_subject.append(DeformableMultiObject(object_list))
-            deformable_objects_dataset.append(deformable_objects_subject)
+                        visit.append((dataset_filenames[i][j][object_id], object_type))
+                visits.append(visit)
+
+        multi_objects = iter(_read_visits(visits, dimension, number_of_loading_workers, dataset_cache_dir))
+        for i in range(len(dataset_filenames)):
+            deformable_objects_dataset.append([next(multi_objects) for _ in range(len(dataset_filenames[i]))])
 
     longitudinal_dataset = LongitudinalDataset(
         subject_ids, times=visit_ages, deformable_objects=deformable_objects_dataset)
@@ -45,6 +54,40 @@ def create_dataset(template_specifications, visit_ages=None, dataset_filenames=N
     return longitudinal_dataset
 
 
+def _read_visit(visit, dimension, dataset_cache_dir):
+    """
+    Reads the (filename, object type) pairs of a visit into a deformable multi object.
+    """
+    reader = DeformableObjectReader()
+    return DeformableMultiObject([reader.create_object(object_filename, object_type, dimension,
+                                                       cache_dir=dataset_cache_dir)
+                                  for object_filename, object_type in visit])
+
+
+def _read_visits(visits, dimension, number_of_loading_workers, dataset_cache_dir):
+    """
+    Yields the deformable multi objects of the given visits, in order. With several workers, the visits are read by a
+    pool of processes (the VTK readers hold the GIL), with at most a few visits per worker read ahead of the consumer,
+    which bounds the memory held by the pending results.
+    """
+    if number_of_loading_workers <= 1 or len(visits) <= 1:
+        for visit in visits:
+            yield _read_visit(visit, dimension, dataset_cache_dir)
+        return
+
+    prefetch = 2 * number_of_loading_workers
+    # The spawned processes read the images with the dtype of this process.
+    with ProcessPoolExecutor(max_workers=number_of_loading_workers, mp_context=mp.get_context('spawn'),
+                             initializer=default.update_dtype, initargs=(default.dtype,)) as executor:
+        pending = deque()
+        for visit in visits:
+            pending.append(executor.submit(_read_visit, visit, dimension, dataset_cache_dir))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
 def create_scalar_dataset(group, observations, timepoints):
     """
     Builds a dataset from the given data.
@@ -218,6 +261,10 @@ def create_template_metadata(template_specifications, dimension=None, gpu_mode=N
         if object_type == 'image' and 'downsampling_factor' in list(object.keys()):
             objects_list[-1].downsampling_factor = object['downsampling_factor']
 
+        # Optional interpolation method for image data.
+        if object_type == 'image' and 'interpolation' in list(object.keys()):
+            objects_list[-1].interpolation = object['interpolation']
+
     multi_object_attachment = MultiObjectAttachment(objects_norm, objects_norm_kernels)
 
     return objects_list, objects_name, objects_name_extension, objects_noise_variance, multi_object_attachment
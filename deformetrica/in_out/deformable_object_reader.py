@@ -1,16 +1,20 @@
+import hashlib
 import logging
 import warnings
 import os
+import tempfile
 
 # Image readers
 import PIL.Image as pimg
 import nibabel as nib
 import numpy as np
+import torch
 
 # Mesh readers
 from vtk import vtkPolyDataReader, vtkSTLReader
 from vtk.util import numpy_support as nps
 
+from ..core import default
 from ..core.observations.deformable_objects.image import Image
 from ..core.observations.deformable_objects.landmarks.landmark import Landmark
 from ..core.observations.deformable_objects.landmarks.point_cloud import PointCloud
@@ -30,9 +34,22 @@ class DeformableObjectReader:
 
     connectivity_degrees = {'LINES': 2, 'VERTICES': 2, 'POLYGONS': 3}
 
+    # Version of the preprocessed cache format, part of the cache keys.
+    cache_version = 1
+
     # Create a PyDeformetrica object from specified filename and object type.
     @staticmethod
-    def create_object(object_filename, object_type, dimension=None):
+    def create_object(object_filename, object_type, dimension=None, cache_dir=None):
+        """
+        If cache_dir is given, the points, cleaned connectivity, centers and normals of the landmark types are read
+        from and written to a preprocessed cache in this directory, see _create_cached_object. The normalized
+        intensities of the images are cached as well, and memory-mapped, see _create_cached_image.
+        """
+        if cache_dir is not None and object_type.lower() in [
+                'SurfaceMesh'.lower(), 'PolyLine'.lower(), 'PointCloud'.lower(), 'Landmark'.lower()]:
+            return DeformableObjectReader._create_cached_object(object_filename, object_type, dimension, cache_dir)
+        elif cache_dir is not None and object_type.lower() == 'Image'.lower():
+            return DeformableObjectReader._create_cached_image(object_filename, dimension, cache_dir)
 
         if object_type.lower() in ['SurfaceMesh'.lower(), 'PolyLine'.lower(), 'PointCloud'.lower(), 'Landmark'.lower()]:
 
@@ -88,8 +105,9 @@ class DeformableObjectReader:
                 img_affine = np.eye(dimension + 1)
 
             elif object_filename.find(".nii") > 0 or object_filename.find(".nii.gz") > 0:
+                # The header is read first, and the voxels only through the array proxy.
                 img = nib.load(object_filename)
-                img_data = img.get_data()
+                img_data = np.asanyarray(img.dataobj)
                 dimension = len(img_data.shape)
                 img_affine = img.affine
                 assert len(img_data.shape) == 3, "Multi-channel images not available (yet!)."
@@ -113,6 +131,116 @@ class DeformableObjectReader:
 
         return out_object
 
+    @staticmethod
+    def get_cache_filename(object_filename, object_type, dimension, cache_dir):
+        """
+        The cache entries are keyed by the absolute path, modification time and size of the file, the object type
+        and the dimension: a modified file is read again. The normalized intensities of the images also depend on
+        the dtype.
+        """
+        stat = os.stat(object_filename)
+        key = [os.path.abspath(object_filename), stat.st_mtime_ns, stat.st_size, object_type.lower(), dimension,
+               DeformableObjectReader.cache_version]
+        if object_type.lower() == 'Image'.lower():
+            key.append(default.dtype)
+        key = '|'.join(str(elt) for elt in key)
+        return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+
+    @staticmethod
+    def _create_cached_object(object_filename, object_type, dimension, cache_dir):
+        cache_filename = DeformableObjectReader.get_cache_filename(object_filename, object_type, dimension, cache_dir)
+
+        if os.path.isfile(cache_filename):
+            try:
+                with np.load(cache_filename) as data:
+                    arrays = {key: data[key] for key in data.files}
+                return DeformableObjectReader._object_from_arrays(object_type, arrays)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning('Could not read the cache file ' + cache_filename + ' of ' + object_filename + ': '
+                               + str(e) + '. Reading the object again.')
+
+        out_object = DeformableObjectReader.create_object(object_filename, object_type, dimension)
+
+        arrays = {'points': out_object.points}
+        if out_object.connectivity is not None:
+            arrays['connectivity'] = out_object.connectivity
+        if object_type.lower() == 'SurfaceMesh'.lower():
+            arrays['centers'] = out_object.centers.numpy()
+            arrays['normals'] = out_object.normals.numpy()
+
+        DeformableObjectReader._write_cache_file(cache_filename, lambda f: np.savez(f, **arrays))
+        return out_object
+
+    @staticmethod
+    def _create_cached_image(object_filename, dimension, cache_dir):
+        """
+        The normalized intensities are written once to a .npy file, next to a .npz file holding the original dtype and
+        the affine. They are then opened as a copy-on-write memory map: the processes reading the same image share the
+        pages of the OS page cache, and pickled images only carry the file name, see Image.__getstate__.
+        """
+        cache_filename = DeformableObjectReader.get_cache_filename(object_filename, 'Image', dimension, cache_dir)
+        intensities_filename = os.path.splitext(cache_filename)[0] + '.npy'
+
+        if os.path.isfile(cache_filename) and os.path.isfile(intensities_filename):
+            try:
+                with np.load(cache_filename) as data:
+                    intensities_dtype, affine = str(data['intensities_dtype']), data['affine']
+                return Image(np.load(intensities_filename, mmap_mode='c'), intensities_dtype, affine,
+                             intensities_filename=intensities_filename)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning('Could not read the cache files of ' + object_filename + ': ' + str(e)
+                               + '. Reading the image again.')
+
+        out_object = DeformableObjectReader.create_object(object_filename, 'Image', dimension)
+
+        # The metadata file is written last: it marks a complete cache entry.
+        if DeformableObjectReader._write_cache_file(intensities_filename,
+                                                    lambda f: np.save(f, out_object.intensities)) \
+                and DeformableObjectReader._write_cache_file(
+                    cache_filename, lambda f: np.savez(f, intensities_dtype=out_object.intensities_dtype,
+                                                       affine=out_object.affine)):
+            return Image(np.load(intensities_filename, mmap_mode='c'), out_object.intensities_dtype, out_object.affine,
+                         intensities_filename=intensities_filename)
+        return out_object
+
+    @staticmethod
+    def _write_cache_file(cache_filename, write_function):
+        """
+        Writes a cache file through a temporary file, so that concurrent runs never read a partial one.
+        Returns whether the file could be written.
+        """
+        cache_dir = os.path.dirname(cache_filename)
+        os.makedirs(cache_dir, exist_ok=True)
+        file_descriptor, temporary_filename = tempfile.mkstemp(dir=cache_dir, suffix=os.path.splitext(cache_filename)[1])
+        try:
+            with os.fdopen(file_descriptor, 'wb') as f:
+                write_function(f)
+            os.replace(temporary_filename, cache_filename)
+            return True
+        except OSError as e:
+            logger.warning('Could not write the cache file ' + cache_filename + ': ' + str(e))
+            if os.path.isfile(temporary_filename):
+                os.remove(temporary_filename)
+            return False
+
+    @staticmethod
+    def _object_from_arrays(object_type, arrays):
+        points = arrays['points']
+        connectivity = arrays.get('connectivity')
+
+        if object_type.lower() == 'SurfaceMesh'.lower():
+            return SurfaceMesh(points, connectivity, centers=torch.from_numpy(arrays['centers']),
+                               normals=torch.from_numpy(arrays['normals']))
+        elif object_type.lower() == 'PolyLine'.lower():
+            return PolyLine(points, connectivity)
+        elif object_type.lower() == 'PointCloud'.lower():
+            return PointCloud(points, connectivity)
+        else:
+            out_object = Landmark(points)
+            if connectivity is not None:
+                out_object.set_connectivity(connectivity)
+            return out_object
+
     @staticmethod
     def read_file(filename, dimension=None, extract_connectivity=False):
         """
@@ -14,6 +14,8 @@ def get_dataset_specifications(xml_parameters):
     specifications['visit_ages'] = xml_parameters.visit_ages
     specifications['dataset_filenames'] = xml_parameters.dataset_filenames
     specifications['subject_ids'] = xml_parameters.subject_ids
+    specifications['number_of_loading_workers'] = xml_parameters.number_of_loading_workers
+    specifications['dataset_cache_dir'] = xml_parameters.dataset_cache_dir
     return specifications
 
 
@@ -50,6 +52,7 @@ def get_estimator_options(xml_parameters):
     options['convergence_tolerance'] = xml_parameters.convergence_tolerance
     options['print_every_n_iters'] = xml_parameters.print_every_n_iters
     options['save_every_n_iters'] = xml_parameters.save_every_n_iters
+    options['use_asynchronous_writer'] = xml_parameters.use_asynchronous_writer
     options['gpu_mode'] = xml_parameters.gpu_mode
     options['state_file'] = xml_parameters.state_file
     options['load_state_file'] = xml_parameters.load_state_file
@@ -67,6 +70,11 @@ def get_model_options(xml_parameters):
         'concentration_of_time_points': xml_parameters.concentration_of_time_points,
         'use_rk2_for_shoot': xml_parameters.use_rk2_for_shoot,
         'use_rk2_for_flow': xml_parameters.use_rk2_for_flow,
+        'adaptive_step_tolerance': xml_parameters.adaptive_step_tolerance,
+        'use_grid_image_flow': xml_parameters.use_grid_image_flow,
+        'use_batched_exponential': xml_parameters.use_batched_exponential,
+        'visit_deduplication_tolerance': xml_parameters.visit_deduplication_tolerance,
+        'concurrent_geodesic_integration': xml_parameters.concurrent_geodesic_integration,
         'freeze_template': xml_parameters.freeze_template,
         'freeze_control_points': xml_parameters.freeze_control_points,
         'freeze_momenta': xml_parameters.freeze_momenta,
@@ -79,9 +87,11 @@ def get_model_options(xml_parameters):
         'dense_mode': xml_parameters.dense_mode,
         'number_of_processes': xml_parameters.number_of_processes,
         'downsampling_factor': xml_parameters.downsampling_factor,
+        'image_interpolation': xml_parameters.image_interpolation,
         'dimension': xml_parameters.dimension,
         'gpu_mode': xml_parameters.gpu_mode,
         'dtype': xml_parameters.dtype,
+        'array_file_format': xml_parameters.array_file_format,
         'tensor_scalar_type': utilities.get_torch_scalar_type(dtype=xml_parameters.dtype),
         'tensor_integer_type': utilities.get_torch_integer_type(dtype=xml_parameters.dtype),
         'random_seed': xml_parameters.random_seed
@@ -139,6 +149,7 @@ class XmlParameters:
 
     def __init__(self):
         self.dtype = default.dtype
+        self.array_file_format = default.array_file_format
         self.random_seed = default.random_seed
         self.tensor_scalar_type = default.tensor_scalar_type
         self.tensor_integer_type = default.tensor_scalar_type
@@ -153,6 +164,11 @@ class XmlParameters:
         self.number_of_sources = default.number_of_sources
         self.use_rk2_for_shoot = default.use_rk2_for_shoot
         self.use_rk2_for_flow = default.use_rk2_for_flow
+        self.adaptive_step_tolerance = default.adaptive_step_tolerance
+        self.use_grid_image_flow = default.use_grid_image_flow
+        self.use_batched_exponential = default.use_batched_exponential
+        self.visit_deduplication_tolerance = default.visit_deduplication_tolerance
+        self.concurrent_geodesic_integration = default.concurrent_geodesic_integration
         self.t0 = None
         self.tmin = default.tmin
         self.tmax = default.tmax
@@ -167,9 +183,12 @@ class XmlParameters:
         self.optimization_method_type = default.optimization_method_type
         self.optimized_log_likelihood = default.optimized_log_likelihood
         self.number_of_processes = default.number_of_processes
+        self.number_of_loading_workers = default.number_of_loading_workers
+        self.dataset_cache_dir = default.dataset_cache_dir
         self.max_iterations = default.max_iterations
         self.max_line_search_iterations = default.max_line_search_iterations
         self.save_every_n_iters = default.save_every_n_iters
+        self.use_asynchronous_writer = default.use_asynchronous_writer
         self.print_every_n_iters = default.print_every_n_iters
         self.sample_every_n_mcmc_iters = default.sample_every_n_mcmc_iters
         self.use_sobolev_gradient = default.use_sobolev_gradient
@@ -182,6 +201,7 @@ class XmlParameters:
         self.memory_length = default.memory_length
         self.scale_initial_step_size = default.scale_initial_step_size
         self.downsampling_factor = default.downsampling_factor
+        self.image_interpolation = default.image_interpolation
 
         self.dense_mode = default.dense_mode
 
@@ -275,6 +295,9 @@ class XmlParameters:
             elif model_xml_level1.tag.lower() == 'dimension':
                 self.dimension = int(model_xml_level1.text)
 
+            elif model_xml_level1.tag.lower() == 'array-file-format':
+                self.array_file_format = model_xml_level1.text.lower()
+
             elif model_xml_level1.tag.lower() == 'dtype':
                 self.dtype = model_xml_level1.text.lower()
                 self.tensor_scalar_type = utilities.get_torch_scalar_type(dtype=self.dtype)
@@ -491,6 +514,12 @@ class XmlParameters:
                     self.optimized_log_likelihood = optimization_parameters_xml_level1.text.lower()
                 elif optimization_parameters_xml_level1.tag.lower() == 'number-of-processes':
                     self.number_of_processes = int(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'number-of-loading-workers':
+                    self.number_of_loading_workers = int(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'dataset-cache-dir':
+                    self.dataset_cache_dir = os.path.normpath(
+                        os.path.join(os.path.dirname(optimization_parameters_xml_path),
+                                     optimization_parameters_xml_level1.text))
                 elif optimization_parameters_xml_level1.tag.lower() == 'max-iterations':
                     self.max_iterations = int(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'convergence-tolerance':
@@ -499,8 +528,12 @@ class XmlParameters:
                     self.memory_length = int(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'downsampling-factor':
                     self.downsampling_factor = int(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'image-interpolation':
+                    self.image_interpolation = optimization_parameters_xml_level1.text.lower()
                 elif optimization_parameters_xml_level1.tag.lower() == 'save-every-n-iters':
                     self.save_every_n_iters = int(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'use-asynchronous-writer':
+                    self.use_asynchronous_writer = self._on_off_to_bool(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'print-every-n-iters':
                     self.print_every_n_iters = int(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'sample-every-n-mcmc-iters':
@@ -531,6 +564,16 @@ class XmlParameters:
                 elif optimization_parameters_xml_level1.tag.lower() == 'use-rk2':
                     self.use_rk2_for_shoot = self._on_off_to_bool(optimization_parameters_xml_level1.text)
                     self.use_rk2_for_flow = self._on_off_to_bool(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'adaptive-step-tolerance':
+                    self.adaptive_step_tolerance = float(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'use-grid-image-flow':
+                    self.use_grid_image_flow = self._on_off_to_bool(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'use-batched-exponential':
+                    self.use_batched_exponential = self._on_off_to_bool(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'visit-deduplication-tolerance':
+                    self.visit_deduplication_tolerance = float(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'concurrent-geodesic-integration':
+                    self.concurrent_geodesic_integration = self._on_off_to_bool(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'momenta-proposal-std':
                     self.momenta_proposal_std = float(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'onset-age-proposal-std':
@@ -1,3 +1,5 @@
+import threading
+from collections import OrderedDict
 from enum import Enum
 
 from ...core import default
@@ -14,11 +16,56 @@ class Type(Enum):
     KEOPS = KeopsKernel
 
 
-instance_map = dict()
+class InstanceCache:
+    """
+    Thread-safe, size-bounded (least recently used) cache of kernel instances.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._instances = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, constructor):
+        with self._lock:
+            if key in self._instances:
+                self.hits += 1
+                self._instances.move_to_end(key)
+                return self._instances[key]
+
+            self.misses += 1
+            res = constructor()
+            self._instances[key] = res
+
+            maxsize = self.maxsize if self.maxsize is not None else default.kernel_cache_size
+            while len(self._instances) > max(maxsize, 0):
+                self._instances.popitem(last=False)
+
+            return res
+
+    def clear(self):
+        with self._lock:
+            self._instances.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._instances),
+                    'maxsize': self.maxsize if self.maxsize is not None else default.kernel_cache_size}
+
+    def __len__(self):
+        return len(self._instances)
+
+
+instance_map = InstanceCache()
 
 
 def factory(kernel_type, cuda_type=None, gpu_mode=None, *args, **kwargs):
-    """Return an instance of a kernel corresponding to the requested kernel_type"""
+    """Return an instance of a kernel corresponding to the requested kernel_type.
+    Instances are cached: requesting twice the same kernel returns the same (shared) instance."""
     if cuda_type is None:
         cuda_type = default.dtype
     if gpu_mode is None:
@@ -39,14 +86,34 @@ def factory(kernel_type, cuda_type=None, gpu_mode=None, *args, **kwargs):
     if kernel_type in [Type.UNDEFINED, Type.NO_KERNEL]:
         return None
 
-    # res = None
-    # hash = AbstractKernel.hash(kernel_type, cuda_type, gpu_mode, *args, **kwargs)
-    # if hash not in instance_map:
-    #     res = kernel_type.value(gpu_mode=gpu_mode, cuda_type=cuda_type, *args, **kwargs)    # instantiate
-    #     instance_map[hash] = res
-    # else:
-    #     res = instance_map[hash]
-    res = kernel_type.value(gpu_mode=gpu_mode, cuda_type=cuda_type, *args, **kwargs)
+    if 'freeze_DOFs' in kwargs and isinstance(kwargs['freeze_DOFs'], list):
+        kwargs['freeze_DOFs'] = tuple(kwargs['freeze_DOFs'])
+
+    def instantiate():
+        instance = kernel_type.value(gpu_mode=gpu_mode, cuda_type=cuda_type, *args, **kwargs)
+        instance.factory_arguments = (kernel_type.name, cuda_type, gpu_mode, args, kwargs)
+        return instance
+
+    key = AbstractKernel.hash(kernel_type, cuda_type, gpu_mode, *args, **kwargs)
+    if key is None:
+        # unhashable arguments: the instance cannot be shared.
+        res = instantiate()
+    else:
+        res = instance_map.get(key, instantiate)
 
     assert res is not None
     return res
+
+
+def cache_info():
+    """Return the hits/misses statistics and the current size of the kernel instance cache."""
+    return instance_map.info()
+
+
+def clear_cache():
+    instance_map.clear()
+
+
+def _rebuild(kernel_type, cuda_type, gpu_mode, args, kwargs):
+    """Used when unpickling or deep-copying a kernel, so that the cached instance is re-used when available."""
+    return factory(Type[kernel_type], cuda_type, gpu_mode, *args, **kwargs)
@@ -1,4 +1,6 @@
+import math
 from abc import ABC, abstractmethod
+import numpy as np
 import torch
 
 from ...core import default
@@ -12,6 +14,8 @@ class AbstractKernel(ABC):
         self.kernel_type = kernel_type
         self.kernel_width = kernel_width
         self.gpu_mode = gpu_mode
+        # arguments given to the kernel factory, used to retrieve the cached instance when unpickling.
+        self.factory_arguments = None
         logger.debug('instantiating kernel %s with kernel_width %s and gpu_mode %s. addr: %s',
                      self.kernel_type, self.kernel_width, self.gpu_mode, hex(id(self)))
 
@@ -22,10 +26,28 @@ class AbstractKernel(ABC):
 
     @staticmethod
     def hash(kernel_type, cuda_type, gpu_mode, *args, **kwargs):
-        return hash((kernel_type, cuda_type, gpu_mode, frozenset(args), frozenset(kwargs.items())))
+        """
+        Returns the key identifying a kernel instance, i.e. (type, width, dtype, gpu_mode, freeze_DOFs, other options),
+        or None if some of the given arguments are not hashable.
+        """
+        kernel_width = kwargs.pop('kernel_width', None)
+        freeze_DOFs = kwargs.pop('freeze_DOFs', None)
+        key = (kernel_type, kernel_width, cuda_type, gpu_mode, freeze_DOFs, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
     def __hash__(self, **kwargs):
-        return AbstractKernel.hash(self.kernel_type, None, self.gpu_mode, **kwargs)
+        return hash(AbstractKernel.hash(self.kernel_type, None, self.gpu_mode, kernel_width=self.kernel_width, **kwargs))
+
+    def __reduce_ex__(self, protocol):
+        if self.factory_arguments is None:
+            return super().__reduce_ex__(protocol)
+
+        from ...support.kernels import _rebuild
+        return _rebuild, self.factory_arguments
 
     @abstractmethod
     def convolve(self, x, y, p, mode=None):
@@ -35,6 +57,88 @@ class AbstractKernel(ABC):
     def convolve_gradient(self, px, x, y=None, py=None):
         raise NotImplementedError
 
+    def convolve_and_gradient(self, x, p):
+        """
+        Returns both convolve(x, x, p) and convolve_gradient(p, x), i.e. the right-hand sides of the geodesic equations
+        for the control points and the momenta. Implementations evaluate the kernel only once for both outputs.
+        """
+        return self.convolve(x, x, p), self.convolve_gradient(p, x)
+
+    def batched_convolve(self, x, y, p, mode='gaussian'):
+        """
+        Batched version of convolve.
+        x is of size (S, M, D), y of size (S, N, D) and p of size (S, N, .) ; output is of size (S, M, .).
+        In varifold mode, x and y are tuples of batched (points, unit normals).
+        The default implementation loops over the batch dimension.
+        """
+        if mode == 'varifold':
+            return torch.stack([self.convolve((x_s, nx_s), (y_s, ny_s), p_s, mode=mode)
+                                for x_s, nx_s, y_s, ny_s, p_s in zip(x[0], x[1], y[0], y[1], p)])
+        return torch.stack([self.convolve(x_s, y_s, p_s, mode=mode) for x_s, y_s, p_s in zip(x, y, p)])
+
+    def batched_convolve_and_gradient(self, x, p):
+        """
+        Batched version of convolve_and_gradient: x and p are of size (S, N, D).
+        The default implementation loops over the batch dimension.
+        """
+        res = [self.convolve_and_gradient(x_s, p_s) for x_s, p_s in zip(x, p)]
+        return torch.stack([r[0] for r in res]), torch.stack([r[1] for r in res])
+
+    def grid_convolve(self, grid_points, y, p, truncation=default.grid_convolution_truncation):
+        """
+        Approximation of convolve(grid_points, y, p) when grid_points is a regular, axis-aligned grid of size
+        (n_1, ..., n_D, D), such as the points of an image. The vectors p carried by y are splatted with multilinear
+        weights onto the grid extended by the kernel support, which is then convolved with the separable Gaussian
+        truncated at truncation * kernel_width: the cost grows with the number of grid points instead of their product
+        with the number of points y. The splatting error decreases with the ratio of the grid spacing to the kernel
+        width. Output is of size (n_1, ..., n_D, .).
+        """
+        dimension = grid_points.size(-1)
+        shape = tuple(grid_points.size()[:-1])
+        assert len(shape) == dimension, 'The grid points must be of size (n_1, ..., n_D, D).'
+
+        origin = grid_points[(0,) * dimension]
+        spacing = grid_points[tuple(n - 1 for n in shape)] - origin
+        spacing = torch.stack([spacing[d] / (shape[d] - 1) if shape[d] > 1 else torch.ones_like(spacing[d])
+                               for d in range(dimension)])
+        radii = [int(math.ceil(truncation * self.kernel_width / abs(float(h)))) for h in spacing]
+
+        # Lattice coordinates of the points y. The grid is only extended towards the points y, within the radii.
+        u = (y - origin) / spacing
+        u_min = torch.floor(torch.min(u.detach(), dim=0)[0]).long().tolist()
+        u_max = torch.floor(torch.max(u.detach(), dim=0)[0]).long().tolist()
+        pads = [(min(max(- u_min[d], 0), radii[d]), min(max(u_max[d] + 2 - shape[d], 0), radii[d]))
+                for d in range(dimension)]
+        extended_shape = [n + pad[0] + pad[1] for n, pad in zip(shape, pads)]
+
+        u = u + torch.tensor([pad[0] for pad in pads], dtype=u.dtype, device=u.device)
+        lower = torch.floor(u.detach()).long()
+        fractions = u - lower.to(u.dtype)
+        extended_shape_t = torch.tensor(extended_shape, device=u.device)
+        strides = torch.tensor([int(np.prod(extended_shape[d + 1:])) for d in range(dimension)], device=u.device)
+
+        # Multilinear splatting of p on the corners of the cells containing the points y.
+        lattice = torch.zeros(int(np.prod(extended_shape)), p.size(-1), dtype=p.dtype, device=p.device)
+        for corner in range(2 ** dimension):
+            offsets = torch.tensor([(corner >> d) & 1 for d in range(dimension)], device=u.device)
+            indices = lower + offsets
+            weights = torch.prod(torch.where(offsets.bool(), fractions, 1. - fractions), dim=1)
+            inside = torch.all((indices >= 0) & (indices < extended_shape_t), dim=1)
+            lattice = lattice.index_add(0, torch.sum(indices[inside] * strides, dim=1),
+                                        weights[inside].unsqueeze(1) * p[inside])
+
+        # Separable convolution, one axis at a time, back to the grid along each axis.
+        field = lattice.view(*extended_shape, p.size(-1))
+        for d in range(dimension):
+            offsets = torch.arange(- radii[d], radii[d] + 1, dtype=p.dtype, device=p.device) * spacing[d]
+            weights = torch.exp(- offsets ** 2 / self.kernel_width ** 2).view(1, 1, -1)
+            field = torch.nn.functional.pad(field.movedim(d, -1), (radii[d] - pads[d][0], radii[d] - pads[d][1]))
+            size = field.size()
+            field = torch.nn.functional.conv1d(field.reshape(-1, 1, size[-1]), weights)
+            field = field.view(*size[:-1], shape[d]).movedim(-1, d)
+
+        return field
+
     def get_kernel_matrix(self, x, y=None):
         """
         returns the kernel matrix, A_{ij} = exp(-|x_i-x_j|^2/sigma^2)
@@ -53,6 +157,14 @@ class AbstractKernel(ABC):
         dist = x_norm + y_norm - 2.0 * torch.mm(x, torch.transpose(y, 0, 1))
         return dist
 
+    @staticmethod
+    def _batched_squared_distances(x, y):
+        x_norm = (x ** 2).sum(2).unsqueeze(2)
+        y_norm = (y ** 2).sum(2).unsqueeze(1)
+
+        dist = x_norm + y_norm - 2.0 * torch.bmm(x, torch.transpose(y, 1, 2))
+        return dist
+
     @staticmethod
     def _move_to_device(t, gpu_mode):
         """
@@ -1,3 +1,4 @@
+import threading
 import torch
 
 from ...support.kernels import AbstractKernel
@@ -9,6 +10,41 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# KeOps formulas and their arguments, for each kernel mode. '{d}' stands for the dimension of the ambient space.
+_formulas = {
+    'gaussian': ("Exp(-G*SqDist(X,Y)) * P",
+                 ["G = Pm(1)", "X = Vi({d})", "Y = Vj({d})", "P = Vj({d})"]),
+    'pointcloud': ("Exp(-G*SqDist(X,Y)) * P",
+                   ["G = Pm(1)", "X = Vi({d})", "Y = Vj({d})", "P = Vj(1)"]),
+    'varifold': ("Exp(-(WeightedSqDist(G, X, Y))) * Square((Nx|Ny)) * P",
+                 ["G = Pm(1)", "X = Vi({d})", "Y = Vj({d})", "Nx = Vi({d})", "Ny = Vj({d})", "P = Vj(1)"]),
+    'gaussian_gradient_x': ("(Px|Py) * Exp(-G*SqDist(X,Y)) * (X-Y)",
+                            ["G = Pm(1)", "X = Vi({d})", "Y = Vj({d})", "Px = Vi({d})", "Py = Vj({d})"]),
+    'gaussian_and_gradient_x': ("Concat(Exp(-G*SqDist(X,Y)) * Q, (Px|Py) * Exp(-G*SqDist(X,Y)) * (X-Y))",
+                                ["G = Pm(1)", "X = Vi({d})", "Y = Vj({d})", "Px = Vi({d})", "Py = Vj({d})",
+                                 "Q = Vj({d})"]),
+}
+
+# Process-wide registry of the Genred reductions, shared by all the KeopsKernel instances.
+_reductions = {}
+_reductions_lock = threading.Lock()
+
+
+def get_reduction(mode, dimension, cuda_type):
+    """
+    Returns the Genred reduction corresponding to the given (mode, dimension, cuda_type).
+    Reductions are created on first use only, and are then shared across kernel instances.
+    """
+    key = (mode, dimension, cuda_type)
+    with _reductions_lock:
+        if key not in _reductions:
+            formula, aliases = _formulas[mode]
+            logger.debug('creating keops reduction for mode=%s, dimension=%d, cuda_type=%s' % key)
+            _reductions[key] = Genred(formula, [alias.format(d=dimension) for alias in aliases],
+                                      reduction_op='Sum', axis=1, cuda_type=cuda_type)
+        return _reductions[key]
+
+
 class KeopsKernel(AbstractKernel):
     def __init__(self, gpu_mode=default.gpu_mode, kernel_width=None, cuda_type=None, freeze_DOFs=None, **kwargs):
         super().__init__('keops', gpu_mode, kernel_width)
@@ -20,48 +56,8 @@ class KeopsKernel(AbstractKernel):
 
         self.gamma = 1. / default.tensor_scalar_type([self.kernel_width ** 2])
 
-        self.gaussian_convolve = []
-        self.point_cloud_convolve = []
-        self.varifold_convolve = []
-        self.gaussian_convolve_gradient_x = []
         self.freeze_DOFs = freeze_DOFs
 
-        for dimension in [2, 3]:
-            self.gaussian_convolve.append(Genred(
-                "Exp(-G*SqDist(X,Y)) * P",
-                ["G = Pm(1)",
-                 "X = Vi(" + str(dimension) + ")",
-                 "Y = Vj(" + str(dimension) + ")",
-                 "P = Vj(" + str(dimension) + ")"],
-                reduction_op='Sum', axis=1, cuda_type=cuda_type))
-
-            self.point_cloud_convolve.append(Genred(
-                "Exp(-G*SqDist(X,Y)) * P",
-                ["G = Pm(1)",
-                 "X = Vi(" + str(dimension) + ")",
-                 "Y = Vj(" + str(dimension) + ")",
-                 "P = Vj(1)"],
-                reduction_op='Sum', axis=1, cuda_type=cuda_type))
-
-            self.varifold_convolve.append(Genred(
-                "Exp(-(WeightedSqDist(G, X, Y))) * Square((Nx|Ny)) * P",
-                ["G = Pm(1)",
-                 "X = Vi(" + str(dimension) + ")",
-                 "Y = Vj(" + str(dimension) + ")",
-                 "Nx = Vi(" + str(dimension) + ")",
-                 "Ny = Vj(" + str(dimension) + ")",
-                 "P = Vj(1)"],
-                reduction_op='Sum', axis=1, cuda_type=cuda_type))
-
-            self.gaussian_convolve_gradient_x.append(Genred(
-                "(Px|Py) * Exp(-G*SqDist(X,Y)) * (X-Y)",
-                ["G = Pm(1)",
-                 "X = Vi(" + str(dimension) + ")",
-                 "Y = Vj(" + str(dimension) + ")",
-                 "Px = Vi(" + str(dimension) + ")",
-                 "Py = Vj(" + str(dimension) + ")"],
-                reduction_op='Sum', axis=1, cuda_type=cuda_type))
-
     def __eq__(self, other):
         return AbstractKernel.__eq__(self, other) and self.cuda_type == other.cuda_type
 
@@ -84,7 +80,7 @@ class KeopsKernel(AbstractKernel):
             gamma = self.gamma.to(x.device, dtype=x.dtype)
 
             device_id = x.device.index if x.device.index is not None else -1
-            res = self.gaussian_convolve[d - 2](gamma, x.contiguous(), y.contiguous(), p.contiguous(), device_id=device_id)
+            res = get_reduction('gaussian', d, self.cuda_type)(gamma, x.contiguous(), y.contiguous(), p.contiguous(), device_id=device_id)
             return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
 
         elif mode == 'pointcloud':
@@ -101,7 +97,7 @@ class KeopsKernel(AbstractKernel):
             gamma = self.gamma.to(x.device, dtype=x.dtype)
 
             device_id = x.device.index if x.device.index is not None else -1
-            res = self.point_cloud_convolve[d - 2](gamma, x.contiguous(), y.contiguous(), p.contiguous(), device_id=device_id)
+            res = get_reduction('pointcloud', d, self.cuda_type)(gamma, x.contiguous(), y.contiguous(), p.contiguous(), device_id=device_id)
             return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
 
         elif mode == 'varifold':
@@ -125,7 +121,7 @@ class KeopsKernel(AbstractKernel):
             gamma = self.gamma.to(x.device, dtype=x.dtype)
 
             device_id = x.device.index if x.device.index is not None else -1
-            res = self.varifold_convolve[d - 2](gamma, x.contiguous(), y.contiguous(), nx.contiguous(), ny.contiguous(), p.contiguous(), device_id=device_id)
+            res = get_reduction('varifold', d, self.cuda_type)(gamma, x.contiguous(), y.contiguous(), nx.contiguous(), ny.contiguous(), p.contiguous(), device_id=device_id)
             return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
 
         else:
@@ -150,5 +146,95 @@ class KeopsKernel(AbstractKernel):
         gamma = self.gamma.to(x.device, dtype=x.dtype)
 
         device_id = x.device.index if x.device.index is not None else -1
-        res = (-2 * gamma * self.gaussian_convolve_gradient_x[d - 2](gamma, x, y, px, py, device_id=device_id))
+        res = (-2 * gamma * get_reduction('gaussian_gradient_x', d, self.cuda_type)(gamma, x, y, px, py, device_id=device_id))
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    def convolve_and_gradient(self, x, p):
+        assert isinstance(x, torch.Tensor), 'x variable must be a torch Tensor'
+        assert isinstance(p, torch.Tensor), 'p variable must be a torch Tensor'
+
+        # move tensors with respect to gpu_mode
+        x, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, p])
+        assert x.device == p.device, 'tensors must be on the same device'
+
+        # the frozen degrees of freedom only apply to the convolution, not to its gradient.
+        q = p
+        if self.freeze_DOFs is not None:
+            mask = self._move_to_device(torch.ones(p.shape, dtype=p.dtype), gpu_mode=self.gpu_mode)
+            mask[:,[self.freeze_DOFs]] = 0
+            q = p * mask
+
+        d = x.size(1)
+        gamma = self.gamma.to(x.device, dtype=x.dtype)
+
+        device_id = x.device.index if x.device.index is not None else -1
+        res = get_reduction('gaussian_and_gradient_x', d, self.cuda_type)(
+            gamma, x.contiguous(), x.contiguous(), p.contiguous(), p.contiguous(), q.contiguous(), device_id=device_id)
+        res = res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+        return res[:, :d], -2 * gamma.to(res.device) * res[:, d:]
+
+    def batched_convolve(self, x, y, p, mode='gaussian'):
+        if mode == 'varifold':
+            assert isinstance(x, tuple) and len(x) == 2, 'x must be a tuple of length 2'
+            assert isinstance(y, tuple) and len(y) == 2, 'y must be a tuple of length 2'
+
+            # move tensors with respect to gpu_mode
+            x, nx, y, ny, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x[0], x[1], y[0], y[1], p])
+            assert x.device == nx.device == y.device == ny.device == p.device, 'x, y and p must be on the same device'
+
+            d = x.size(2)
+            gamma = self.gamma.to(x.device, dtype=x.dtype).view(1, 1)
+
+            device_id = x.device.index if x.device.index is not None else -1
+            res = get_reduction('varifold', d, self.cuda_type)(
+                gamma, x.contiguous(), y.contiguous(), nx.contiguous(), ny.contiguous(), p.contiguous(),
+                device_id=device_id)
+            return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+        if mode not in ['gaussian', 'pointcloud']:
+            raise RuntimeError('Unknown kernel mode.')
+
+        assert isinstance(x, torch.Tensor), 'x variable must be a torch Tensor'
+        assert isinstance(y, torch.Tensor), 'y variable must be a torch Tensor'
+        assert isinstance(p, torch.Tensor), 'p variable must be a torch Tensor'
+
+        # move tensors with respect to gpu_mode
+        x, y, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, y, p])
+        assert x.device == y.device == p.device, 'tensors must be on the same device. x.device=' + str(x.device) \
+                                                 + ', y.device=' + str(y.device) + ', p.device=' + str(p.device)
+        if mode == 'gaussian' and self.freeze_DOFs is not None:
+            mask = self._move_to_device(torch.ones(p.shape, dtype=p.dtype), gpu_mode=self.gpu_mode)
+            mask[..., [self.freeze_DOFs]] = 0
+            p = p * mask
+
+        d = x.size(2)
+        # parameters must have as many batch dimensions as the variables.
+        gamma = self.gamma.to(x.device, dtype=x.dtype).view(1, 1)
+
+        device_id = x.device.index if x.device.index is not None else -1
+        res = get_reduction(mode, d, self.cuda_type)(
+            gamma, x.contiguous(), y.contiguous(), p.contiguous(), device_id=device_id)
         return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    def batched_convolve_and_gradient(self, x, p):
+        assert isinstance(x, torch.Tensor), 'x variable must be a torch Tensor'
+        assert isinstance(p, torch.Tensor), 'p variable must be a torch Tensor'
+
+        # move tensors with respect to gpu_mode
+        x, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, p])
+        assert x.device == p.device, 'tensors must be on the same device'
+
+        q = p
+        if self.freeze_DOFs is not None:
+            mask = self._move_to_device(torch.ones(p.shape, dtype=p.dtype), gpu_mode=self.gpu_mode)
+            mask[..., [self.freeze_DOFs]] = 0
+            q = p * mask
+
+        d = x.size(2)
+        gamma = self.gamma.to(x.device, dtype=x.dtype).view(1, 1)
+
+        device_id = x.device.index if x.device.index is not None else -1
+        res = get_reduction('gaussian_and_gradient_x', d, self.cuda_type)(
+            gamma, x.contiguous(), x.contiguous(), p.contiguous(), p.contiguous(), q.contiguous(), device_id=device_id)
+        res = res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+        return res[..., :d], -2 * self.gamma.to(res.device, dtype=res.dtype) * res[..., d:]
@@ -1,11 +1,20 @@
+import inspect
 import logging
+import math
 import torch
+from torch.utils.checkpoint import checkpoint
 
 from ...core import GpuMode, default
 from ...support.kernels.abstract_kernel import AbstractKernel
 
 logger = logging.getLogger(__name__)
 
+# non-reentrant checkpointing is only available (and recommended) on recent torch versions.
+_checkpoint_kwargs = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+# kernel matrices below this size (in bytes) are never tiled.
+_small_kernel_matrix_bytes = 2 ** 26
+
 
 def gaussian(r2, s):
     return torch.exp(-r2 / (s * s))
@@ -20,8 +29,15 @@ class TorchKernel(AbstractKernel):
     ### Constructor:
     ####################################################################################################################
 
-    def __init__(self, gpu_mode=default.gpu_mode, kernel_width=None, **kwargs):
+    def __init__(self, gpu_mode=default.gpu_mode, kernel_width=None, tile_size=None, **kwargs):
+        """
+        :param tile_size:   Number of rows/columns of the kernel matrix evaluated at once. If None, the value of
+                            default.kernel_tile_size is used ; if this is also None, the tile size is automatically
+                            picked from the memory available on the compute device, and tiling is only triggered when
+                            the full kernel matrix does not fit in memory.
+        """
         super().__init__('torch', gpu_mode, kernel_width)
+        self.tile_size = tile_size
 
     ####################################################################################################################
     ### Public methods:
@@ -35,9 +51,11 @@ class TorchKernel(AbstractKernel):
             x, y, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, y, p])
             assert x.device == y.device == p.device, 'x, y and p must be on the same device'
 
-            sq = self._squared_distances(x, y)
-            res = torch.mm(torch.exp(-sq / (self.kernel_width ** 2)), p)
-            # res = torch.mm(1.0 / (1 + sq / self.kernel_width ** 2), p)
+            tile_size = self._get_tile_size(x, y, 2)
+            if tile_size is None:
+                res = self._gaussian_convolve(x, y, p)
+            else:
+                res = self._tiled_reduction(self._gaussian_convolve, [x], [y, p], tile_size)
 
         elif mode == 'varifold':
             assert isinstance(x, tuple), 'x must be a tuple'
@@ -54,8 +72,11 @@ class TorchKernel(AbstractKernel):
             assert x[0].device == y[0].device == p.device, 'x, y and p must be on the same device'
             assert x[1].device == y[1].device == p.device, 'x, y and p must be on the same device'
 
-            sq = self._squared_distances(x[0], y[0])
-            res = torch.mm(gaussian(sq, self.kernel_width) * binet(torch.mm(x[1], torch.t(y[1]))), p)
+            tile_size = self._get_tile_size(x[0], y[0], 3)
+            if tile_size is None:
+                res = self._varifold_convolve(x[0], x[1], y[0], y[1], p)
+            else:
+                res = self._tiled_reduction(self._varifold_convolve, x, [y[0], y[1], p], tile_size)
         else:
             raise RuntimeError('Unknown kernel mode.')
 
@@ -71,6 +92,95 @@ class TorchKernel(AbstractKernel):
         x, px, y, py = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, px, y, py])
         assert px.device == x.device == y.device == py.device, 'tensors must be on the same device'
 
+        tile_size = self._get_tile_size(x, y, x.size(1) + 2)
+        if tile_size is None:
+            res = self._gaussian_convolve_gradient(x, px, y, py)
+        else:
+            res = self._tiled_reduction(self._gaussian_convolve_gradient, [x, px], [y, py], tile_size)
+
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    def convolve_and_gradient(self, x, p):
+        # move tensors with respect to gpu_mode
+        x, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, p])
+        assert x.device == p.device, 'tensors must be on the same device'
+
+        tile_size = self._get_tile_size(x, x, 4)
+        if tile_size is None:
+            res = self._gaussian_convolve_and_gradient(x, p, x, p)
+        else:
+            res = self._tiled_reduction(self._gaussian_convolve_and_gradient, [x, p], [x, p], tile_size)
+
+        res = res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+        d = x.size(1)
+        return res[:, :d], res[:, d:]
+
+    def batched_convolve(self, x, y, p, mode='gaussian'):
+        if mode in ['gaussian', 'pointcloud']:
+            # move tensors with respect to gpu_mode
+            x, y, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, y, p])
+            assert x.device == y.device == p.device, 'x, y and p must be on the same device'
+
+            if self._get_tile_size(x.reshape(-1, x.size(2)), y[0], 2) is not None:
+                # the stacked kernel matrices do not fit in memory: one (tiled) convolution per batch element.
+                return super().batched_convolve(x, y, p, mode=mode)
+
+            sq = self._batched_squared_distances(x, y)
+            res = torch.bmm(torch.exp(-sq / (self.kernel_width ** 2)), p)
+
+        elif mode == 'varifold':
+            assert isinstance(x, tuple) and len(x) == 2, 'x must be a tuple of length 2'
+            assert isinstance(y, tuple) and len(y) == 2, 'y must be a tuple of length 2'
+
+            # move tensors with respect to gpu_mode
+            x, nx, y, ny, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x[0], x[1], y[0], y[1], p])
+            assert x.device == nx.device == y.device == ny.device == p.device, 'x, y and p must be on the same device'
+
+            if self._get_tile_size(x.reshape(-1, x.size(2)), y[0], 3) is not None:
+                # the stacked kernel matrices do not fit in memory: one (tiled) convolution per batch element.
+                return super().batched_convolve((x, nx), (y, ny), p, mode=mode)
+
+            sq = self._batched_squared_distances(x, y)
+            res = torch.bmm(gaussian(sq, self.kernel_width) * binet(torch.bmm(nx, ny.transpose(1, 2))), p)
+
+        else:
+            raise RuntimeError('Unknown kernel mode.')
+
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    def batched_convolve_and_gradient(self, x, p):
+        # move tensors with respect to gpu_mode
+        x, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, p])
+        assert x.device == p.device, 'tensors must be on the same device'
+
+        if self._get_tile_size(x.reshape(-1, x.size(2)), x[0], 4) is not None:
+            # the stacked kernel matrices do not fit in memory: fall back to one (tiled) evaluation per batch element.
+            return super().batched_convolve_and_gradient(x, p)
+
+        sq = self._batched_squared_distances(x, x)
+        A = torch.exp(-sq / (self.kernel_width ** 2))
+        W = A * torch.bmm(p, p.transpose(1, 2))
+        convolve = torch.bmm(A, p)
+        gradient = - 2 * (x * torch.sum(W, 2, keepdim=True) - torch.bmm(W, x)) / (self.kernel_width ** 2)
+
+        if self.gpu_mode is GpuMode.KERNEL:
+            return convolve.cpu(), gradient.cpu()
+        return convolve, gradient
+
+    ####################################################################################################################
+    ### Auxiliary methods:
+    ####################################################################################################################
+
+    def _gaussian_convolve(self, x, y, p):
+        sq = self._squared_distances(x, y)
+        return torch.mm(torch.exp(-sq / (self.kernel_width ** 2)), p)
+        # return torch.mm(1.0 / (1 + sq / self.kernel_width ** 2), p)
+
+    def _varifold_convolve(self, x, nx, y, ny, p):
+        sq = self._squared_distances(x, y)
+        return torch.mm(gaussian(sq, self.kernel_width) * binet(torch.mm(nx, torch.t(ny))), p)
+
+    def _gaussian_convolve_gradient(self, x, px, y, py):
         # A=exp(-(x_i - y_j)^2/(ker^2)).
         sq = self._squared_distances(x, y)
         A = torch.exp(-sq / (self.kernel_width ** 2))
@@ -79,12 +189,85 @@ class TorchKernel(AbstractKernel):
         # B=(x_i - y_j)*exp(-(x_i - y_j)^2/(ker^2))/(ker^2).
         B = self._differences(x, y) * A
 
-        res = (- 2 * torch.sum(px * (torch.matmul(B, py)), 2) / (self.kernel_width ** 2)).t()
-        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+        return (- 2 * torch.sum(px * (torch.matmul(B, py)), 2) / (self.kernel_width ** 2)).t()
 
-    ####################################################################################################################
-    ### Auxiliary methods:
-    ####################################################################################################################
+    def _gaussian_convolve_and_gradient(self, x, px, y, py):
+        """
+        Returns the concatenation of the gaussian convolution of py and of its gradient with respect to x, sharing the
+        kernel matrix. Uses sum_j W_ij (x_i - y_j) = x_i sum_j W_ij - (W y)_i, which avoids the (D, M, N) differences.
+        """
+        sq = self._squared_distances(x, y)
+        A = torch.exp(-sq / (self.kernel_width ** 2))
+        W = A * torch.mm(px, py.t())
+        gradient = - 2 * (x * torch.sum(W, 1, keepdim=True) - torch.mm(W, y)) / (self.kernel_width ** 2)
+        return torch.cat([torch.mm(A, py), gradient], 1)
+
+    def _get_tile_size(self, x, y, number_of_matrices):
+        """
+        Returns the number of rows/columns of the kernel matrix tiles, or None if the full (M, N) kernel matrix can be
+        evaluated at once.
+        :param number_of_matrices:  Number of (M, N) temporaries that are simultaneously alive during the evaluation.
+        """
+        m, n = x.size(0), y.size(0)
+
+        tile_size = self.tile_size if self.tile_size is not None else default.kernel_tile_size
+        if tile_size is None:
+            bytes_per_tile_entry = number_of_matrices * x.element_size()
+            if m * n * bytes_per_tile_entry <= _small_kernel_matrix_bytes:
+                return None     # avoids querying the device memory for small problems.
+
+            available_memory = self._get_available_memory(x.device) * default.kernel_memory_fraction
+            if m * n * bytes_per_tile_entry <= available_memory:
+                return None
+            tile_size = max(1, int(math.sqrt(available_memory / bytes_per_tile_entry)))
+            logger.debug('kernel matrix of size (%d, %d) does not fit in memory, using tiles of size %d'
+                         % (m, n, tile_size))
+
+        assert tile_size > 0, 'tile_size must be a positive integer'
+        return None if tile_size >= max(m, n) else int(tile_size)
+
+    @staticmethod
+    def _get_available_memory(device):
+        """
+        Returns the memory that is currently available on the given device, in bytes.
+        """
+        if device.type == 'cuda':
+            device_index = device.index if device.index is not None else torch.cuda.current_device()
+            return torch.cuda.get_device_properties(device_index).total_memory \
+                - torch.cuda.memory_reserved(device_index)
+
+        import psutil
+        return psutil.virtual_memory().available
+
+    @staticmethod
+    def _tiled_reduction(function, xs, ys, tile_size):
+        """
+        Evaluates a sum-reduction over the j index by streaming over (tile_size, tile_size) blocks of the kernel matrix.
+        :param function:    callable mapping (*xs_tile, *ys_tile) to the partial reduction of the tile, of size (tile, .).
+        :param xs:          list of tensors indexed by i, i.e. of size (M, .).
+        :param ys:          list of tensors indexed by j, i.e. of size (N, .).
+        When gradients are required, each tile is checkpointed so that the backward pass is also memory-bounded.
+        """
+        requires_grad = torch.is_grad_enabled() and any(t.requires_grad for t in xs + ys)
+
+        res = []
+        for i in range(0, xs[0].size(0), tile_size):
+            xs_tile = [t[i:i + tile_size] for t in xs]
+
+            res_tile = None
+            for j in range(0, ys[0].size(0), tile_size):
+                ys_tile = [t[j:j + tile_size] for t in ys]
+
+                if requires_grad:
+                    partial = checkpoint(function, *xs_tile, *ys_tile, **_checkpoint_kwargs)
+                else:
+                    partial = function(*xs_tile, *ys_tile)
+
+                res_tile = partial if res_tile is None else res_tile + partial
+
+            res.append(res_tile)
+
+        return torch.cat(res)
 
     @staticmethod
     def _differences(x, y):
@@ -75,3 +75,14 @@ class MultiScalarNormalDistribution:
 
         delta = observation.contiguous().view(-1, 1) - mean.contiguous().view(-1, 1)
         return -0.5 * torch.sum(delta ** 2) * self.variance_inverse
+
+    def compute_batched_log_likelihood_torch(self, observations, tensor_scalar_type, device='cpu'):
+        """
+        Fully torch method.
+        Returns the log-likelihoods of the observations, whose first dimension indexes the samples.
+        """
+        mean = utilities.move_data(self.mean, dtype=tensor_scalar_type, requires_grad=False, device=device)
+        observations = utilities.move_data(observations, dtype=tensor_scalar_type, device=device)
+
+        delta = observations.contiguous().view(observations.size(0), -1) - mean.contiguous().view(1, -1)
+        return -0.5 * torch.sum(delta ** 2, dim=1) * self.variance_inverse
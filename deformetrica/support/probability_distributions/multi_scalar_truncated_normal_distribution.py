@@ -86,3 +86,16 @@ class MultiScalarTruncatedNormalDistribution:
         else:
             delta = observation.contiguous().view(-1, 1) - mean.contiguous().view(-1, 1)
             return -0.5 * torch.sum(delta ** 2) * self.variance_inverse
+
+    def compute_batched_log_likelihood_torch(self, observations, tensor_scalar_type, device='cpu'):
+        """
+        Fully torch method.
+        Returns the log-likelihoods of the observations, whose first dimension indexes the samples.
+        """
+        mean = utilities.move_data(self.mean, dtype=tensor_scalar_type, requires_grad=False, device=device)
+        observations = utilities.move_data(observations, dtype=tensor_scalar_type, device=device)
+
+        observations = observations.contiguous().view(observations.size(0), -1)
+        delta = observations - mean.contiguous().view(1, -1)
+        log_likelihoods = -0.5 * torch.sum(delta ** 2, dim=1) * self.variance_inverse
+        return log_likelihoods.masked_fill(torch.any(observations < 0.0, dim=1), - float('inf'))
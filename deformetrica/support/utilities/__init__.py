@@ -1,3 +1,4 @@
+import copy
 import torch
 import torch.multiprocessing as mp
 import numpy as np
@@ -145,6 +146,90 @@ def convert_deformable_object_to_torch(deformable_object, device='cpu'):
     return deformable_object
 
 
+class SharedArray(np.ndarray):
+    """
+    Numpy array whose buffer lives in shared memory.
+    When sent to another process through torch.multiprocessing (e.g. as a pool initializer argument), only a handle to
+    the shared buffer is pickled: the receiving process maps the same memory, and sees the subsequent in-place updates.
+    Views and results of numpy operations are ordinary arrays, that are copied when pickled.
+    """
+
+    def __new__(cls, array):
+        tensor = torch.from_numpy(np.ascontiguousarray(array)).share_memory_()
+        obj = tensor.numpy().view(cls)
+        obj.shared_tensor = tensor
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.shared_tensor = None
+
+    def __array_wrap__(self, array, context=None, return_scalar=False):
+        array = array.view(np.ndarray)
+        return array[()] if return_scalar else array
+
+    def __reduce__(self):
+        if self.shared_tensor is None:
+            return np.asarray(self).__reduce__()
+        return _rebuild_shared_array, (self.shared_tensor,)
+
+
+def _rebuild_shared_array(shared_tensor):
+    obj = shared_tensor.numpy().view(SharedArray)
+    obj.shared_tensor = shared_tensor
+    return obj
+
+
+def share_memory(data, memo=None):
+    """
+    Returns a copy of the given data whose numerical numpy arrays are moved to shared memory, see SharedArray.
+    Dictionaries, lists and tuples are traversed recursively. Other objects (e.g. deformable objects) are shallow-copied
+    and traversed through their attributes: the given data itself is left unchanged.
+    :param data:    numpy array, or (possibly nested) dictionary, list, tuple or object holding numpy arrays, such as a
+                    deformable object or a list of them.
+    :param memo:    dictionary mapping the ids of the objects already traversed to their copies, used internally to
+                    keep shared references shared and to stop on reference cycles.
+    :return:    copy of data, with its numpy arrays replaced by SharedArray instances. Tensors and other leaf values are
+                returned as is.
+    """
+    if memo is None:
+        memo = {}
+
+    if isinstance(data, (SharedArray, np.memmap)):
+        # memory-mapped arrays are already shared through the page cache.
+        return data
+    elif isinstance(data, np.ndarray):
+        return SharedArray(data) if data.dtype.kind in 'biuf' else data
+    elif isinstance(data, dict):
+        return {key: share_memory(value, memo) for key, value in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return type(data)(share_memory(elt, memo) for elt in data)
+    elif hasattr(data, '__dict__') and not isinstance(data, (type, torch.Tensor)):
+        if id(data) not in memo:
+            shared_data = copy.copy(data)
+            memo[id(data)] = shared_data
+            for key, value in vars(data).items():
+                setattr(shared_data, key, share_memory(value, memo))
+        return memo[id(data)]
+
+    return data
+
+
+def copy_to_shared_memory(shared_data, data):
+    """
+    Copies in place the given numpy arrays to the shared memory buffers previously created with share_memory.
+    Both arguments must have the same (possibly nested) dictionary structure, and the arrays the same shapes.
+    """
+    if isinstance(shared_data, dict):
+        assert shared_data.keys() == data.keys(), 'shared memory buffers and data do not have the same structure'
+        for key in shared_data.keys():
+            copy_to_shared_memory(shared_data[key], data[key])
+    else:
+        assert isinstance(shared_data, SharedArray), 'expecting a SharedArray instance'
+        assert shared_data.shape == np.shape(data), 'shared memory buffer of shape ' + str(shared_data.shape) + \
+                                                    ' cannot hold data of shape ' + str(np.shape(data))
+        np.copyto(shared_data, data)
+
+
 def get_device_from_string(device):
 
     if isinstance(device, str) and device.startswith('cuda') and ':' in device:
@@ -8,6 +8,7 @@ from tests.unit_tests.test_api import API
 from tests.unit_tests.test_array_readers_and_writers import ArrayReadersAndWritersTests
 from tests.unit_tests.test_attachments import DistanceTests
 from tests.unit_tests.test_auto_dimension import AutomaticDimensionDetectionTests
+from tests.unit_tests.test_dataset_functions import DatasetFunctionsTests
 from tests.unit_tests.test_kernel_factory import KeopsVersusCuda, KernelFactoryTest, TorchKernelTest, KeopsKernelTest
 from tests.unit_tests.test_parallel_transport import ParallelTransportTests
 from tests.unit_tests.test_point_cloud import PointCloudTests
@@ -18,7 +19,7 @@ from tests.unit_tests.test_surface_mesh import SurfaceMeshTests
 TEST_MODULES = [API, KernelFactoryTest, TorchKernelTest, KeopsKernelTest, KeopsVersusCuda,
                 ParallelTransportTests, DistanceTests, ArrayReadersAndWritersTests,
                 PolyLineTests, PointCloudTests, SurfaceMeshTests, ShootingTests,
-                AutomaticDimensionDetectionTests]
+                AutomaticDimensionDetectionTests, DatasetFunctionsTests]
 
 # TEST_MODULES = [ParallelTransportTests]
 
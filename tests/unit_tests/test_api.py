@@ -1,6 +1,9 @@
+import copy
 import os
+import threading
 import time
 import unittest
+import numpy as np
 from vtk import vtkPolyDataReader
 
 import deformetrica as dfca
@@ -116,6 +119,42 @@ class API(unittest.TestCase):
     def test_estimate_deterministic_atlas_landmark_2d_skulls(self):
         self.__test_all(self._test_estimate_deterministic_atlas_landmark_2d_skulls)
 
+    def test_estimate_deterministic_atlas_landmark_2d_skulls_multiprocess(self):
+        dataset_specifications = {
+            'dataset_filenames': [
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_australopithecus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_erectus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_habilis.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_neandertalis.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_sapiens.vtk'}]],
+            'subject_ids': ['australopithecus', 'erectus', 'habilis', 'neandertalis', 'sapiens'],
+        }
+        template_specifications = {
+            'skull': {'deformable_object_type': 'polyline',
+                      'kernel_type': 'torch', 'kernel_width': 20.0,
+                      'noise_std': 1.0,
+                      'filename': example_data_dir + '/atlas/landmark/2d/skulls/data/template.vtk',
+                      'attachment_type': 'varifold'}}
+
+        log_likelihoods = {}
+        for number_of_processes in [1, 2]:
+            log_likelihoods[number_of_processes] = []
+            self.deformetrica.estimate_deterministic_atlas(
+                template_specifications,
+                dataset_specifications,
+                estimator_options={'optimization_method_type': 'GradientAscent', 'initial_step_size': 1.,
+                                   'max_iterations': 3, 'max_line_search_iterations': 10,
+                                   'callback': lambda status_dict, number_of_processes=number_of_processes:
+                                   log_likelihoods[number_of_processes].append(
+                                       status_dict['current_log_likelihood']) is None},
+                model_options={'deformation_kernel_type': 'torch', 'deformation_kernel_width': 40.0,
+                               'dtype': 'float64', 'gpu_mode': dfca.GpuMode.NONE,
+                               'number_of_processes': number_of_processes})
+
+        self.assertEqual(len(log_likelihoods[1]), len(log_likelihoods[2]))
+        for log_likelihood_1, log_likelihood_2 in zip(log_likelihoods[1], log_likelihoods[2]):
+            self.assertAlmostEqual(log_likelihood_1, log_likelihood_2, delta=1e-6 * abs(log_likelihood_1))
+
     def _test_estimate_deterministic_atlas_landmark_3d_brain_structure(self, dtype, gpu_mode):
         dataset_specifications = {
             'dataset_filenames': [
@@ -228,6 +267,142 @@ class API(unittest.TestCase):
     def test_estimate_bayesian_atlas_landmark_2d_skulls(self):
         self.__test_all(self._test_estimate_bayesian_atlas_landmark_2d_skulls)
 
+    def test_estimate_bayesian_atlas_landmark_2d_skulls_mcmc_saem_subject_cache(self):
+        dataset_specifications = {
+            'dataset_filenames': [
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_australopithecus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_erectus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_habilis.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_neandertalis.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_sapiens.vtk'}]],
+            'subject_ids': ['australopithecus', 'erectus', 'habilis', 'neandertalis', 'sapiens']
+        }
+        template_specifications = {
+            'skull': {'deformable_object_type': 'polyline',
+                      'kernel_type': 'torch',
+                      'kernel_width': 20.0,
+                      'noise_std': 1.0,
+                      'noise_variance_prior_normalized_dof': 10,
+                      'noise_variance_prior_scale_std': 1,
+                      'filename': example_data_dir + '/atlas/landmark/2d/skulls/data/template.vtk',
+                      'attachment_type': 'varifold'}}
+
+        # the cached subject residuals give the same estimation as recomputing them.
+        models = {}
+        subject_cache_size = dfca.default.subject_cache_size
+        try:
+            for cache_size in [subject_cache_size, 0]:
+                dfca.default.subject_cache_size = cache_size
+                np.random.seed(42)
+                models[cache_size], _ = self.deformetrica.estimate_bayesian_atlas(
+                    template_specifications, dataset_specifications,
+                    estimator_options={'optimization_method_type': 'McmcSaem', 'max_iterations': 2,
+                                       'sample_every_n_mcmc_iters': 3},
+                    model_options={'deformation_kernel_type': 'torch', 'deformation_kernel_width': 40.0,
+                                   'dtype': 'float64', 'gpu_mode': dfca.GpuMode.NONE})
+        finally:
+            dfca.default.subject_cache_size = subject_cache_size
+
+        self.assertGreater(models[subject_cache_size].subject_cache_info['hits'], 0)
+        self.assertEqual(models[0].subject_cache_info['hits'], 0)
+        self.assertTrue(np.allclose(models[subject_cache_size].get_template_data()['landmark_points'],
+                                    models[0].get_template_data()['landmark_points'], rtol=1e-12, atol=1e-12))
+        self.assertTrue(np.allclose(models[subject_cache_size].get_noise_variance(), models[0].get_noise_variance(),
+                                    rtol=1e-12))
+
+    def test_estimate_bayesian_atlas_landmark_2d_skulls_mcmc_saem_multiprocess(self):
+        dataset_specifications = {
+            'dataset_filenames': [
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_australopithecus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_erectus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_habilis.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_neandertalis.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_sapiens.vtk'}]],
+            'subject_ids': ['australopithecus', 'erectus', 'habilis', 'neandertalis', 'sapiens']
+        }
+        template_specifications = {
+            'skull': {'deformable_object_type': 'polyline',
+                      'kernel_type': 'torch',
+                      'kernel_width': 20.0,
+                      'noise_std': 1.0,
+                      'noise_variance_prior_normalized_dof': 10,
+                      'noise_variance_prior_scale_std': 1,
+                      'filename': example_data_dir + '/atlas/landmark/2d/skulls/data/template.vtk',
+                      'attachment_type': 'varifold'}}
+
+        # the candidates evaluated by the pool workers give the same chain as the sequential evaluation.
+        models = {}
+        for number_of_processes in [1, 2]:
+            np.random.seed(42)
+            models[number_of_processes], _ = self.deformetrica.estimate_bayesian_atlas(
+                template_specifications, dataset_specifications,
+                estimator_options={'optimization_method_type': 'McmcSaem', 'max_iterations': 2,
+                                   'sample_every_n_mcmc_iters': 3},
+                model_options={'deformation_kernel_type': 'torch', 'deformation_kernel_width': 40.0,
+                               'dtype': 'float64', 'gpu_mode': dfca.GpuMode.NONE,
+                               'number_of_processes': number_of_processes})
+
+        self.assertEqual(len(models[1].task_timings), 0)
+        self.assertGreater(len(models[2].task_timings), 0)
+        self.assertTrue(np.allclose(models[1].get_template_data()['landmark_points'],
+                                    models[2].get_template_data()['landmark_points'], rtol=1e-10, atol=1e-10))
+        self.assertTrue(np.allclose(models[1].get_noise_variance(), models[2].get_noise_variance(), rtol=1e-10))
+
+    def test_estimate_atlas_landmark_2d_skulls_asynchronous_writer(self):
+        dataset_specifications = {
+            'dataset_filenames': [
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_australopithecus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_erectus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_habilis.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_neandertalis.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_sapiens.vtk'}]],
+            'subject_ids': ['australopithecus', 'erectus', 'habilis', 'neandertalis', 'sapiens']
+        }
+        template_specifications = {
+            'skull': {'deformable_object_type': 'polyline',
+                      'kernel_type': 'torch',
+                      'kernel_width': 20.0,
+                      'noise_std': 1.0,
+                      'noise_variance_prior_normalized_dof': 10,
+                      'noise_variance_prior_scale_std': 1,
+                      'filename': example_data_dir + '/atlas/landmark/2d/skulls/data/template.vtk',
+                      'attachment_type': 'varifold'}}
+        model_options = {'deformation_kernel_type': 'torch', 'deformation_kernel_width': 40.0,
+                         'dtype': 'float64', 'gpu_mode': dfca.GpuMode.NONE}
+
+        # the intermediate outputs written in the background are those of the synchronous writes.
+        for estimate, estimator_options in [
+                ('estimate_deterministic_atlas', {'optimization_method_type': 'GradientAscent',
+                                                  'initial_step_size': 1., 'max_iterations': 3}),
+                ('estimate_deterministic_atlas', {'optimization_method_type': 'ScipyLBFGS', 'max_iterations': 3}),
+                ('estimate_bayesian_atlas', {'optimization_method_type': 'McmcSaem', 'max_iterations': 3,
+                                             'sample_every_n_mcmc_iters': 2})]:
+            with self.subTest(estimate=estimate, estimator=estimator_options['optimization_method_type']):
+                output_dirs = {}
+                for use_asynchronous_writer in [False, True]:
+                    output_dirs[use_asynchronous_writer] = os.path.join(
+                        os.path.dirname(__file__), 'output', 'asynchronous_writer_' + str(use_asynchronous_writer))
+                    deformetrica = dfca.Deformetrica(output_dir=output_dirs[use_asynchronous_writer],
+                                                     verbosity='INFO')
+                    np.random.seed(42)
+                    getattr(deformetrica, estimate)(
+                        template_specifications, dataset_specifications,
+                        estimator_options=dict(estimator_options, save_every_n_iters=1,
+                                               use_asynchronous_writer=use_asynchronous_writer),
+                        model_options=copy.deepcopy(model_options), write_output=False)
+
+                self.assertFalse(any(thread.name == 'AsynchronousWriter' for thread in threading.enumerate()))
+                filenames = sorted(filename for filename in os.listdir(output_dirs[False])
+                                   if 'EstimatedParameters' in filename and not filename.endswith('.npy'))
+                self.assertGreater(len(filenames), 0)
+                self.assertEqual(filenames, sorted(filename for filename in os.listdir(output_dirs[True])
+                                                   if 'EstimatedParameters' in filename
+                                                   and not filename.endswith('.npy')))
+                for filename in filenames:
+                    with open(os.path.join(output_dirs[False], filename)) as f, \
+                            open(os.path.join(output_dirs[True], filename)) as f_asynchronous:
+                        self.assertEqual(f.read(), f_asynchronous.read(), filename)
+
     # Longitudinal Atlas
 
     def _test_estimate_longitudinal_atlas(self, dtype, gpu_mode):
@@ -369,6 +544,55 @@ class API(unittest.TestCase):
     def test_estimate_longitudinal_atlas(self):
         self.__test_all(self._test_estimate_longitudinal_atlas)
 
+    def test_estimate_longitudinal_atlas_batched_and_deduplicated_visits(self):
+        BASE_DIR = example_data_dir + '/longitudinal_atlas/landmark/2d/starmen'
+
+        # the last visit of the first subject is duplicated.
+        dataset_specifications = {
+            'subject_ids': ['sub-0', 'sub-1', 'sub-2'],
+            'visit_ages': [
+                [66.68, 68.85, 71.02, 73.19, 73.19],
+                [63.97, 64.86, 65.74, 66.63, 67.51, 68.4, 69.28, 70.16],
+                [65.18, 66.18, 67.18, 68.18, 69.18, 70.18, 71.18, 72.18, 73.18, 74.18]
+            ],
+            'dataset_filenames': [
+                [{'starman': os.path.join(BASE_DIR, 'data/subject_s0__tp_%d__age_%.2f.vtk' % (j, age))}
+                 for j, age in enumerate([66.68, 68.85, 71.02, 73.19])]
+                + [{'starman': os.path.join(BASE_DIR, 'data/subject_s0__tp_3__age_73.19.vtk')}],
+                [{'starman': os.path.join(BASE_DIR, 'data/subject_s1__tp_%d__age_%.2f.vtk' % (j, age))}
+                 for j, age in enumerate([63.97, 64.86, 65.74, 66.63, 67.51, 68.4, 69.28, 70.16])],
+                [{'starman': os.path.join(BASE_DIR, 'data/subject_s2__tp_%d__age_%.2f.vtk' % (j, age))}
+                 for j, age in enumerate([65.18, 66.18, 67.18, 68.18, 69.18, 70.18, 71.18, 72.18, 73.18, 74.18])]
+            ]
+        }
+        template_specifications = {
+            'starman': {'deformable_object_type': 'polyline',
+                        'noise_std': 1.0,
+                        'filename': os.path.join(BASE_DIR, 'data', 'ForInitialization__Template.vtk'),
+                        'attachment_type': 'landmark',
+                        'noise_variance_prior_normalized_dof': 0.01,
+                        'noise_variance_prior_scale_std': 1.}}
+
+        # the visits batched by time interval, and the deduplicated visits give the same estimation.
+        models = {}
+        for key, options in [('sequential', {}),
+                             ('batched', {'use_batched_exponential': True}),
+                             ('deduplicated', {'visit_deduplication_tolerance': 0.0})]:
+            np.random.seed(42)
+            models[key] = self.deformetrica.estimate_longitudinal_atlas(
+                template_specifications, dataset_specifications,
+                estimator_options={'optimization_method_type': 'McmcSaem', 'max_iterations': 1,
+                                   'sample_every_n_mcmc_iters': 2},
+                model_options={'deformation_kernel_type': 'torch', 'deformation_kernel_width': 1.0,
+                               'dtype': 'float64', 'gpu_mode': dfca.GpuMode.KERNEL, **options})
+
+        for key in ['batched', 'deduplicated']:
+            self.assertTrue(np.allclose(models[key].get_template_data()['landmark_points'],
+                                        models['sequential'].get_template_data()['landmark_points'],
+                                        rtol=1e-8, atol=1e-8))
+            self.assertTrue(np.allclose(models[key].get_noise_variance(), models['sequential'].get_noise_variance(),
+                                        rtol=1e-8))
+
     @unittest.skip
     def test_estimate_longitudinal_atlas_hippocampi(self):
         import torch
@@ -549,6 +773,46 @@ class API(unittest.TestCase):
     def test_estimate_geodesic_regression_landmark_2d_skulls(self):
         self.__test_all(self._test_estimate_geodesic_regression_landmark_2d_skulls)
 
+    def test_estimate_geodesic_regression_concurrent_integration(self):
+        dataset_specifications = {
+            'dataset_filenames': [
+                [{'skull': example_data_dir + '/regression/landmark/2d/skulls/data/skull_australopithecus.vtk'},
+                 {'skull': example_data_dir + '/regression/landmark/2d/skulls/data/skull_habilis.vtk'},
+                 {'skull': example_data_dir + '/regression/landmark/2d/skulls/data/skull_erectus.vtk'},
+                 {'skull': example_data_dir + '/regression/landmark/2d/skulls/data/skull_sapiens.vtk'}]],
+            'visit_ages': [[1, 2, 3, 4]],
+            'subject_ids': [['australopithecus', 'habilis', 'erectus', 'sapiens']]
+        }
+        template_specifications = {
+            'skull': {'deformable_object_type': 'polyline',
+                      'kernel_type': 'torch', 'kernel_width': 20.0,
+                      'noise_std': 1.0,
+                      'filename': example_data_dir + '/regression/landmark/2d/skulls/data/template.vtk',
+                      'attachment_type': 'varifold'}}
+
+        # The backward and forward halves of the geodesic are both integrated from t0 = 2.5.
+        models = {}
+        for concurrent_geodesic_integration in [False, True]:
+            models[concurrent_geodesic_integration] = self.deformetrica.estimate_geodesic_regression(
+                template_specifications, dataset_specifications,
+                estimator_options={'optimization_method_type': 'GradientAscent', 'max_iterations': 2},
+                model_options={'deformation_kernel_type': 'torch', 'deformation_kernel_width': 25.0,
+                               'concentration_of_time_points': 5, 'smoothing_kernel_width': 20.0, 't0': 2.5,
+                               'concurrent_geodesic_integration': concurrent_geodesic_integration,
+                               'dtype': 'float64', 'gpu_mode': dfca.GpuMode.NONE})
+
+        self.assertTrue(models[True].geodesic.concurrent_integration)
+        # The worker thread belongs to the geodesic, and is not carried by its copies.
+        geodesic = models[True].geodesic
+        self.assertIsNotNone(geodesic._executor)
+        self.assertIsNone(copy.deepcopy(geodesic)._executor)
+        geodesic.shutdown()
+        self.assertIsNone(geodesic._executor)
+        for key in ['momenta', 'control_points']:
+            self.assertTrue(np.array_equal(models[True].fixed_effects[key], models[False].fixed_effects[key]))
+        self.assertTrue(np.array_equal(models[True].get_template_data()['landmark_points'],
+                                       models[False].get_template_data()['landmark_points']))
+
     def _test_estimate_geodesic_regression_landmark_3d_surprise(self, dtype, gpu_mode):
         dataset_specifications = {
             'dataset_filenames': [
@@ -677,6 +941,33 @@ class API(unittest.TestCase):
     def test_estimate_deterministic_registration_image_2d_tetris(self):
         self.__test_all(self._test_estimate_deterministic_registration_image_2d_tetris)
 
+    def test_estimate_deterministic_registration_image_2d_tetris_grid_image_flow(self):
+        dataset_specifications = {
+            'dataset_filenames': [
+                [{'image': example_data_dir + '/registration/image/2d/tetris/data/image2.png'}]],
+            'subject_ids': ['target']
+        }
+        template_specifications = {
+            'image': {'deformable_object_type': 'image',
+                      'kernel_type': 'torch',
+                      'kernel_width': 10.0,
+                      'noise_std': 0.1,
+                      'filename': example_data_dir + '/registration/image/2d/tetris/data/image1.png'}}
+
+        # The velocity fields evaluated on the image grid approximate the direct kernel convolutions.
+        models = {}
+        for use_grid_image_flow in [False, True]:
+            models[use_grid_image_flow] = self.deformetrica.estimate_deterministic_atlas(
+                template_specifications, dataset_specifications,
+                estimator_options={'optimization_method_type': 'GradientAscent', 'max_iterations': 2},
+                model_options={'deformation_kernel_type': 'torch', 'deformation_kernel_width': 20.0,
+                               'use_grid_image_flow': use_grid_image_flow,
+                               'dtype': 'float64', 'gpu_mode': dfca.GpuMode.NONE})
+
+        self.assertTrue(models[True].exponential.use_grid_image_flow)
+        momenta = {key: model.fixed_effects['momenta'] for key, model in models.items()}
+        self.assertLess(np.max(np.abs(momenta[True] - momenta[False])), 1e-2 * np.max(np.abs(momenta[False])))
+
     #
     # Parallel Transport
     #
@@ -1,4 +1,5 @@
 import os
+import shutil
 import tempfile
 import unittest
 
@@ -13,12 +14,14 @@ class ArrayReadersAndWritersTests(unittest.TestCase):
     """
     def setUp(self):
         self.test_output_file_path = os.path.join(tempfile.gettempdir(), "test_write_3D_array.txt")
-        pass
+        self.test_output_dir = tempfile.mkdtemp()
 
     def tearDown(self):
         # remove created file
         if os.path.isfile(self.test_output_file_path):
             os.remove(self.test_output_file_path)
+        shutil.rmtree(self.test_output_dir)
+        dfca.default.update_array_file_format('txt')
 
         super().tearDown()
 
@@ -34,3 +37,35 @@ class ArrayReadersAndWritersTests(unittest.TestCase):
         dfca.io.write_3D_array(momenta, self.test_output_file_path, self.test_output_file_path)
         read = dfca.io.read_3D_array(self.test_output_file_path)
         self.assertTrue(np.allclose(momenta, read))
+
+    def test_arrays_round_trip(self):
+        arrays_3D = [np.random.randn(4, 72, 3), np.random.randn(1, 10, 2), np.random.randn(3, 5, 2).astype('float32')]
+        arrays_2D = [np.random.randn(72, 3), np.random.randn(10, 2).astype('float32')]
+
+        for file_format in ['txt', 'npy']:
+            for k, array in enumerate(arrays_3D):
+                path = dfca.io.write_3D_array(array, self.test_output_dir, 'momenta_%d.txt' % k,
+                                              file_format=file_format)
+                self.assertEqual(os.path.splitext(path)[1], '.' + file_format)
+                read = dfca.io.read_3D_array(path)
+                # The exact values are read back, in both formats (text files are read in double precision).
+                self.assertTrue(np.array_equal(array[0] if len(array) == 1 else array, read.astype(array.dtype)))
+
+            for k, array in enumerate(arrays_2D):
+                path = dfca.io.write_2D_array(array, self.test_output_dir, 'control_points_%d.txt' % k,
+                                              fmt='%.17g', file_format=file_format)
+                self.assertTrue(np.array_equal(array, dfca.io.read_2D_array(path).astype(array.dtype)))
+
+    def test_binary_arrays_are_read_from_text_names(self):
+        momenta = np.random.randn(4, 72, 3)
+        dfca.default.update_array_file_format('npy')
+        path = dfca.io.write_3D_array(momenta, self.test_output_dir, 'Momenta.txt')
+        self.assertEqual(path, os.path.join(self.test_output_dir, 'Momenta.npy'))
+        self.assertFalse(os.path.isfile(os.path.join(self.test_output_dir, 'Momenta.txt')))
+        self.assertTrue(np.array_equal(momenta, dfca.io.read_3D_array(
+            os.path.join(self.test_output_dir, 'Momenta.txt'))))
+
+        # The single array of a .npz file is read as well.
+        np.savez(os.path.join(self.test_output_dir, 'Momenta.npz'), momenta=momenta)
+        self.assertTrue(np.array_equal(momenta, dfca.io.read_3D_array(
+            os.path.join(self.test_output_dir, 'Momenta.npz'))))
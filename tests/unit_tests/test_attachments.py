@@ -3,6 +3,7 @@ import unittest
 
 import torch
 import deformetrica as dfca
+from deformetrica.core.observations import DeformableMultiObject
 from torch.autograd import Variable
 
 # Tests a few distances computations (current and varifold) and compares them to C++ version
@@ -67,3 +68,64 @@ class DistanceTests(unittest.TestCase):
     def test_poly_line_current_distance_to_self_is_zero(self):
         self._test_poly_line_current_distance_to_self_is_zero()
         self._test_poly_line_current_distance_to_self_is_zero()
+
+    def test_target_attachment_data_is_cached_until_target_is_modified(self):
+        import copy
+        import pickle
+        source = self._read_surface_mesh(os.path.join(unit_tests_data_dir, "hippocampus.vtk"))
+        target = self._read_surface_mesh(os.path.join(unit_tests_data_dir, "hippocampus_2.vtk"))
+        points_source = torch.from_numpy(source.get_points()).type(self.tensor_scalar_type)
+
+        varifold_distance = self.multi_attach.varifold_distance(points_source, source, target, self.kernel)
+        self.assertEqual(len(target.attachment_cache), 1)
+        target_data = next(iter(target.attachment_cache.values()))
+        self.assertTrue(all(key in target_data for key in ['centers', 'normals', 'areas', 'unit_normals', 'norm']))
+
+        # a second evaluation re-uses the cached target data.
+        self.assertAlmostEqual(varifold_distance.item(),
+                               self.multi_attach.varifold_distance(points_source, source, target, self.kernel).item())
+        self.assertIs(next(iter(target.attachment_cache.values())), target_data)
+
+        # the cache is not pickled, and is dropped when the target is modified.
+        self.assertEqual(len(pickle.loads(pickle.dumps(target)).attachment_cache), 0)
+        self.assertEqual(len(copy.deepcopy(target).attachment_cache), 0)
+        target.set_points(target.get_points() + 1.)
+        self.assertEqual(len(target.attachment_cache), 0)
+        new_target = self._read_surface_mesh(os.path.join(unit_tests_data_dir, "hippocampus_2.vtk"))
+        new_target.set_points(new_target.get_points() + 1.)
+        self.assertAlmostEqual(self.multi_attach.varifold_distance(points_source, source, target, self.kernel).item(),
+                               self.multi_attach.varifold_distance(points_source, source, new_target, self.kernel).item())
+
+    def test_batched_distances_are_equal_to_sequential_distances(self):
+        reader = dfca.io.DeformableObjectReader()
+        torch.manual_seed(42)
+        noise = torch.randn(3, 162, 3, dtype=self.tensor_scalar_type.dtype)
+
+        for kernel_type in ['torch', 'keops']:
+            kernel = dfca.kernels.factory(kernel_type, kernel_width=10., cuda_type='float64')
+            for attachment_type in ['current', 'pointcloud', 'varifold', 'landmark']:
+                object_type = {'pointcloud': 'PointCloud', 'landmark': 'Landmark'}.get(attachment_type, 'SurfaceMesh')
+                target_names = ["hippocampus_2.vtk", "hippocampus.vtk", "hippocampus_2.vtk"]
+                if attachment_type == 'landmark':
+                    target_names = ["hippocampus.vtk"] * 3
+                source = reader.create_object(os.path.join(unit_tests_data_dir, "hippocampus.vtk"), object_type,
+                                              dimension=3)
+                template = DeformableMultiObject([source])
+                targets = [DeformableMultiObject([reader.create_object(os.path.join(unit_tests_data_dir, name),
+                                                                       object_type, dimension=3)])
+                           for name in target_names]
+                multi_attach = dfca.attachments.MultiObjectAttachment([attachment_type], [kernel])
+
+                points = torch.from_numpy(source.get_points()).type(self.tensor_scalar_type)
+                points = (points + noise).requires_grad_()
+
+                batched = multi_attach.compute_batched_weighted_distance(
+                    {'landmark_points': points}, template, targets, [2.])
+                batched_grad = torch.autograd.grad(batched, points)[0]
+
+                sequential = sum(multi_attach.compute_weighted_distance(
+                    {'landmark_points': points[j]}, template, target, [2.]) for j, target in enumerate(targets))
+                sequential_grad = torch.autograd.grad(sequential, points)[0]
+
+                self.assertAlmostEqual(batched.item(), sequential.item(), delta=1e-8 * abs(sequential.item()))
+                self.assertTrue(torch.allclose(batched_grad, sequential_grad, rtol=1e-8, atol=1e-8))
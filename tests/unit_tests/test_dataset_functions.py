@@ -0,0 +1,113 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+from deformetrica.in_out.dataset_functions import create_dataset
+from deformetrica.in_out.deformable_object_reader import DeformableObjectReader
+from deformetrica.support import utilities
+
+from . import example_data_dir, unit_tests_data_dir
+
+
+class DatasetFunctionsTests(unittest.TestCase):
+    """
+    Checks the parallel and cached loading of the datasets against the sequential reading.
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.template_specifications = {
+            'hippocampus': {'deformable_object_type': 'SurfaceMesh'},
+            'cloud': {'deformable_object_type': 'PointCloud'}}
+        self.dataset_filenames = [
+            [{'hippocampus': os.path.join(unit_tests_data_dir, 'hippocampus.vtk'),
+              'cloud': os.path.join(unit_tests_data_dir, 'hippocampus.vtk')}],
+            [{'hippocampus': os.path.join(unit_tests_data_dir, 'hippocampus_2.vtk'),
+              'cloud': os.path.join(unit_tests_data_dir, 'hippocampus.vtk')},
+             {'hippocampus': os.path.join(unit_tests_data_dir, 'hippocampus.vtk'),
+              'cloud': os.path.join(unit_tests_data_dir, 'hippocampus.vtk')}]]
+        self.visit_ages = [[60.], [65., 70.]]
+        self.subject_ids = ['s0', 's1']
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _create_dataset(self, **kwargs):
+        return create_dataset(self.template_specifications, visit_ages=self.visit_ages,
+                              dataset_filenames=self.dataset_filenames, subject_ids=self.subject_ids, **kwargs)
+
+    def _assert_datasets_equal(self, dataset, expected_dataset):
+        self.assertEqual(len(dataset.deformable_objects), len(expected_dataset.deformable_objects))
+        for subject, expected_subject in zip(dataset.deformable_objects, expected_dataset.deformable_objects):
+            self.assertEqual(len(subject), len(expected_subject))
+            for multi_object, expected_multi_object in zip(subject, expected_subject):
+                for elt, expected_elt in zip(multi_object.object_list, expected_multi_object.object_list):
+                    self.assertEqual(elt.type, expected_elt.type)
+                    self.assertTrue(np.array_equal(elt.points, expected_elt.points))
+                    self.assertTrue(np.array_equal(elt.connectivity, expected_elt.connectivity))
+                    for tensor, expected_tensor in zip(elt.get_centers_and_normals(),
+                                                       expected_elt.get_centers_and_normals()):
+                        self.assertTrue(torch.equal(tensor, expected_tensor))
+
+    def test_cached_dataset_equals_read_dataset(self):
+        expected_dataset = self._create_dataset()
+
+        dataset = self._create_dataset(dataset_cache_dir=self.cache_dir)
+        self._assert_datasets_equal(dataset, expected_dataset)
+        # One cache file per distinct file and object type.
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+        # The files are not parsed again.
+        with mock.patch.object(DeformableObjectReader, 'read_file', side_effect=AssertionError('File parsed')):
+            dataset = self._create_dataset(dataset_cache_dir=self.cache_dir)
+        self._assert_datasets_equal(dataset, expected_dataset)
+
+    def test_cache_is_invalidated_by_modified_files(self):
+        filename = os.path.join(self.cache_dir, 'skull.vtk')
+        shutil.copyfile(os.path.join(unit_tests_data_dir, 'skull.vtk'), filename)
+
+        cache_filename = DeformableObjectReader.get_cache_filename(filename, 'PolyLine', None, self.cache_dir)
+        DeformableObjectReader.create_object(filename, 'PolyLine', cache_dir=self.cache_dir)
+        self.assertTrue(os.path.isfile(cache_filename))
+
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertNotEqual(DeformableObjectReader.get_cache_filename(filename, 'PolyLine', None, self.cache_dir),
+                            cache_filename)
+
+    def test_parallel_loading_equals_sequential_loading(self):
+        expected_dataset = self._create_dataset()
+
+        dataset = self._create_dataset(number_of_loading_workers=2, dataset_cache_dir=self.cache_dir)
+        self._assert_datasets_equal(dataset, expected_dataset)
+        self.assertEqual(dataset.subject_ids, self.subject_ids)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_cached_images_are_memory_mapped(self):
+        for filename in [os.path.join(unit_tests_data_dir, 'digit_2_sample_1.png'),
+                         os.path.join(example_data_dir, 'longitudinal_atlas', 'image', '3d', 'hippocampi', 'data',
+                                      's0142_7970_1.nii')]:
+            expected_image = DeformableObjectReader.create_object(filename, 'Image')
+
+            # The cache is written by the first read, and read by the second one.
+            for _ in range(2):
+                image = DeformableObjectReader.create_object(filename, 'Image', cache_dir=self.cache_dir)
+                self.assertIsInstance(image.intensities, np.memmap)
+                self.assertTrue(np.array_equal(image.intensities, expected_image.intensities))
+                self.assertEqual(image.intensities.dtype, expected_image.intensities.dtype)
+                self.assertEqual(image.intensities_dtype, expected_image.intensities_dtype)
+                self.assertTrue(np.array_equal(image.affine, expected_image.affine))
+
+            # The memory-mapped intensities are neither pickled nor copied to shared memory.
+            pickled_image = pickle.dumps(image)
+            self.assertLess(len(pickled_image), image.intensities.nbytes)
+            unpickled_image = pickle.loads(pickled_image)
+            self.assertIsInstance(unpickled_image.intensities, np.memmap)
+            self.assertTrue(np.array_equal(unpickled_image.intensities, expected_image.intensities))
+            self.assertIs(utilities.share_memory(image).intensities, image.intensities)
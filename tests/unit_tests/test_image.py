@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+import torch
+
+from deformetrica.core.observations import Image
+
+
+class ImageTests(unittest.TestCase):
+    """
+    Methods with names starting by "test" will be run
+    """
+
+    def setUp(self):
+        torch.manual_seed(42)
+        np.random.seed(42)
+
+    def _test_interpolations_are_equal(self, image_shape):
+        dimension = len(image_shape)
+        image = Image(np.random.rand(*image_shape), 'float64', np.eye(dimension + 1))
+
+        # deformed points, some of them being outside of the image.
+        points = torch.from_numpy(image.get_points())
+        deformed_points = (points + 2. * torch.randn(points.size(), dtype=torch.float64)).requires_grad_()
+        intensities = torch.from_numpy(image.get_intensities()).requires_grad_()
+
+        results = []
+        for interpolation in ['legacy', 'gather']:
+            image.interpolation = interpolation
+            deformed_intensities = image.get_deformed_intensities(deformed_points, intensities)
+            grad_points, grad_intensities = torch.autograd.grad(torch.sum(deformed_intensities ** 2),
+                                                                [deformed_points, intensities])
+            results.append([deformed_intensities.detach(), grad_points, grad_intensities])
+
+        self.assertEqual(results[0][0].size(), torch.Size(image_shape))
+        for legacy, gather in zip(*results):
+            self.assertTrue(torch.allclose(legacy, gather, rtol=1e-12, atol=1e-12))
+
+    def test_interpolations_are_equal_2d(self):
+        self._test_interpolations_are_equal((13, 17))
+
+    def test_interpolations_are_equal_3d(self):
+        self._test_interpolations_are_equal((7, 9, 11))
+
+    def test_unknown_interpolation(self):
+        image = Image(np.random.rand(5, 5), 'float64', np.eye(3))
+        image.interpolation = 'unknown'
+        points = torch.from_numpy(image.get_points())
+        with self.assertRaises(RuntimeError):
+            image.get_deformed_intensities(points, torch.from_numpy(image.get_intensities()))
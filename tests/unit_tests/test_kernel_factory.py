@@ -11,6 +11,9 @@ import numpy as np
 
 
 class KernelFactoryTest(unittest.TestCase):
+    def setUp(self):
+        dfca.default.update_dtype('float32')
+
     def test_instantiate_abstract_class(self):
         with self.assertRaises(TypeError):
             dfca.kernels.AbstractKernel()
@@ -37,6 +40,54 @@ class KernelFactoryTest(unittest.TestCase):
             instance = dfca.kernels.factory(k, kernel_width=1.)
             self.__isKernelValid(instance)
 
+    def test_instance_cache_statistics(self):
+        dfca.kernels.clear_cache()
+        k1 = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=2.)
+        k2 = dfca.kernels.factory('torch', kernel_width=2.)
+        k3 = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=2., cuda_type='float64')
+
+        self.assertIs(k1, k2)
+        self.assertIsNot(k1, k3)
+        self.assertEqual(dfca.kernels.cache_info()['hits'], 1)
+        self.assertEqual(dfca.kernels.cache_info()['misses'], 2)
+        self.assertEqual(dfca.kernels.cache_info()['size'], 2)
+
+    def test_instance_cache_is_keyed_on_explicit_dtype(self):
+        dfca.kernels.clear_cache()
+        for default_dtype in ['float32', 'float64']:
+            dfca.default.update_dtype(default_dtype)
+            k1 = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=2., cuda_type='float32')
+            k2 = dfca.kernels.factory('torch', kernel_width=2., cuda_type='float32')
+            k3 = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=2., cuda_type='float64')
+
+            self.assertIs(k1, k2)
+            self.assertIsNot(k1, k3)
+            self.assertIs(k1 if default_dtype == 'float32' else k3,
+                          dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=2.))
+        self.assertEqual(dfca.kernels.cache_info()['misses'], 2)
+
+    def test_instance_cache_is_bounded(self):
+        dfca.kernels.clear_cache()
+        cache_size = dfca.default.kernel_cache_size
+        dfca.default.kernel_cache_size = 2
+        try:
+            k1 = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=1.)
+            dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=2.)
+            dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=1.)     # k1 is now the most recently used.
+            dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=3.)     # evicts kernel_width=2.
+            self.assertEqual(dfca.kernels.cache_info()['size'], 2)
+            self.assertIs(k1, dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=1.))
+            self.assertEqual(dfca.kernels.cache_info()['misses'], 3)
+        finally:
+            dfca.default.kernel_cache_size = cache_size
+
+    def test_pickle_and_deepcopy_reuse_cached_instance(self):
+        from copy import deepcopy
+        for k in [dfca.kernels.Type.TORCH, dfca.kernels.Type.KEOPS]:
+            instance = dfca.kernels.factory(k, kernel_width=1., freeze_DOFs=[0])
+            self.assertIs(instance, pickle.loads(pickle.dumps(instance)))
+            self.assertIs(instance, deepcopy(instance))
+
     def __isKernelValid(self, instance):
         self.assertIsNotNone(instance)
         self.assertIsInstance(instance, dfca.kernels.AbstractKernel)
@@ -121,6 +172,41 @@ class TorchKernelTest(KernelTestBase):
         res = kernel_instance.convolve_gradient(self.x, self.x)
         self._assert_tensor_close(res, self.expected_convolve_gradient_res)
 
+    def test_tiled_convolve_cpu(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=1., tile_size=3)
+        res = kernel_instance.convolve(self.x, self.y, self.p)
+        self._assert_tensor_close(res, self.expected_convolve_res)
+
+    def test_tiled_convolve_gradient_cpu(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=1., tile_size=3)
+        res = kernel_instance.convolve_gradient(self.x, self.x)
+        self._assert_tensor_close(res, self.expected_convolve_gradient_res)
+
+    def test_tiled_and_full_kernels_are_equal(self):
+        full_kernel = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=1.)
+        tiled_kernel = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=1., tile_size=7)
+
+        x = torch.rand((50, 3), dtype=self.torch_dtype, requires_grad=True)
+        nx = torch.rand((50, 3), dtype=self.torch_dtype, requires_grad=True)
+        y = torch.rand((33, 3), dtype=self.torch_dtype, requires_grad=True)
+        ny = torch.rand((33, 3), dtype=self.torch_dtype, requires_grad=True)
+        px = torch.rand((50, 3), dtype=self.torch_dtype, requires_grad=True)
+        py = torch.rand((33, 3), dtype=self.torch_dtype, requires_grad=True)
+        ay = torch.rand((33, 1), dtype=self.torch_dtype, requires_grad=True)
+
+        for kernel in [full_kernel, tiled_kernel]:
+            gaussian = kernel.convolve(x, y, py)
+            varifold = kernel.convolve((x, nx), (y, ny), ay, mode='varifold')
+            gradient = kernel.convolve_gradient(px, x, y, py)
+            total = torch.sum(gaussian * px) + torch.sum(varifold) + torch.sum(gradient * px)
+            grads = torch.autograd.grad(total, [x, nx, y, ny, px, py, ay])
+
+            if kernel is full_kernel:
+                expected = [gaussian, varifold, gradient] + list(grads)
+            else:
+                for t1, t2 in zip([gaussian, varifold, gradient] + list(grads), expected):
+                    self._assert_tensor_close(t1, t2, precision=1e-12)
+
     @unittest.skipIf(not torch.cuda.is_available(), 'cuda is not available')
     def test_convolve_gpu(self):
         kernel_instance = dfca.kernels.factory(dfca.kernels.Type.TORCH, gpu_mode=dfca.GpuMode.FULL, kernel_width=1.)
@@ -185,6 +271,18 @@ class KeopsKernelTest(KernelTestBase):
     def setUp(self):
         super().setUp()
 
+    def test_reductions_are_lazily_created_and_shared(self):
+        from deformetrica.support.kernels import keops_kernel
+        keops_kernel._reductions.clear()
+
+        k1 = dfca.kernels.factory(dfca.kernels.Type.KEOPS, kernel_width=1.)
+        k2 = dfca.kernels.factory(dfca.kernels.Type.KEOPS, kernel_width=2.)
+        self.assertEqual(len(keops_kernel._reductions), 0)
+
+        k1.convolve(self.x, self.y, self.p)
+        k2.convolve(self.x, self.y, self.p)
+        self.assertEqual(list(keops_kernel._reductions.keys()), [('gaussian', 3, 'float64')])
+
     def test_convolve_cpu(self):
         kernel_instance = dfca.kernels.factory(dfca.kernels.Type.KEOPS, kernel_width=1.)
         res = kernel_instance.convolve(self.x, self.y, self.p)
@@ -468,3 +566,59 @@ class KeopsVersusCuda(unittest.TestCase):
         self.assertTrue(np.allclose(keops_dcp_2, torch_dcp_2, rtol=self.precision, atol=self.precision))
         self.assertTrue(np.allclose(keops_dmom_1, torch_dmom_1, rtol=self.precision, atol=self.precision))
         self.assertTrue(np.allclose(keops_dmom_2, torch_dmom_2, rtol=self.precision, atol=self.precision))
+
+    def test_convolve_and_gradient_equals_separate_operations(self):
+        # Parameters.
+        kernel_width = 10.
+        number_of_control_points = 10
+        dimension = 3
+
+        for kernel_type in [dfca.kernels.Type.KEOPS, dfca.kernels.Type.TORCH]:
+            for kernel in [dfca.kernels.factory(kernel_type, kernel_width=kernel_width),
+                           dfca.kernels.factory(kernel_type, kernel_width=kernel_width, tile_size=3)]:
+                control_points = torch.from_numpy(
+                    np.random.randn(number_of_control_points, dimension)).type(self.tensor_scalar_type).requires_grad_()
+                momenta = torch.from_numpy(
+                    np.random.randn(number_of_control_points, dimension)).type(self.tensor_scalar_type).requires_grad_()
+
+                # Compute the desired forward quantities.
+                fused_convolve, fused_convolve_gradient = kernel.convolve_and_gradient(control_points, momenta)
+                convolve = kernel.convolve(control_points, control_points, momenta)
+                convolve_gradient = kernel.convolve_gradient(momenta, control_points)
+
+                # Compute the desired backward quantities.
+                fused_total = torch.sum(fused_convolve * momenta) + torch.sum(fused_convolve_gradient ** 2)
+                total = torch.sum(convolve * momenta) + torch.sum(convolve_gradient ** 2)
+                fused_grads = torch.autograd.grad(fused_total, [control_points, momenta])
+                grads = torch.autograd.grad(total, [control_points, momenta])
+
+                # Check for equality.
+                for t1, t2 in zip([fused_convolve, fused_convolve_gradient] + list(fused_grads),
+                                  [convolve, convolve_gradient] + list(grads)):
+                    self.assertTrue(np.allclose(t1.detach().cpu().numpy(), t2.detach().cpu().numpy(),
+                                                rtol=self.precision, atol=self.precision))
+
+    def test_grid_convolve_approximates_convolve(self):
+        # Parameters.
+        kernel_width = 10.
+        number_of_control_points = 20
+
+        for dimension, grid_size in [(2, 101), (3, 41)]:
+            axes = [np.linspace(0., 40., grid_size)] * dimension
+            grid_points = torch.from_numpy(np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)).type(
+                self.tensor_scalar_type)
+            # Some control points lie outside of the grid, within the kernel support.
+            control_points = torch.from_numpy(
+                60. * np.random.rand(number_of_control_points, dimension) - 10.).type(self.tensor_scalar_type)
+            momenta = torch.from_numpy(
+                np.random.randn(number_of_control_points, dimension)).type(self.tensor_scalar_type)
+
+            for kernel_type in [dfca.kernels.Type.KEOPS, dfca.kernels.Type.TORCH]:
+                kernel = dfca.kernels.factory(kernel_type, kernel_width=kernel_width)
+                convolve = kernel.convolve(grid_points.view(-1, dimension), control_points, momenta).view(
+                    grid_points.size())
+                grid_convolve = kernel.grid_convolve(grid_points, control_points, momenta)
+
+                self.assertEqual(grid_convolve.size(), grid_points.size())
+                error = torch.max(torch.abs(grid_convolve - convolve)) / torch.max(torch.abs(convolve))
+                self.assertLess(float(error), 1e-2)
@@ -0,0 +1,117 @@
+import os
+import unittest
+import numpy as np
+import torch
+
+from deformetrica.core.models.longitudinal_atlas import LongitudinalAtlas
+from deformetrica.support.probability_distributions.multi_scalar_normal_distribution import \
+    MultiScalarNormalDistribution
+from deformetrica.support.probability_distributions.multi_scalar_truncated_normal_distribution import \
+    MultiScalarTruncatedNormalDistribution
+
+from . import example_data_dir
+
+
+class LongitudinalAtlasTests(unittest.TestCase):
+    """
+    Checks the packed (vectorized) computations of the longitudinal atlas against per-subject loops.
+    """
+
+    def setUp(self):
+        np.random.seed(42)
+        torch.manual_seed(42)
+
+        data_dir = os.path.join(example_data_dir, 'longitudinal_atlas', 'landmark', '2d', 'starmen', 'data')
+        template_specifications = {
+            'starman': {'deformable_object_type': 'polyline', 'noise_std': 1.0, 'attachment_type': 'landmark',
+                        'filename': os.path.join(data_dir, 'ForInitialization__Template.vtk'),
+                        'noise_variance_prior_normalized_dof': 0.01, 'noise_variance_prior_scale_std': 1.}}
+        self.model = LongitudinalAtlas(template_specifications, dimension=2, tensor_scalar_type=torch.DoubleTensor,
+                                       deformation_kernel_type='torch', deformation_kernel_width=1.,
+                                       initial_cp_spacing=1., number_of_sources=2, t0=70.,
+                                       initial_time_shift_variance=4., initial_acceleration_variance=0.25)
+
+        # Subjects with different numbers of visits, including a subject with a single one.
+        self.times = [np.array([66.7, 68.9, 71.0]), np.array([64.0]), np.array([65.2, 66.2, 67.2, 68.2])]
+        self.number_of_subjects = len(self.times)
+
+    def test_subject_indices(self):
+        subject_indices = self.model._get_subject_indices([len(times_i) for times_i in self.times])
+        expected = [i for i, times_i in enumerate(self.times) for _ in times_i]
+        self.assertEqual(subject_indices.tolist(), expected)
+        self.assertEqual(self.model._get_subject_indices([]).tolist(), [])
+
+    def test_absolute_times_equal_per_subject_loop(self):
+        onset_ages = torch.from_numpy(70. + np.random.randn(self.number_of_subjects))
+        accelerations = torch.from_numpy(np.array([1.2, -0.3, 0.8]))   # the negative acceleration is clamped.
+
+        absolute_times, tmin, tmax = self.model._compute_absolute_times(self.times, onset_ages, accelerations)
+
+        expected = [max(0., float(accelerations[i])) * (torch.from_numpy(times_i) - onset_ages[i]) + 70.
+                    for i, times_i in enumerate(self.times)]
+        self.assertEqual(len(absolute_times), self.number_of_subjects)
+        for absolute_times_i, expected_i in zip(absolute_times, expected):
+            self.assertTrue(np.allclose(absolute_times_i.numpy(), expected_i.numpy()))
+        all_times = np.concatenate([elt.numpy() for elt in expected] + [np.array([70.])])
+        self.assertAlmostEqual(tmin, np.min(all_times))
+        self.assertAlmostEqual(tmax, np.max(all_times))
+
+    def test_individual_attachments_equal_per_subject_loop(self):
+        self.model.set_noise_variance(np.array([0.7]))
+        residuals = [[torch.rand(1, dtype=torch.float64) for _ in times_i] for times_i in self.times]
+
+        packed_residuals, subject_indices = self.model._pack_residuals(residuals)
+        self.assertEqual(tuple(packed_residuals.size()), (sum(len(times_i) for times_i in self.times), 1))
+        self.assertTrue(torch.equal(packed_residuals[subject_indices == 2],
+                                    torch.stack(residuals[2])))
+
+        attachments, _ = self.model._compute_individual_attachments(residuals)
+        expected = [sum(- 0.5 * float(torch.sum(residual / 0.7)) for residual in residuals_i)
+                    for residuals_i in residuals]
+        self.assertTrue(np.allclose(attachments.numpy(), expected))
+
+    def test_random_effects_regularity_equals_per_subject_loop(self):
+        individual_RER = self.model.initialize_random_effects_realization(self.number_of_subjects)
+        sources = torch.from_numpy(np.random.randn(self.number_of_subjects, 2))
+        onset_ages = torch.from_numpy(individual_RER['onset_age'] + np.random.randn(self.number_of_subjects))
+        accelerations = torch.from_numpy(np.array([1.2, 0.9, 1.1]))
+
+        regularity = self.model._compute_random_effects_regularity(sources, onset_ages, accelerations)
+
+        expected = 0.
+        for i in range(self.number_of_subjects):
+            for key, value in [('sources', sources[i]), ('onset_age', onset_ages[i]),
+                               ('acceleration', accelerations[i])]:
+                expected += float(self.model.individual_random_effects[key].compute_log_likelihood_torch(
+                    value, torch.DoubleTensor))
+        self.assertAlmostEqual(float(regularity), expected)
+
+    def test_batched_log_likelihoods_equal_per_sample(self):
+        observations = torch.from_numpy(np.array([[0.5, 1.2], [2.0, 0.1], [-0.3, 1.0]]))
+
+        for distribution in [MultiScalarNormalDistribution(), MultiScalarTruncatedNormalDistribution()]:
+            distribution.set_mean(np.array([1., 0.5]))
+            distribution.set_variance(0.4)
+
+            batched = distribution.compute_batched_log_likelihood_torch(observations, torch.DoubleTensor)
+            self.assertEqual(tuple(batched.size()), (3,))
+            for observation, log_likelihood in zip(observations, batched):
+                self.assertEqual(float(log_likelihood), float(
+                    distribution.compute_log_likelihood_torch(observation, torch.DoubleTensor)))
+
+    def test_unique_visits_are_merged_within_tolerance(self):
+        self.model.visit_deduplication_tolerance = 0.1
+        visits = [(0, 0), (0, 1), (1, 0), (2, 0)]
+        # The first two visits straddle a multiple of the tolerance, but are closer than it. The third one has the
+        # same time as the first one, but other sources. The last one is further than the tolerance in time.
+        absolute_times = [[torch.tensor(70.04999), torch.tensor(70.05001)], [torch.tensor(70.04999)],
+                          [torch.tensor(70.2)]]
+        sources = torch.tensor([[0., 0.], [0.5, 0.], [0., 0.]])
+
+        unique_visits, unique_indices = self.model._get_unique_visits(visits, absolute_times, sources, True)
+        self.assertEqual(unique_visits, [(0, 0), (1, 0), (2, 0)])
+        self.assertEqual(unique_indices, [0, 0, 1, 2])
+
+        unique_visits, unique_indices = self.model._get_unique_visits(visits, absolute_times, sources, False)
+        self.assertEqual(unique_visits, visits)
+        self.assertEqual(unique_indices, [0, 1, 2, 3])
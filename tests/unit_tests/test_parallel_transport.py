@@ -1,5 +1,6 @@
 import os
 import unittest
+from unittest import mock
 
 import torch
 
@@ -69,3 +70,110 @@ class ParallelTransportTests(unittest.TestCase):
         # self.assertTrue(np.linalg.norm(transported_momenta_truth - parallel_transport_trajectory[-1].data.numpy())/np.linalg.norm(transported_momenta_truth) <= 1e-5)
 
         # should be 1e-5 (relative) with 10 concentration wrt C++
+
+    def _get_transport_geodesic(self, factor=5):
+        control_points = dfca.io.read_2D_array(os.path.join(unit_tests_data_dir, "parallel_transport", "control_points.txt"))
+        momenta = dfca.io.read_3D_array(os.path.join(unit_tests_data_dir, "parallel_transport", "geodesic_momenta.txt"))
+
+        geodesic = dfca.deformations.Geodesic(
+            dense_mode=False,
+            kernel=dfca.kernels.factory('torch', kernel_width=0.01, gpu_mode=dfca.GpuMode.NONE),
+            t0=0.,
+            use_rk2_for_shoot=True,
+            concentration_of_time_points=10 * factor
+        )
+
+        geodesic.tmin = 0.
+        geodesic.tmax = 9.
+        geodesic.set_momenta_t0(torch.from_numpy(momenta).type(torch.DoubleTensor) / float(factor))
+        geodesic.set_control_points_t0(torch.from_numpy(control_points).type(torch.DoubleTensor))
+        geodesic.update()
+        return geodesic
+
+    def test_parallel_transport_cometric_factors(self):
+        """
+        the cached Cholesky factors solve the cometric like the explicit inverse kernel matrices, are shared by all
+        the transported momenta, and are recomputed when discarded by the memory cap.
+        """
+        momenta_to_transport = torch.from_numpy(dfca.io.read_3D_array(os.path.join(
+            unit_tests_data_dir, "parallel_transport", "momenta_to_transport.txt"))).type(torch.DoubleTensor)
+        geodesic = self._get_transport_geodesic()
+        exponential = geodesic.forward_exponential
+
+        for i in [0, exponential.number_of_time_points - 2]:
+            kernel_matrix = exponential.shoot_kernel.get_kernel_matrix(exponential.control_points_t[i + 1])
+            self.assertTrue(np.allclose(exponential._solve_cometric(i, momenta_to_transport).numpy(),
+                                        torch.mm(torch.inverse(kernel_matrix), momenta_to_transport).numpy(),
+                                        rtol=1e-8, atol=1e-10))
+
+        transported_momenta = geodesic.parallel_transport(momenta_to_transport)[-1]
+        factors = dict(exponential.cometric_factors)
+        self.assertEqual(len(factors), exponential.number_of_time_points - 1)
+        geodesic.parallel_transport(2. * momenta_to_transport)
+        self.assertTrue(all(exponential.cometric_factors[i] is factor for i, factor in factors.items()))
+
+        cometric_cache_memory = dfca.default.cometric_cache_memory
+        try:
+            dfca.default.cometric_cache_memory = 3.5 * factors[0].element_size() * factors[0].nelement() / 1024 ** 2
+            exponential.cometric_factors.clear()
+            self.assertTrue(np.allclose(geodesic.parallel_transport(momenta_to_transport)[-1].numpy(),
+                                        transported_momenta.numpy(), rtol=1e-12, atol=1e-12))
+            self.assertEqual(len(exponential.cometric_factors), 3)
+        finally:
+            dfca.default.cometric_cache_memory = cometric_cache_memory
+
+    def test_cometric_factor_jitter(self):
+        """
+        the Cholesky factorization of a singular kernel matrix falls back on a small diagonal jitter.
+        """
+        control_points = torch.tensor([[0., 0.], [0., 0.], [1., 0.]], dtype=torch.float64)
+        kernel = dfca.kernels.factory('torch', kernel_width=1., gpu_mode=dfca.GpuMode.NONE)
+        kernel_matrix = kernel.get_kernel_matrix(control_points)
+
+        factor = dfca.deformations.Exponential._compute_cometric_factor(kernel_matrix)
+        self.assertTrue(np.allclose(torch.mm(factor, factor.t()).numpy(), kernel_matrix.numpy(), atol=1e-8))
+        self.assertTrue(torch.all(torch.isfinite(factor)))
+
+    def test_cometric_solve_falls_back_on_inverse(self):
+        """
+        kernel matrices that cannot be factorized, even with a jitter, are inverted as before.
+        """
+        geodesic = self._get_transport_geodesic()
+        exponential = geodesic.forward_exponential
+        exponential.cometric_factors.clear()
+        momenta = torch.rand(exponential.initial_momenta.size(), dtype=torch.float64)
+        indefinite_matrix = torch.tensor([[1., 2.], [2., 1.]], dtype=torch.float64)
+        self.assertIsNone(dfca.deformations.Exponential._compute_cometric_factor(indefinite_matrix))
+
+        with mock.patch.object(dfca.deformations.Exponential, '_compute_cometric_factor', return_value=None):
+            approx_momenta = exponential._solve_cometric(0, momenta)
+
+        kernel_matrix = exponential.shoot_kernel.get_kernel_matrix(exponential.control_points_t[1])
+        self.assertEqual(list(exponential.cometric_inverses.keys()), [0])
+        self.assertTrue(np.allclose(approx_momenta.numpy(), torch.mm(torch.inverse(kernel_matrix), momenta).numpy()))
+
+    def test_parallel_transport_many(self):
+        """
+        transporting stacked momenta at once gives the same trajectories as transporting them one by one.
+        """
+        momenta_to_transport = torch.from_numpy(dfca.io.read_3D_array(os.path.join(
+            unit_tests_data_dir, "parallel_transport", "momenta_to_transport.txt"))).type(torch.DoubleTensor)
+        geodesic = self._get_transport_geodesic(factor=1)
+        momenta_block = torch.stack([momenta_to_transport, torch.zeros(momenta_to_transport.size()).double(),
+                                     momenta_to_transport.flip(0),
+                                     momenta_to_transport + 0.5 * geodesic.momenta_t0])
+
+        for is_orthogonal in [False, True]:
+            if is_orthogonal:
+                norm_squared = geodesic.get_norm_squared()
+                momenta_block = momenta_block - geodesic.momenta_t0 * torch.stack([
+                    geodesic.forward_exponential.scalar_product(geodesic.control_points_t0, elt, geodesic.momenta_t0)
+                    for elt in momenta_block]).view(-1, 1, 1) / norm_squared
+
+            transported_block_t = geodesic.parallel_transport_many(momenta_block, is_orthogonal=is_orthogonal)
+            self.assertEqual(len(transported_block_t), len(geodesic.get_times()))
+            for s, momenta in enumerate(momenta_block):
+                transported_t = geodesic.parallel_transport(momenta, is_orthogonal=is_orthogonal)
+                for transported_block, transported in zip(transported_block_t, transported_t):
+                    self.assertTrue(np.allclose(transported_block[s].numpy(), transported.numpy(),
+                                                rtol=1e-6, atol=1e-7))
@@ -80,3 +80,134 @@ class ShootingTests(unittest.TestCase):
         for (cp, mom, time) in zip(cp_traj, mom_traj, times_traj):
             self.assertTrue(np.allclose(cp.detach().numpy(), control_points + time * momenta))
             self.assertTrue(np.allclose(mom.detach().numpy(), momenta))
+
+    def test_batched_exponential_equals_sequential_shooting(self):
+        """
+        Test that shooting and flowing several momenta at once gives the same trajectories as one subject at a time.
+        """
+        np.random.seed(42)
+        control_points = torch.from_numpy(np.random.randn(6, 3)).type(torch.DoubleTensor)
+        momenta = torch.from_numpy(np.random.randn(4, 6, 3)).type(torch.DoubleTensor).requires_grad_()
+        landmark_points = torch.from_numpy(np.random.randn(20, 3)).type(torch.DoubleTensor)
+
+        for kernel_type in ['torch', 'keops']:
+            for use_rk2 in [False, True]:
+                kernel = dfca.kernels.factory(kernel_type, kernel_width=1., cuda_type='float64')
+                exponential = dfca.deformations.Exponential(
+                    kernel=kernel, number_of_time_points=5, use_rk2_for_shoot=use_rk2, use_rk2_for_flow=use_rk2)
+                batched_exponential = dfca.deformations.BatchedExponential(
+                    kernel=kernel, number_of_time_points=5, use_rk2_for_shoot=use_rk2, use_rk2_for_flow=use_rk2)
+
+                batched_exponential.set_initial_template_points({'landmark_points': landmark_points})
+                batched_exponential.set_initial_control_points(control_points)
+                batched_exponential.set_initial_momenta(momenta)
+                batched_exponential.update()
+                batched_points = batched_exponential.get_template_points()['landmark_points']
+                batched_norm = batched_exponential.get_norm_squared()
+                batched_grad = torch.autograd.grad(torch.sum(batched_points ** 2) + batched_norm, momenta)[0]
+
+                exponential.set_initial_template_points({'landmark_points': landmark_points})
+                exponential.set_initial_control_points(control_points)
+                points, norm = [], 0.
+                for i in range(momenta.size(0)):
+                    exponential.set_initial_momenta(momenta[i])
+                    exponential.update()
+                    points.append(exponential.get_template_points()['landmark_points'])
+                    norm += exponential.get_norm_squared()
+                points = torch.stack(points)
+                grad = torch.autograd.grad(torch.sum(points ** 2) + norm, momenta)[0]
+
+                self.assertTrue(np.allclose(batched_points.detach().numpy(), points.detach().numpy(), atol=1e-10))
+                self.assertTrue(np.allclose(batched_norm.detach().numpy(), norm.detach().numpy(), atol=1e-10))
+                self.assertTrue(np.allclose(batched_grad.numpy(), grad.numpy(), atol=1e-10))
+
+    def test_geodesic_template_points_at_times(self):
+        """
+        Test that the cached, vectorized lookup of the template points interpolates the geodesic trajectory, and is
+        rebuilt when the geodesic is updated.
+        """
+        np.random.seed(42)
+        control_points = torch.from_numpy(np.random.randn(6, 2)).type(torch.DoubleTensor)
+        momenta = torch.from_numpy(np.random.randn(6, 2)).type(torch.DoubleTensor).requires_grad_()
+        landmark_points = torch.from_numpy(np.random.randn(20, 2)).type(torch.DoubleTensor)
+
+        geodesic = dfca.deformations.Geodesic(
+            kernel=dfca.kernels.factory('torch', kernel_width=1.), t0=0., concentration_of_time_points=3)
+        geodesic.set_template_points_t0({'landmark_points': landmark_points})
+        geodesic.set_control_points_t0(control_points)
+        geodesic.set_tmin(-1.)
+        geodesic.set_tmax(2.)
+
+        for scale in [1., 0.5]:
+            geodesic.set_momenta_t0(scale * momenta)
+            geodesic.update()
+
+            grid_times = geodesic.get_times()
+            trajectory = geodesic.get_template_points_trajectory()['landmark_points']
+            query_times = [-1., -0.9, 0., 0.35, grid_times[4], 1.99, 2.]
+            points_at = geodesic.get_template_points_at(query_times)['landmark_points']
+            self.assertEqual(points_at.size(), (len(query_times), 20, 2))
+
+            for k, time in enumerate(query_times):
+                j = min(max(1, int(np.searchsorted(grid_times, time, side='right'))), len(grid_times) - 1)
+                w = (time - grid_times[j - 1]) / (grid_times[j] - grid_times[j - 1])
+                expected = (1. - w) * trajectory[j - 1] + w * trajectory[j]
+                self.assertTrue(np.allclose(points_at[k].detach().numpy(), expected.detach().numpy(), atol=1e-12))
+                self.assertTrue(np.allclose(geodesic.get_template_points(time)['landmark_points'].detach().numpy(),
+                                            expected.detach().numpy(), atol=1e-12))
+
+            grad = torch.autograd.grad(torch.sum(points_at ** 2), momenta)[0]
+            self.assertTrue(torch.all(torch.isfinite(grad)))
+
+    def test_adaptive_shooting(self):
+        """
+        Test that the adaptive shoot matches a finely discretized fixed-step shoot at the same time points, and that
+        small deformations take fewer steps than large ones.
+        """
+        np.random.seed(42)
+        control_points = torch.from_numpy(np.random.randn(6, 2)).type(torch.DoubleTensor)
+        momenta = torch.from_numpy(np.random.randn(6, 2)).type(torch.DoubleTensor).requires_grad_()
+        landmark_points = torch.from_numpy(np.random.randn(20, 2)).type(torch.DoubleTensor)
+        kernel = dfca.kernels.factory('torch', kernel_width=1.)
+
+        reference = dfca.deformations.Exponential(kernel=kernel, number_of_time_points=2001,
+                                                  use_rk2_for_shoot=True, use_rk2_for_flow=True)
+        adaptive = dfca.deformations.Exponential(kernel=kernel, number_of_time_points=11,
+                                                 adaptive_step_tolerance=1e-6)
+        self.assertIsNone(reference.get_step_statistics())
+
+        accepted_steps = []
+        for scale in [0.1, 1.]:
+            for exponential in [reference, adaptive]:
+                exponential.set_initial_template_points({'landmark_points': landmark_points})
+                exponential.set_initial_control_points(control_points)
+                exponential.set_initial_momenta(scale * momenta)
+                exponential.update()
+
+            self.assertEqual(len(adaptive.control_points_t), 11)
+            self.assertEqual(len(adaptive.template_points_t['landmark_points']), 11)
+            for k in range(11):
+                self.assertTrue(np.allclose(adaptive.control_points_t[k].detach().numpy(),
+                                            reference.control_points_t[200 * k].detach().numpy(), atol=1e-5))
+                self.assertTrue(np.allclose(adaptive.get_template_points(k)['landmark_points'].detach().numpy(),
+                                            reference.get_template_points(200 * k)['landmark_points'].detach().numpy(),
+                                            atol=1e-5))
+
+            statistics = adaptive.get_step_statistics()
+            self.assertEqual(statistics['function_evaluations'],
+                             1 + 3 * (statistics['accepted_steps'] + statistics['rejected_steps']))
+            accepted_steps.append(statistics['accepted_steps'])
+
+            grad = torch.autograd.grad(torch.sum(adaptive.get_template_points()['landmark_points'] ** 2), momenta)[0]
+            self.assertTrue(torch.all(torch.isfinite(grad)))
+
+        self.assertLess(accepted_steps[0], 10)
+        self.assertLess(accepted_steps[0], accepted_steps[1])
+
+        # Flowing new template points integrates them along the same deformation.
+        adaptive.set_initial_template_points({'landmark_points': 0.5 * landmark_points})
+        reference.set_initial_template_points({'landmark_points': 0.5 * landmark_points})
+        adaptive.update()
+        reference.update()
+        self.assertTrue(np.allclose(adaptive.get_template_points()['landmark_points'].detach().numpy(),
+                                    reference.get_template_points()['landmark_points'].detach().numpy(), atol=1e-5))